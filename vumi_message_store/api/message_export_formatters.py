@@ -1,13 +1,31 @@
 """ Formatters to serialise messages for export """
 
+import json
+import zlib
+from collections import OrderedDict
 from csv import writer
+from functools import partial
 
-from zope.interface import Interface, implementer
+from vumi.message import to_json
+from zope.interface import Attribute, Interface, implementer
+
+# The default number of buffered rows that triggers a flush.
+DEFAULT_FLUSH_ROWS = 100
+# The default number of buffered bytes that triggers a flush.
+DEFAULT_FLUSH_BYTES = 64 * 1024
+# The default maximum number of rows in each columnar row group.
+DEFAULT_ROW_GROUP_SIZE = 1000
+# The default zlib compression level for gzipped exports.
+DEFAULT_COMPRESS_LEVEL = 6
 
 
 class IMessageExportFormatter(Interface):
     """ Interface for writing messages to an HTTP request. """
 
+    raw_json = Attribute(
+        "If true, :meth:`write_row` is given each message as a JSON string "
+        "built from its stored fields instead of as a message object.")
+
     def add_http_headers(request):
         """
         Add any needed HTTP headers to the request.
@@ -15,6 +33,14 @@ class IMessageExportFormatter(Interface):
         Often used to set the Content-Type header.
         """
 
+    def select_fields(fields):
+        """
+        Only write the given message fields, in the given order.
+
+        :raises ValueError:
+            If the formatter can't write one of the fields.
+        """
+
     def write_row_header(request):
         """
         Write any header bytes that need to be written to the request before
@@ -24,29 +50,164 @@ class IMessageExportFormatter(Interface):
     def write_row(request, message):
         """
         Write a :class:`TransportUserMessage` to the request.
+
+        The formatter may buffer the row instead of writing it immediately.
+        """
+
+    def write_row_footer(request):
         """
+        Write any buffered bytes and any footer bytes that need to be written
+        to the request after all messages.
+        """
+
+    def write_cursor(request, cursor):
+        """
+        Write a cursor that an interrupted export can be resumed from.
+        """
+
+    def flush(request):
+        """
+        Write any buffered bytes to the request.
+        """
+
+
+def check_fields(fields, available_fields):
+    """
+    Check that the selected fields are all available and return them as a
+    tuple.
+
+    :raises ValueError:
+        If any of the fields aren't available.
+    """
+    unknown = [field for field in fields if field not in available_fields]
+    if unknown:
+        raise ValueError("Unknown fields: %s" % (", ".join(unknown),))
+    return tuple(fields)
+
+
+class WriteBuffer(object):
+    """
+    File-like object that collects written chunks so they can be written to
+    a request in one go.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def pop(self):
+        """
+        Return everything written since the last pop and empty the buffer.
+        """
+        data = ''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
 
 
 @implementer(IMessageExportFormatter)
 class JsonFormatter(object):
-    """ Formatter for writing messages to requests as JSON. """
+    """
+    Formatter for writing messages to requests as JSON.
+
+    Each message is written as a single line of JSON to an internal buffer,
+    which is written to the request once it holds `flush_bytes` bytes or when
+    :meth:`flush` is called. Because of this, a formatter instance shouldn't
+    be shared between requests.
+
+    Cursors are written as lines of the form ``{"cursor": "..."}``.
+
+    If fields are selected, each message is written as an object holding
+    just those fields, with ``null`` for any the message doesn't have.
+    """
+
+    raw_json = False
+
+    def __init__(self, flush_bytes=DEFAULT_FLUSH_BYTES):
+        self.flush_bytes = flush_bytes
+        self.fields = None
+        self._buffer = WriteBuffer()
 
     def add_http_headers(self, request):
         resp_headers = request.responseHeaders
         resp_headers.addRawHeader(
             'Content-Type', 'application/json; charset=utf-8')
 
+    def select_fields(self, fields):
+        self.fields = list(fields)
+
     def write_row_header(self, request):
         pass
 
     def write_row(self, request, message):
-        request.write(message.to_json())
-        request.write('\n')
+        if self.fields is None:
+            self._write_json(request, message.to_json())
+        else:
+            self._write_json(request, self._project(message.payload))
+
+    def _project(self, payload):
+        return to_json(OrderedDict(
+            (field, payload.get(field)) for field in self.fields))
+
+    def _write_json(self, request, data):
+        self._buffer.write(data)
+        self._buffer.write('\n')
+        if self._buffer.size >= self.flush_bytes:
+            self.flush(request)
+
+    def write_row_footer(self, request):
+        self.flush(request)
+
+    def write_cursor(self, request, cursor):
+        self._buffer.write(json.dumps({'cursor': cursor}))
+        self._buffer.write('\n')
+
+    def flush(self, request):
+        data = self._buffer.pop()
+        if data:
+            request.write(data)
+
+
+@implementer(IMessageExportFormatter)
+class RawJsonFormatter(JsonFormatter):
+    """
+    Formatter for writing messages to requests as JSON without deserialising
+    them.
+
+    Messages are passed to :meth:`write_row` as JSON strings built from
+    their stored fields, which avoids building a message object for each one
+    only to serialise it again. The stored records are still loaded and
+    decoded.
+    """
+
+    raw_json = True
+
+    def write_row(self, request, message_json):
+        self._write_json(request, self._project_json(message_json))
+
+    def _project_json(self, message_json):
+        if self.fields is None:
+            return message_json
+        return self._project(json.loads(message_json))
 
 
 @implementer(IMessageExportFormatter)
 class CsvFormatter(object):
-    """ Formatter for writing messages to requests as CSV. """
+    """
+    Formatter for writing messages to requests as CSV.
+
+    Rows are written to an internal buffer by a single :func:`csv.writer` and
+    the buffer is written to the request once it holds `flush_rows` rows or
+    `flush_bytes` bytes, or when :meth:`flush` is called. Because of this, a
+    formatter instance shouldn't be shared between requests.
+
+    Cursors are written as rows with ``#cursor`` in the first column and the
+    cursor in the second.
+    """
 
     FIELDS = (
         'timestamp',
@@ -59,28 +220,314 @@ class CsvFormatter(object):
         'group',
     )
 
+    raw_json = False
+
+    def __init__(self, flush_rows=DEFAULT_FLUSH_ROWS,
+                 flush_bytes=DEFAULT_FLUSH_BYTES):
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self._buffer = WriteBuffer()
+        self._buffered_rows = 0
+        self._writer = writer(self._buffer)
+        self.select_fields(self.FIELDS)
+
     def add_http_headers(self, request):
         resp_headers = request.responseHeaders
         resp_headers.addRawHeader(
             'Content-Type', 'text/csv; charset=utf-8')
 
+    def select_fields(self, fields):
+        self.fields = check_fields(fields, self.FIELDS)
+        self._field_formatters = [
+            self._get_field_formatter(field) for field in self.fields]
+
     def write_row_header(self, request):
-        writer(request).writerow(self.FIELDS)
+        self._writer.writerow(self.fields)
+        self.flush(request)
 
     def write_row(self, request, message):
-        writer(request).writerow([
-            self._format_field(field, message) for field in self.FIELDS])
+        self._write_values(request, self._format_row(message))
+
+    def _format_row(self, message):
+        return [
+            field_formatter(message).encode('utf-8')
+            for field_formatter in self._field_formatters]
+
+    def _write_values(self, request, values):
+        self._writer.writerow(values)
+        self._buffered_rows += 1
+        if (self._buffered_rows >= self.flush_rows or
+                self._buffer.size >= self.flush_bytes):
+            self.flush(request)
 
-    def _format_field(self, field, message):
+    def write_row_footer(self, request):
+        self.flush(request)
+
+    def write_cursor(self, request, cursor):
+        self._writer.writerow(['#cursor', cursor])
+
+    def flush(self, request):
+        self._buffered_rows = 0
+        data = self._buffer.pop()
+        if data:
+            request.write(data)
+
+    def _get_field_formatter(self, field):
         field_formatter = getattr(self, '_format_field_%s' % (field,), None)
-        if field_formatter is not None:
-            field_value = field_formatter(message)
-        else:
-            field_value = self._format_field_default(field, message)
-        return field_value.encode('utf-8')
+        if field_formatter is None:
+            field_formatter = partial(self._format_field_default, field)
+        return field_formatter
 
     def _format_field_default(self, field, message):
         return message[field] or u''
 
     def _format_field_timestamp(self, message):
         return message['timestamp'].isoformat()
+
+
+@implementer(IMessageExportFormatter)
+class EventCsvFormatter(CsvFormatter):
+    """ Formatter for writing events to requests as CSV. """
+
+    FIELDS = (
+        'timestamp',
+        'event_id',
+        'event_type',
+        'user_message_id',
+        'sent_message_id',
+        'delivery_status',
+        'nack_reason',
+    )
+
+    def _format_field_default(self, field, event):
+        # Not every event type has every field.
+        return event.get(field) or u''
+
+
+@implementer(IMessageExportFormatter)
+class MessageStatusJsonFormatter(RawJsonFormatter):
+    """
+    Formatter for writing messages with their latest status to requests as
+    JSON.
+
+    Each row is a ``(message_json, status_timestamp, status)`` tuple and is
+    written as a JSON object with ``message``, ``status_timestamp`` and
+    ``status`` fields. The message JSON is written as is.
+    """
+
+    def write_row(self, request, row):
+        message_json, status_timestamp, status = row
+        row_json = '{"message": %s, "status_timestamp": %s, "status": %s}' % (
+            self._project_json(message_json), json.dumps(status_timestamp),
+            json.dumps(status))
+        self._write_json(request, row_json)
+
+
+@implementer(IMessageExportFormatter)
+class MessageStatusCsvFormatter(CsvFormatter):
+    """
+    Formatter for writing messages with their latest status to requests as
+    CSV.
+
+    Each row is a ``(message, status_timestamp, status)`` tuple and is written
+    with the message fields followed by the status fields.
+    """
+
+    STATUS_FIELDS = (
+        'status_timestamp',
+        'status',
+    )
+
+    def write_row_header(self, request):
+        self._writer.writerow(self.fields + self.STATUS_FIELDS)
+        self.flush(request)
+
+    def write_row(self, request, row):
+        message, status_timestamp, status = row
+        self._write_values(request, self._format_row(message) + [
+            (status_timestamp or u'').encode('utf-8'),
+            (status or u'').encode('utf-8'),
+        ])
+
+
+@implementer(IMessageExportFormatter)
+class ColumnarJsonFormatter(object):
+    """
+    Formatter for writing messages to requests as columnar JSON.
+
+    Messages are collected into row groups of up to `row_group_size` rows,
+    and a row group is also ended whenever :meth:`flush` is called. Each row
+    group is written as a single line of JSON of the form::
+
+        {"num_rows": 2, "columns": {"timestamp": [...], "message_id": [...]}}
+
+    with a list of values for each of :attr:`FIELDS`. Keeping each field's
+    values together lets columnar tools load them without parsing every row
+    and makes the output compress better than CSV.
+
+    Cursors end the current row group and are written as lines of the form
+    ``{"cursor": "..."}``.
+    """
+
+    raw_json = False
+
+    FIELDS = CsvFormatter.FIELDS
+
+    def __init__(self, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        self.row_group_size = row_group_size
+        self.select_fields(self.FIELDS)
+
+    def _start_row_group(self):
+        self._num_rows = 0
+        self._columns = [[] for _ in self.fields]
+
+    def add_http_headers(self, request):
+        resp_headers = request.responseHeaders
+        resp_headers.addRawHeader(
+            'Content-Type', 'application/json; charset=utf-8')
+
+    def select_fields(self, fields):
+        self.fields = check_fields(fields, self.FIELDS)
+        self._field_formatters = [
+            self._get_field_formatter(field) for field in self.fields]
+        self._start_row_group()
+
+    def write_row_header(self, request):
+        pass
+
+    def write_row(self, request, message):
+        for column, field_formatter in zip(
+                self._columns, self._field_formatters):
+            column.append(field_formatter(message))
+        self._num_rows += 1
+        if self._num_rows >= self.row_group_size:
+            self.flush(request)
+
+    def write_row_footer(self, request):
+        self.flush(request)
+
+    def write_cursor(self, request, cursor):
+        # The cursor must come after the row group holding the rows before
+        # it.
+        self.flush(request)
+        request.write(json.dumps({'cursor': cursor}) + '\n')
+
+    def flush(self, request):
+        if not self._num_rows:
+            return
+        row_group = OrderedDict([
+            ('num_rows', self._num_rows),
+            ('columns', OrderedDict(zip(self.fields, self._columns))),
+        ])
+        self._start_row_group()
+        request.write(json.dumps(row_group) + '\n')
+
+    def _get_field_formatter(self, field):
+        field_formatter = getattr(self, '_format_field_%s' % (field,), None)
+        if field_formatter is None:
+            field_formatter = partial(self._format_field_default, field)
+        return field_formatter
+
+    def _format_field_default(self, field, message):
+        return message[field]
+
+    def _format_field_timestamp(self, message):
+        return message['timestamp'].isoformat()
+
+
+class GzipWriter(object):
+    """
+    File-like object that compresses data written to it with gzip and writes
+    the compressed data to a request.
+
+    Data is compressed as it is written, so the whole body is never held in
+    memory. :meth:`flush` writes out everything compressed so far, and
+    :meth:`close` finishes the gzip stream.
+    """
+
+    def __init__(self, request, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.request = request
+        self._compressor = zlib.compressobj(
+            compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._unflushed = False
+
+    def write(self, data):
+        self._unflushed = True
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.request.write(compressed)
+
+    def flush(self):
+        if self._unflushed:
+            self._unflushed = False
+            self.request.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def close(self):
+        self.request.write(self._compressor.flush(zlib.Z_FINISH))
+
+
+@implementer(IMessageExportFormatter)
+class GzipFormatter(object):
+    """
+    Formatter that compresses the output of another formatter with gzip.
+
+    The wrapped formatter writes to a :class:`GzipWriter` instead of the
+    request, and each flush of this formatter writes out the data compressed
+    so far.
+
+    :param formatter:
+        The :class:`IMessageExportFormatter` to compress the output of.
+    :param bool content_encoding:
+        If true, the response is sent with a ``Content-Encoding: gzip`` header
+        and keeps the wrapped formatter's content type. Otherwise the response
+        is a gzip file with an ``application/gzip`` content type.
+    :param int compress_level:
+        The zlib compression level to use.
+    """
+
+    def __init__(self, formatter, content_encoding=False,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.formatter = formatter
+        self.content_encoding = content_encoding
+        self.compress_level = compress_level
+        self._writer = None
+
+    @property
+    def raw_json(self):
+        return self.formatter.raw_json
+
+    def _get_writer(self, request):
+        if self._writer is None:
+            self._writer = GzipWriter(request, self.compress_level)
+        return self._writer
+
+    def add_http_headers(self, request):
+        self.formatter.add_http_headers(request)
+        resp_headers = request.responseHeaders
+        if self.content_encoding:
+            resp_headers.addRawHeader('Content-Encoding', 'gzip')
+            resp_headers.addRawHeader('Vary', 'Accept-Encoding')
+        else:
+            resp_headers.setRawHeaders('Content-Type', ['application/gzip'])
+
+    def select_fields(self, fields):
+        self.formatter.select_fields(fields)
+
+    def write_row_header(self, request):
+        self.formatter.write_row_header(self._get_writer(request))
+
+    def write_row(self, request, message):
+        self.formatter.write_row(self._get_writer(request), message)
+
+    def write_row_footer(self, request):
+        writer = self._get_writer(request)
+        self.formatter.write_row_footer(writer)
+        writer.close()
+
+    def write_cursor(self, request, cursor):
+        self.formatter.write_cursor(self._get_writer(request), cursor)
+
+    def flush(self, request):
+        writer = self._get_writer(request)
+        self.formatter.flush(writer)
+        writer.flush()
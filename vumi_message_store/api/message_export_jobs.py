@@ -0,0 +1,363 @@
+""" Export jobs that write messages to local files """
+
+import gzip
+import os
+import shutil
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, gatherResults, inlineCallbacks, succeed)
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from vumi_message_store.api.message_export_formatters import (
+    DEFAULT_COMPRESS_LEVEL)
+from vumi_message_store.api.message_export_resources import ExportProducer
+
+# The default maximum number of export jobs to run at once.
+DEFAULT_MAX_CONCURRENT_JOBS = 2
+# The default number of uncompressed bytes to write to each export file.
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+# The default number of seconds to keep finished jobs around for.
+DEFAULT_JOB_EXPIRY = 24 * 60 * 60
+# The number of bytes an export job buffers before pausing the export until
+# they've been written out.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class ChunkedGzipWriter(object):
+    """
+    File-like object that writes data to a series of gzip files.
+
+    A new file is started once the current one holds `chunk_size` bytes of
+    uncompressed data. Files are only split between writes, and formatters
+    only write whole rows, so no row is split across files. Concatenating
+    the files in order gives the whole export.
+
+    Writes are blocking, so :class:`ExportJob` only calls them from a thread.
+
+    :param str path:
+        The directory to write the files to.
+    :param str file_template:
+        Template for the file names, which is given the file's index.
+    :param int chunk_size:
+        The number of uncompressed bytes to write to each file.
+    :param int compress_level:
+        The gzip compression level.
+    """
+
+    def __init__(self, path, file_template, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.path = path
+        self.file_template = file_template
+        self.chunk_size = chunk_size
+        self.compress_level = compress_level
+        self.filenames = []
+        self._file = None
+        self._file_size = 0
+
+    def write(self, data):
+        if self._file is None:
+            filename = self.file_template % (len(self.filenames),)
+            self._file = gzip.GzipFile(
+                os.path.join(self.path, filename), 'wb', self.compress_level)
+            self._file_size = 0
+            self.filenames.append(filename)
+        self._file.write(data)
+        self._file_size += len(data)
+        if self._file_size >= self.chunk_size:
+            self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ExportJob(object):
+    """
+    An export that writes to local files instead of an HTTP response.
+
+    The job stands in for the request that a
+    :class:`MessageExportProxyResource` would otherwise write to, so exports
+    run as jobs use the same index iteration and formatters as exports over
+    HTTP.
+
+    Compressing and writing the files happens in a thread, so that it doesn't
+    hold up the reactor. Written data is buffered until the previous write is
+    done, and the job's producer is paused while more than
+    :data:`WRITE_BUFFER_SIZE` bytes are waiting, the same way a transport
+    pauses an export whose client isn't keeping up.
+
+    :param str job_id:
+        The job's identifier, which is also the name of its directory.
+    :param str export_name:
+        The name of the export in :attr:`BatchResource.RESOURCES`.
+    :param dict args:
+        The export parameters, as they'd be found in ``request.args``.
+    :param export_resource:
+        The :class:`MessageExportProxyResource` to run the export with.
+    :param str path:
+        The directory to write the export files to.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, job_id, export_name, args, export_resource, path,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.job_id = job_id
+        self.batch_id = export_resource.batch_id
+        self.export_name = export_name
+        self.args = args
+        self.export_resource = export_resource
+        self.path = path
+        self.status = self.QUEUED
+        self.error = None
+        self.bytes_written = 0
+        self.export_rows = 0
+        self.export_producer = ExportProducer()
+        self.connection_has_been_closed = False
+        self.writer = ChunkedGzipWriter(
+            path, self._file_template(export_name), chunk_size,
+            compress_level)
+        self._export_params = export_resource.parse_export_args(self)
+        self._finished = []
+        self._buffer = []
+        self._buffer_size = 0
+        self._writing = None
+        self._write_failure = None
+        self._stopped = False
+
+    def _file_template(self, export_name):
+        name, _, extension = export_name.partition('.')
+        return '%s-%%05d.%s.gz' % (name, extension)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= WRITE_BUFFER_SIZE:
+            self.export_producer.pauseProducing()
+        if self._writing is None:
+            self._writing = self._write_buffer()
+
+    @inlineCallbacks
+    def _write_buffer(self):
+        while self._buffer and self._write_failure is None:
+            data = ''.join(self._buffer)
+            self._buffer, self._buffer_size = [], 0
+            try:
+                yield deferToThread(self.writer.write, data)
+            except Exception:
+                # Stop the export, the same way a closed connection would.
+                self._write_failure = Failure()
+                self.connection_has_been_closed = True
+            else:
+                self.bytes_written += len(data)
+            self.export_producer.resumeProducing()
+        self._writing = None
+
+    @inlineCallbacks
+    def _close_writer(self):
+        """
+        Wait for any buffered data to be written and close the last file.
+        """
+        if self._writing is not None:
+            yield self._writing
+        yield deferToThread(self.writer.close)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def finish(self):
+        # The files are closed in run() once all the data has been written.
+        pass
+
+    def notify_finished(self):
+        """
+        Return a Deferred that fires with the job once it's done or has
+        failed.
+        """
+        if self.status in (self.DONE, self.FAILED):
+            return succeed(self)
+        d = Deferred()
+        self._finished.append(d)
+        return d
+
+    @inlineCallbacks
+    def run(self):
+        """
+        Run the export, recording the error if it fails. A job that was
+        stopped before it finished is marked as failed.
+        """
+        self.status = self.RUNNING
+        try:
+            if not self._stopped:
+                yield self._run_export()
+            if self._stopped:
+                self.status = self.FAILED
+                self.error = "Export job was stopped."
+            else:
+                self.status = self.DONE
+        except Exception as e:
+            log.err(None, "Export job %s failed" % (self.job_id,))
+            self.connection_has_been_closed = True
+            self.status = self.FAILED
+            self.error = str(e)
+        finished, self._finished = self._finished, []
+        for d in finished:
+            d.callback(self)
+
+    @inlineCallbacks
+    def _run_export(self):
+        yield deferToThread(os.makedirs, self.path)
+        start, end, cursor, shards = self._export_params
+        try:
+            yield self.export_resource.start_export(
+                self, start, end, cursor, shards)
+        finally:
+            yield self._close_writer()
+        if self._write_failure is not None:
+            self._write_failure.raiseException()
+
+    def stop(self):
+        """
+        Stop the export if the job hasn't finished, the same way a closed
+        connection stops an export over HTTP.
+
+        :returns:
+            A Deferred that fires with the job once it has finished.
+        """
+        if self.status not in (self.DONE, self.FAILED):
+            self._stopped = True
+            self.connection_has_been_closed = True
+            self.export_producer.stopProducing()
+        return self.notify_finished()
+
+    def get_status(self):
+        return {
+            'job_id': self.job_id,
+            'batch_id': self.batch_id,
+            'export': self.export_name,
+            'status': self.status,
+            'error': self.error,
+            'messages_exported': self.export_rows,
+            'bytes_written': self.bytes_written,
+            'files': list(self.writer.filenames),
+        }
+
+
+class ExportJobScheduler(object):
+    """
+    Worker-wide scheduler for export jobs, which runs no more than
+    `max_concurrent_jobs` of them at once and queues the rest.
+
+    Each job writes its files to a directory named after the job under
+    `export_dir`. Jobs are only tracked in memory, so they're lost if the
+    worker restarts. Finished jobs are forgotten after `job_expiry` seconds,
+    and their directories are deleted.
+
+    :param str export_dir:
+        The local directory to write export files to.
+    :param int max_concurrent_jobs:
+        The maximum number of jobs to run at once.
+    :param int chunk_size:
+        The number of uncompressed bytes to write to each export file.
+    :param int job_expiry:
+        The number of seconds to keep finished jobs for.
+    :param clock:
+        The reactor to schedule job expiry with.
+    """
+
+    def __init__(self, export_dir,
+                 max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 compress_level=DEFAULT_COMPRESS_LEVEL,
+                 job_expiry=DEFAULT_JOB_EXPIRY, clock=reactor):
+        self.export_dir = export_dir
+        self.chunk_size = chunk_size
+        self.compress_level = compress_level
+        self.job_expiry = job_expiry
+        self.clock = clock
+        self.jobs = {}
+        self._limiter = DeferredSemaphore(max_concurrent_jobs)
+        self._expiry_calls = {}
+        self._removals = set()
+        self._stopped = False
+
+    def create_job(self, export_resource, export_name, args):
+        """
+        Create a job for an export.
+
+        :raises ParameterError:
+            If any of the export parameters are invalid.
+        """
+        job_id = uuid4().hex
+        return ExportJob(
+            job_id, export_name, args, export_resource,
+            os.path.join(self.export_dir, job_id), chunk_size=self.chunk_size,
+            compress_level=self.compress_level)
+
+    def submit(self, job):
+        """
+        Queue a job to be run once there's room for it.
+
+        :returns:
+            A Deferred that fires once the job is done or has failed.
+        """
+        self.jobs[job.job_id] = job
+        d = self._limiter.run(job.run)
+        d.addCallback(lambda _: self._schedule_expiry(job))
+        return d
+
+    def _schedule_expiry(self, job):
+        if self._stopped:
+            return
+        self._expiry_calls[job.job_id] = self.clock.callLater(
+            self.job_expiry, self._expire_job, job.job_id)
+
+    def _expire_job(self, job_id):
+        del self._expiry_calls[job_id]
+        job = self.jobs.pop(job_id)
+        d = deferToThread(_remove_dir, job.path)
+        d.addErrback(
+            log.err, "Failed to delete the files for export job %s" % (
+                job_id,))
+        self._removals.add(d)
+        d.addBoth(lambda _: self._removals.discard(d))
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def stop(self):
+        """
+        Cancel any pending job expiries and stop any jobs that haven't
+        finished.
+
+        :returns:
+            A Deferred that fires once all the jobs have finished and any
+            expired jobs' files have been deleted.
+        """
+        self._stopped = True
+        expiry_calls, self._expiry_calls = self._expiry_calls, {}
+        for call in expiry_calls.values():
+            call.cancel()
+        return gatherResults(
+            [job.stop() for job in self.jobs.values()] +
+            list(self._removals))
+
+
+def _remove_dir(path):
+    """
+    Delete a directory and everything in it, if it exists.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
@@ -1,14 +1,85 @@
 """ HTTP API for exporting messages as CSV/JSON """
 
+import json
+import re
+from datetime import datetime, timedelta
+
 import iso8601
 
-from twisted.internet.defer import DeferredList, inlineCallbacks
+from twisted.internet.defer import (
+    Deferred, DeferredQueue, DeferredSemaphore, inlineCallbacks,
+    returnValue, succeed)
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.web.resource import NoResource, Resource
 from twisted.web.server import NOT_DONE_YET
+from zope.interface import implementer
 
 from vumi_message_store.api.message_export_formatters import (
-    JsonFormatter, CsvFormatter)
-from vumi.message import format_vumi_date
+    ColumnarJsonFormatter, CsvFormatter, EventCsvFormatter, GzipFormatter,
+    MessageStatusCsvFormatter, MessageStatusJsonFormatter, RawJsonFormatter)
+from vumi_message_store.batch_info_cache import time_shard_ranges
+from vumi_message_store.utils import bounded_map, gather_results
+from vumi.message import VUMI_DATE_FORMAT, format_vumi_date
+from vumi.persist.model import VumiRiakError
+
+# The default maximum number of messages to fetch at once for each export.
+DEFAULT_CONCURRENCY = 10
+# The default maximum number of messages to hold back for ordered exports.
+DEFAULT_REORDER_BUFFER_SIZE = 100
+# The maximum number of time shards a single export may be split into.
+MAX_EXPORT_SHARDS = 16
+# Message fields that message exports can be filtered on.
+MESSAGE_FILTER_FIELDS = ('session_event', 'group')
+# Cursors are Riak continuations, which are base64-encoded.
+CURSOR_RE = re.compile(r'^(?=.)(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|'
+                       r'[A-Za-z0-9+/]{3}=)?\Z')
+
+
+def export_shard_ranges(start, end, shards):
+    """
+    Split the time range from `start` to `end` into up to `shards` contiguous
+    ranges of roughly equal length, newest first to match the index order.
+
+    Index timestamps only have a resolution of one second, so ranges are
+    split on whole seconds and a short time range may be split into fewer
+    ranges than asked for.
+    """
+    start_dt = datetime.strptime(start, VUMI_DATE_FORMAT)
+    end_dt = datetime.strptime(end, VUMI_DATE_FORMAT)
+    step = (end_dt - start_dt) / shards
+    boundaries = [start_dt + step * i for i in xrange(1, shards)]
+    boundaries = [
+        boundary for boundary in boundaries
+        if boundary.replace(microsecond=0) - timedelta(seconds=1) >= start_dt]
+    ranges = time_shard_ranges(boundaries)
+    ranges[0] = (start, ranges[0][1])
+    ranges[-1] = (ranges[-1][0], end)
+    return list(reversed(ranges))
+
+
+def accepts_gzip(request):
+    """
+    Return ``True`` if the request's ``Accept-Encoding`` header allows a gzip
+    response.
+    """
+    if request is None:
+        return False
+    for header in request.requestHeaders.getRawHeaders('Accept-Encoding', []):
+        for coding in header.split(','):
+            params = coding.split(';')
+            if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
 
 
 class ParameterError(Exception):
@@ -17,15 +88,154 @@ class ParameterError(Exception):
     """
 
 
+@implementer(IPushProducer)
+class ExportProducer(object):
+    """
+    Push producer that is registered with an export request so that the
+    transport can tell us to stop fetching messages while the client isn't
+    reading them fast enough.
+    """
+
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+        self._waiters = []
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._wake_waiters()
+
+    def stopProducing(self):
+        self.stopped = True
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def wait_for_resume(self):
+        """
+        Return a Deferred that fires once we're allowed to produce data, which
+        is immediately unless we've been paused. It also fires if we're
+        stopped, so callers should check :attr:`stopped` afterwards.
+        """
+        if not self.paused or self.stopped:
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+
+class ReorderBuffer(object):
+    """
+    Buffer that accepts numbered results in any order and writes them out in
+    order.
+
+    Results that arrive before the ones ahead of them are held back, but no
+    more than `size` results are held. Callers must wait for
+    :meth:`wait_for_room` before producing a result so that a single slow
+    result can't make the buffer grow without bound.
+
+    :param write:
+        Callable that writes a single result.
+    :param int size:
+        The maximum number of results to hold back.
+    """
+
+    def __init__(self, write, size):
+        self._write = write
+        self.size = size
+        self._next_index = 0
+        self._results = {}
+        self._waiters = []
+
+    def wait_for_room(self, index):
+        """
+        Return a Deferred that fires once the result with the given index can
+        be added without holding back more than :attr:`size` results.
+        """
+        if index < self._next_index + self.size:
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append((index, d))
+        return d
+
+    def add(self, index, result):
+        """
+        Add a result and write it along with any results held back behind it.
+        """
+        self._results[index] = result
+        while self._next_index in self._results:
+            self._write(self._results.pop(self._next_index))
+            self._next_index += 1
+
+        waiters, self._waiters = self._waiters, []
+        for index, d in waiters:
+            if index < self._next_index + self.size:
+                d.callback(None)
+            else:
+                self._waiters.append((index, d))
+
+
 class MessageExportProxyResource(Resource):
+    """
+    Resource that exports messages from a batch.
+
+    Messages are written as they are fetched, unless the ``ordered`` parameter
+    is ``true``. In that case, they're written in the same descending
+    timestamp order as the index, using a :class:`ReorderBuffer` so that
+    messages can still be fetched concurrently.
+
+    If the ``shards`` parameter is greater than one, the time range given by
+    ``start`` and ``end`` (which are both required) is split into that many
+    shards, which are scanned and fetched concurrently. Each shard fetches at
+    most one page of messages ahead of the one being written, and the shards
+    are written out one after the other in descending timestamp order.
+
+    The ``fields`` parameter takes a comma-separated list of the message
+    fields to export. Exports that support filtering accept one or more
+    ``addr`` parameters to only export messages to or from those addresses,
+    which are matched against the index so that other messages are never
+    fetched, and ``session_event`` and ``group`` parameters to only export
+    messages with those values, which are matched once the messages are
+    fetched. An empty filter value matches messages without that field.
+
+    If the ``with_cursors`` parameter is ``true``, a cursor is written after
+    each index page except the last. An interrupted export can be resumed by
+    repeating the request with the last cursor received as the ``cursor``
+    parameter, after discarding anything written after that cursor. Resumed
+    exports don't repeat the row header, so the output can be appended to
+    what was received before.
+
+    :param int concurrency:
+        The maximum number of messages to fetch at once for this export.
+    :param fetch_limiter:
+        An optional :class:`DeferredSemaphore` shared between exports that
+        limits the number of messages fetched at once across all of them.
+    :param int reorder_buffer_size:
+        The maximum number of messages to hold back for ordered exports.
+    """
 
     isLeaf = True
 
-    def __init__(self, message_store, batch_id, formatter):
+    # Whether this export's index values are addresses, and its messages
+    # have the fields in MESSAGE_FILTER_FIELDS, so that it can be filtered.
+    FILTERABLE = False
+
+    def __init__(self, message_store, batch_id, formatter,
+                 concurrency=DEFAULT_CONCURRENCY, fetch_limiter=None,
+                 reorder_buffer_size=DEFAULT_REORDER_BUFFER_SIZE):
         Resource.__init__(self)
         self.message_store = message_store
         self.batch_id = batch_id
         self.formatter = formatter
+        self.concurrency = concurrency
+        self.fetch_limiter = fetch_limiter
+        self.reorder_buffer_size = reorder_buffer_size
 
     def _extract_arg(self, request, argname):
         if argname not in request.args:
@@ -46,29 +256,175 @@ class MessageExportProxyResource(Resource):
             raise ParameterError(
                 "Invalid '%s' parameter: %s" % (argname, str(e)))
 
+    def _extract_list_arg(self, request, argname):
+        arg = self._extract_arg(request, argname)
+        if arg is None:
+            return None
+        values = [value.strip() for value in arg.split(',') if value.strip()]
+        if not values:
+            raise ParameterError(
+                "Invalid '%s' parameter: At least one value required" % (
+                    argname,))
+        return values
+
+    def _extract_filter_args(self, request):
+        """
+        Extract the ``addr`` parameters as a set of addresses (or ``None``)
+        and the message field filters as a dict.
+        """
+        filter_args = ('addr',) + MESSAGE_FILTER_FIELDS
+        if not self.FILTERABLE:
+            for argname in filter_args:
+                if argname in request.args:
+                    raise ParameterError(
+                        "Invalid '%s' parameter: Not supported for this "
+                        "export" % (argname,))
+            return None, {}
+
+        addrs = None
+        if 'addr' in request.args:
+            addrs = set(addr.decode('utf-8') for addr in request.args['addr'])
+        filters = {}
+        for field in MESSAGE_FILTER_FIELDS:
+            value = self._extract_arg(request, field)
+            if value is not None:
+                filters[field] = value.decode('utf-8')
+        return addrs, filters
+
+    def _extract_int_arg(self, request, argname, default, minimum, maximum):
+        arg = self._extract_arg(request, argname)
+        if arg is None:
+            return default
+        try:
+            value = int(arg)
+        except ValueError:
+            value = None
+        if value is None or not (minimum <= value <= maximum):
+            raise ParameterError(
+                "Invalid '%s' parameter: Must be an integer from %d to %d" % (
+                    argname, minimum, maximum))
+        return value
+
+    def _extract_cursor_arg(self, request, argname):
+        arg = self._extract_arg(request, argname)
+        if arg is not None and CURSOR_RE.match(arg) is None:
+            raise ParameterError(
+                "Invalid '%s' parameter: Not a valid cursor" % (argname,))
+        return arg
+
+    def _extract_bool_arg(self, request, argname):
+        arg = self._extract_arg(request, argname)
+        if arg is None:
+            return False
+        if arg not in ('true', 'false'):
+            raise ParameterError(
+                "Invalid '%s' parameter: Must be 'true' or 'false'" % (
+                    argname,))
+        return arg == 'true'
+
+    def parse_export_args(self, request):
+        """
+        Parse the export parameters from the request's arguments, storing the
+        export options on the request and selecting the formatter's fields.
+
+        :returns:
+            A ``(start, end, cursor, shards)`` tuple.
+        :raises ParameterError:
+            If any of the parameters are invalid.
+        """
+        start = self._extract_date_arg(request, 'start')
+        end = self._extract_date_arg(request, 'end')
+        request.export_ordered = self._extract_bool_arg(request, 'ordered')
+        request.export_with_cursors = self._extract_bool_arg(
+            request, 'with_cursors')
+        cursor = self._extract_cursor_arg(request, 'cursor')
+        shards = self._extract_int_arg(
+            request, 'shards', 1, 1, MAX_EXPORT_SHARDS)
+        if shards > 1:
+            self._check_shardable(request, start, end, cursor)
+        request.export_addrs, request.export_filters = (
+            self._extract_filter_args(request))
+        fields = self._extract_list_arg(request, 'fields')
+        if fields is not None:
+            try:
+                self.formatter.select_fields(fields)
+            except ValueError as e:
+                raise ParameterError(
+                    "Invalid 'fields' parameter: %s" % (str(e),))
+        return start, end, cursor, shards
+
     def render_GET(self, request):
         try:
-            start = self._extract_date_arg(request, 'start')
-            end = self._extract_date_arg(request, 'end')
+            start, end, cursor, shards = self.parse_export_args(request)
         except ParameterError as e:
             request.setResponseCode(400)
             return str(e)
 
         self.formatter.add_http_headers(request)
-        self.formatter.write_row_header(request)
 
-        d = self.get_keys_page(self.message_store, self.batch_id, start, end)
+        # The transport pauses the producer when its write buffer is full, so
+        # that we stop fetching messages until the client catches up.
+        request.export_producer = ExportProducer()
+        request.registerProducer(request.export_producer, True)
 
         request.connection_has_been_closed = False
         request.notifyFinish().addBoth(
             lambda _: setattr(request, 'connection_has_been_closed', True))
-        d.addCallback(self.fetch_pages, request)
+
+        d = self.start_export(request, start, end, cursor, shards)
+        d.addErrback(self.export_failed_cb, request)
         return NOT_DONE_YET
 
-    def get_keys_page(self, message_store, batch_id, start, end):
+    def start_export(self, request, start, end, cursor, shards):
+        """
+        Write the row header (unless we're resuming from a cursor) and start
+        fetching and writing messages.
+
+        The request must already have the export options from
+        :meth:`parse_export_args` along with an ``export_producer`` and a
+        ``connection_has_been_closed`` flag.
+
+        :returns:
+            A Deferred that fires once the export has finished or stopped.
+        """
+        request.export_rows = 0
+        if cursor is None:
+            self.formatter.write_row_header(request)
+
+        if shards > 1:
+            return self.fetch_shards(
+                export_shard_ranges(start, end, shards), request)
+
+        d = self.get_keys_page(
+            self.message_store, self.batch_id, start, end, cursor)
+        if cursor is not None:
+            d.addErrback(self.check_cursor_eb)
+        d.addCallback(self.fetch_pages, request)
+        return d
+
+    def _check_shardable(self, request, start, end, cursor):
+        if start is None or end is None:
+            raise ParameterError(
+                "Invalid 'shards' parameter: 'start' and 'end' are required")
+        if cursor is not None or request.export_with_cursors:
+            raise ParameterError(
+                "Invalid 'shards' parameter: Sharded exports can't be resumed")
+
+    def check_cursor_eb(self, failure):
+        """
+        Turn Riak rejecting the continuation we resumed from into a
+        :class:`ParameterError`, since the cursor came from the client.
+        """
+        failure.trap(VumiRiakError)
+        raise ParameterError(
+            "Invalid 'cursor' parameter: %s" % (failure.getErrorMessage(),))
+
+    def get_keys_page(self, message_store, batch_id, start, end,
+                      continuation=None):
         """
         Query the message store for the relevant messages and return a
-        paginated response.
+        paginated response, starting from the given continuation if there is
+        one.
         """
         raise NotImplementedError('To be implemented by sub-class.')
 
@@ -85,6 +441,42 @@ class MessageExportProxyResource(Resource):
         """
         raise NotImplementedError('To be implemented by sub-class.')
 
+    def get_message_json(self, message_store, message_key):
+        """
+        Fetch the message from the message store as a JSON string using the
+        message key. This is used instead of :meth:`get_message` if the
+        formatter accepts raw JSON.
+        """
+        raise NotImplementedError('To be implemented by sub-class.')
+
+    def select_message_keys(self, keys_page, request):
+        """
+        Get the list of message keys from a keys page, leaving out any that
+        don't match the request's address filter.
+        """
+        if request.export_addrs is None:
+            return self.get_message_keys(keys_page)
+        return [
+            key for key, _, addr in keys_page if addr in request.export_addrs]
+
+    def get_message_payload(self, message):
+        """
+        Get the payload of a fetched message as a dict.
+        """
+        if self.formatter.raw_json:
+            return json.loads(message)
+        return message.payload
+
+    def message_matches(self, message, request):
+        """
+        Check a fetched message against the request's message field filters.
+        """
+        payload = self.get_message_payload(message)
+        for field, value in request.export_filters.iteritems():
+            if (payload.get(field) or u'') != value:
+                return False
+        return True
+
     def fetch_pages(self, keys_page, request):
         """
         Process a page of keys and each subsequent page.
@@ -100,6 +492,10 @@ class MessageExportProxyResource(Resource):
             # We're no longer connected, so stop doing work.
             return
         d = self.fetch_page(keys_page, request)
+        if keys_page.has_next_page() and request.export_with_cursors:
+            d.addCallback(
+                self.write_cursor_cb, keys_page.continuation, request)
+        d.addCallback(self.flush_formatter_cb, request)
         if keys_page.has_next_page():
             # We fetch the next page before waiting for the current page to be
             # processed.
@@ -113,35 +509,249 @@ class MessageExportProxyResource(Resource):
             d.addCallback(self.finish_request_cb, request)
         return d
 
+    @inlineCallbacks
+    def fetch_shards(self, shard_ranges, request):
+        """
+        Scan all the shards concurrently and write out each shard's pages in
+        turn. The shards share a limit of :attr:`concurrency` messages being
+        fetched at once, the same as an unsharded export.
+
+        If a shard fails or the connection is closed, the remaining scans are
+        stopped, since they'd otherwise wait forever for slots that will
+        never be released.
+        """
+        request.export_shards_stopped = False
+        request.export_shard_fetches = DeferredSemaphore(self.concurrency)
+        shards = [
+            self.scan_shard(start, end, request)
+            for start, end in shard_ranges]
+        try:
+            for pages, slots in shards:
+                while True:
+                    messages = yield pages.get()
+                    slots.release()
+                    if isinstance(messages, Failure):
+                        messages.raiseException()
+                    if messages is None or request.connection_has_been_closed:
+                        break
+                    for message in messages:
+                        self.write_message_if_connected(message, request)
+                    self.flush_formatter_cb(None, request)
+                if request.connection_has_been_closed:
+                    return
+        finally:
+            self.stop_shard_scans(shards, request)
+        self.finish_request_cb(None, request)
+
+    def stop_shard_scans(self, shards, request):
+        """
+        Stop any shard scans that are still running, cancelling their waits
+        for slots.
+        """
+        request.export_shards_stopped = True
+        for pages, slots in shards:
+            for d in list(slots.waiting):
+                d.cancel()
+
+    def scan_shard(self, start, end, request):
+        """
+        Start fetching a shard's messages a page at a time.
+
+        :returns:
+            A ``(pages, slots)`` tuple. Lists of fetched messages are put in
+            the `pages` queue, followed by ``None`` once the shard is done.
+            The consumer must release a `slots` token for each page it takes,
+            which lets the scan fetch another page.
+        """
+        pages = DeferredQueue()
+        slots = DeferredSemaphore(1)
+        d = self._scan_shard(start, end, pages, slots, request)
+        # Hand any failure to the consumer rather than leaving it waiting.
+        d.addErrback(pages.put)
+        return pages, slots
+
+    @inlineCallbacks
+    def _scan_shard(self, start, end, pages, slots, request):
+        keys_page = yield self.get_keys_page(
+            self.message_store, self.batch_id, start, end)
+        while keys_page is not None:
+            if request.export_shards_stopped:
+                return
+            next_page_d = None
+            if keys_page.has_next_page():
+                next_page_d = keys_page.next_page()
+            try:
+                carry_on = yield self._scan_shard_page(
+                    keys_page, pages, slots, request)
+            except Exception:
+                self._abandon_page(next_page_d)
+                raise
+            if not carry_on:
+                self._abandon_page(next_page_d)
+                return
+            keys_page = yield next_page_d
+        if request.export_shards_stopped:
+            return
+        yield slots.acquire()
+        pages.put(None)
+
+    @inlineCallbacks
+    def _scan_shard_page(self, keys_page, pages, slots, request):
+        """
+        Fetch a shard's page of messages and put them in the `pages` queue
+        once a slot is free.
+
+        :returns:
+            A Deferred that fires with ``False`` if the scan should stop, and
+            ``True`` otherwise.
+        """
+        fetches = request.export_shard_fetches
+        messages = yield bounded_map(
+            lambda key: fetches.run(self.fetch_message, key, request),
+            self.select_message_keys(keys_page, request),
+            self.concurrency)
+        if request.export_shards_stopped:
+            returnValue(False)
+        yield slots.acquire()
+        pages.put([m for m in messages if m is not None])
+        returnValue(not request.connection_has_been_closed)
+
+    def _abandon_page(self, page_d):
+        """
+        Stop waiting for a page of keys we no longer need, so that it failing
+        isn't reported as an unhandled error.
+        """
+        if page_d is not None:
+            page_d.addErrback(lambda _: None)
+
+    def write_cursor_cb(self, _result, cursor, request):
+        if not request.connection_has_been_closed:
+            self.formatter.write_cursor(request, cursor)
+
+    def flush_formatter_cb(self, _result, request):
+        if not request.connection_has_been_closed:
+            self.formatter.flush(request)
+
+    def export_failed_cb(self, failure, request):
+        """
+        Log a failed export and end the request.
+
+        If the response hasn't been started, we send an error response, which
+        is a 400 if the export failed because of a bad parameter and a 500
+        otherwise. Otherwise, we write out any buffered rows and close the
+        connection without finishing the response, so that the client can
+        tell that the export is incomplete.
+        """
+        if failure.check(ParameterError) is None:
+            log.err(failure, "Export from batch %r failed" % (self.batch_id,))
+        if request.connection_has_been_closed:
+            return
+        request.unregisterProducer()
+        if not request.startedWriting:
+            if failure.check(ParameterError) is not None:
+                request.setResponseCode(400)
+                body = failure.getErrorMessage()
+            else:
+                request.setResponseCode(500)
+                body = 'Export failed'
+            request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+            request.responseHeaders.removeHeader('Content-Encoding')
+            request.write(body)
+            request.finish()
+            return
+        self.formatter.flush(request)
+        request.loseConnection()
+
     def finish_request_cb(self, _result, request):
         if not request.connection_has_been_closed:
             # We need to check for this here in case we lose the connection
             # while delivering the last page.
+            self.formatter.write_row_footer(request)
+            request.unregisterProducer()
             return request.finish()
 
     @inlineCallbacks
     def fetch_page(self, keys_page, request):
         """
-        Process a page of keys in chunks of concurrently-fetched messages.
+        Process a page of keys, fetching no more than :attr:`concurrency`
+        messages at once.
+        """
+        message_keys = self.select_message_keys(keys_page, request)
+        if not request.export_ordered:
+            yield bounded_map(
+                lambda key: self.handle_message(key, request), message_keys,
+                self.concurrency)
+            return
+
+        reorder_buffer = ReorderBuffer(
+            lambda message: self.write_message_if_connected(message, request),
+            self.reorder_buffer_size)
+
+        def handle_ordered_message(indexed_key):
+            index, key = indexed_key
+            return self.handle_ordered_message(
+                index, key, reorder_buffer, request)
+
+        yield bounded_map(
+            handle_ordered_message, enumerate(message_keys), self.concurrency)
+
+    @inlineCallbacks
+    def fetch_message(self, message_key, request):
+        """
+        Fetch a message, waiting until the request's producer isn't paused
+        before fetching it. If the connection has been closed, the message
+        isn't fetched and ``None`` is returned. ``None`` is also returned if
+        the message doesn't match the request's message field filters.
+
+        If the message can't be fetched, the failure is passed on so that the
+        export fails instead of finishing with the message missing.
         """
-        message_keys = self.get_message_keys(keys_page)
-        yield DeferredList([
-            self.handle_message(key, request) for key in message_keys])
+        yield request.export_producer.wait_for_resume()
+        if request.connection_has_been_closed:
+            returnValue(None)
+        if self.formatter.raw_json:
+            get_message = self.get_message_json
+        else:
+            get_message = self.get_message
+        if self.fetch_limiter is not None:
+            message = yield self.fetch_limiter.run(
+                get_message, self.message_store, message_key)
+        else:
+            message = yield get_message(self.message_store, message_key)
+        if (message is not None and request.export_filters and
+                not self.message_matches(message, request)):
+            returnValue(None)
+        returnValue(message)
 
+    @inlineCallbacks
     def handle_message(self, message_key, request):
-        d = self.get_message(self.message_store, message_key)
-        d.addCallback(self.write_message, request)
-        return d
+        message = yield self.fetch_message(message_key, request)
+        self.write_message_if_connected(message, request)
+
+    @inlineCallbacks
+    def handle_ordered_message(self, index, message_key, reorder_buffer,
+                               request):
+        yield reorder_buffer.wait_for_room(index)
+        message = yield self.fetch_message(message_key, request)
+        reorder_buffer.add(index, message)
+
+    def write_message_if_connected(self, message, request):
+        if message is not None and not request.connection_has_been_closed:
+            self.write_message(message, request)
 
     def write_message(self, message, request):
         self.formatter.write_row(request, message)
+        request.export_rows += 1
 
 
 class InboundResource(MessageExportProxyResource):
 
-    def get_keys_page(self, message_store, batch_id, start, end):
+    FILTERABLE = True
+
+    def get_keys_page(self, message_store, batch_id, start, end,
+                      continuation=None):
         return message_store.list_batch_inbound_messages(
-            batch_id, start=start, end=end)
+            batch_id, start=start, end=end, continuation=continuation)
 
     def get_message_keys(self, keys_page):
         return [key for key, _, _ in keys_page]
@@ -149,12 +759,18 @@ class InboundResource(MessageExportProxyResource):
     def get_message(self, message_store, message_key):
         return message_store.get_inbound_message(message_key)
 
+    def get_message_json(self, message_store, message_key):
+        return message_store.get_inbound_message_json(message_key)
+
 
 class OutboundResource(MessageExportProxyResource):
 
-    def get_keys_page(self, message_store, batch_id, start, end):
+    FILTERABLE = True
+
+    def get_keys_page(self, message_store, batch_id, start, end,
+                      continuation=None):
         return message_store.list_batch_outbound_messages(
-            batch_id, start=start, end=end)
+            batch_id, start=start, end=end, continuation=continuation)
 
     def get_message_keys(self, keys_page):
         return [key for key, _, _ in keys_page]
@@ -162,34 +778,266 @@ class OutboundResource(MessageExportProxyResource):
     def get_message(self, message_store, message_key):
         return message_store.get_outbound_message(message_key)
 
+    def get_message_json(self, message_store, message_key):
+        return message_store.get_outbound_message_json(message_key)
+
+
+class EventResource(MessageExportProxyResource):
+
+    def get_keys_page(self, message_store, batch_id, start, end,
+                      continuation=None):
+        return message_store.list_batch_events(
+            batch_id, start=start, end=end, continuation=continuation)
+
+    def get_message_keys(self, keys_page):
+        return [key for key, _, _ in keys_page]
+
+    def get_message(self, message_store, message_key):
+        return message_store.get_event(message_key)
+
+    def get_message_json(self, message_store, message_key):
+        return message_store.get_event_json(message_key)
+
+
+class OutboundStatusResource(OutboundResource):
+    """
+    Resource that exports outbound messages from a batch along with the
+    status from each message's latest event.
+
+    Each message is fetched along with its event index entries, which carry
+    the event timestamps and statuses, so no events need to be loaded. This
+    is still an extra index query for every message, which is counted as
+    part of the message's fetch. The rows handed to the formatter are
+    ``(message, status_timestamp, status)`` tuples, with ``None`` for the
+    status fields if there are no events.
+    """
+
+    @inlineCallbacks
+    def get_message(self, message_store, message_key):
+        message, (status_timestamp, status) = yield gather_results([
+            message_store.get_outbound_message(message_key),
+            self.get_latest_status(message_store, message_key),
+        ])
+        if message is None:
+            returnValue(None)
+        returnValue((message, status_timestamp, status))
+
+    @inlineCallbacks
+    def get_message_json(self, message_store, message_key):
+        message_json, (status_timestamp, status) = yield gather_results([
+            message_store.get_outbound_message_json(message_key),
+            self.get_latest_status(message_store, message_key),
+        ])
+        if message_json is None:
+            returnValue(None)
+        returnValue((message_json, status_timestamp, status))
+
+    def get_message_payload(self, row):
+        message, _, _ = row
+        return super(OutboundStatusResource, self).get_message_payload(
+            message)
+
+    @inlineCallbacks
+    def get_latest_status(self, message_store, message_key):
+        """
+        Find the timestamp and status of the latest event for a message.
+
+        Events are listed in ascending timestamp order, so this is the last
+        entry in the message's event index.
+
+        This makes a ``list_message_events`` query for each message, and more
+        than one if the message has more than a page of events. It's called
+        from :meth:`get_message` and :meth:`get_message_json`, which
+        :meth:`fetch_message` runs under the :attr:`fetch_limiter`, so the
+        queries are limited along with the message fetches. Each slot covers
+        both the message fetch and its status query.
+        """
+        latest = (None, None)
+        events_page = yield message_store.list_message_events(message_key)
+        while events_page is not None:
+            for _, timestamp, status in events_page:
+                latest = (timestamp, status)
+            if not events_page.has_next_page():
+                break
+            events_page = yield events_page.next_page()
+        returnValue(latest)
+
 
 class BatchResource(Resource):
+    """
+    Resource that serves the exports for a batch.
+
+    Each export is also available gzipped by adding ``.gz`` to its name, and
+    exports are compressed with ``Content-Encoding: gzip`` if the client's
+    ``Accept-Encoding`` header allows it.
+
+    If there's a job scheduler, exports can also be run as jobs that write to
+    local files under ``jobs/``. See :class:`ExportJobsResource`.
+    """
 
     RESOURCES = {
-        'inbound.json': (InboundResource, JsonFormatter),
-        'outbound.json': (OutboundResource, JsonFormatter),
+        'inbound.json': (InboundResource, RawJsonFormatter),
+        'outbound.json': (OutboundResource, RawJsonFormatter),
         'inbound.csv': (InboundResource, CsvFormatter),
         'outbound.csv': (OutboundResource, CsvFormatter),
+        'inbound.columns.json': (InboundResource, ColumnarJsonFormatter),
+        'outbound.columns.json': (OutboundResource, ColumnarJsonFormatter),
+        'events.json': (EventResource, RawJsonFormatter),
+        'events.csv': (EventResource, EventCsvFormatter),
+        'outbound_status.json': (
+            OutboundStatusResource, MessageStatusJsonFormatter),
+        'outbound_status.csv': (
+            OutboundStatusResource, MessageStatusCsvFormatter),
     }
 
-    def __init__(self, message_store, batch_id):
+    def __init__(self, message_store, batch_id,
+                 concurrency=DEFAULT_CONCURRENCY, fetch_limiter=None,
+                 reorder_buffer_size=DEFAULT_REORDER_BUFFER_SIZE,
+                 job_scheduler=None):
         Resource.__init__(self)
         self.message_store = message_store
         self.batch_id = batch_id
+        self.concurrency = concurrency
+        self.fetch_limiter = fetch_limiter
+        self.reorder_buffer_size = reorder_buffer_size
+        self.job_scheduler = job_scheduler
 
     def getChild(self, path, request):
+        if path == 'jobs':
+            if self.job_scheduler is None:
+                return NoResource()
+            return ExportJobsResource(self, self.job_scheduler)
+        gzip_file = path.endswith('.gz')
+        if gzip_file:
+            path = path[:-len('.gz')]
         if path not in self.RESOURCES:
             return NoResource()
         resource_class, message_formatter = self.RESOURCES.get(path)
+        formatter = message_formatter()
+        if gzip_file:
+            formatter = GzipFormatter(formatter)
+        elif accepts_gzip(request):
+            formatter = GzipFormatter(formatter, content_encoding=True)
+        return self.make_export_resource(resource_class, formatter)
+
+    def make_export_resource(self, resource_class, formatter):
         return resource_class(
-            self.message_store, self.batch_id, message_formatter())
+            self.message_store, self.batch_id, formatter,
+            concurrency=self.concurrency, fetch_limiter=self.fetch_limiter,
+            reorder_buffer_size=self.reorder_buffer_size)
+
+
+class ExportJobsResource(Resource):
+    """
+    Resource that starts export jobs for a batch and reports on them.
+
+    A ``POST`` to ``jobs/<export>``, where ``<export>`` is one of the exports
+    in :attr:`BatchResource.RESOURCES`, starts a job that takes the same
+    parameters as the export. Job files are always gzipped, so there are no
+    separate ``.gz`` exports. The response has a ``202`` response code and
+    the job's status, and the status can be fetched again with a ``GET`` to
+    ``jobs/<job_id>``.
+    """
+
+    def __init__(self, batch_resource, job_scheduler):
+        Resource.__init__(self)
+        self.batch_resource = batch_resource
+        self.job_scheduler = job_scheduler
+
+    def getChild(self, path, request):
+        if path in self.batch_resource.RESOURCES:
+            resource_class, message_formatter = (
+                self.batch_resource.RESOURCES[path])
+            return StartExportJobResource(
+                self.job_scheduler, path,
+                self.batch_resource.make_export_resource(
+                    resource_class, message_formatter()))
+        job = self.job_scheduler.get_job(path)
+        if job is None or job.batch_id != self.batch_resource.batch_id:
+            return NoResource()
+        return ExportJobResource(job)
+
+
+class StartExportJobResource(Resource):
+    """
+    Resource that starts an export job.
+    """
+
+    isLeaf = True
+
+    def __init__(self, job_scheduler, export_name, export_resource):
+        Resource.__init__(self)
+        self.job_scheduler = job_scheduler
+        self.export_name = export_name
+        self.export_resource = export_resource
+
+    def render_POST(self, request):
+        try:
+            job = self.job_scheduler.create_job(
+                self.export_resource, self.export_name, request.args)
+        except ParameterError as e:
+            request.setResponseCode(400)
+            return str(e)
+        self.job_scheduler.submit(job)
+        request.setResponseCode(202)
+        request.setHeader('Content-Type', 'application/json; charset=utf-8')
+        return json.dumps(job.get_status())
+
+
+class ExportJobResource(Resource):
+    """
+    Resource that reports an export job's status.
+    """
+
+    isLeaf = True
+
+    def __init__(self, job):
+        Resource.__init__(self)
+        self.job = job
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json; charset=utf-8')
+        return json.dumps(self.job.get_status())
 
 
 class MessageExportResource(Resource):
+    """
+    Resource that exports messages from the batch named in the next path
+    segment.
+
+    :param int concurrency:
+        The maximum number of messages to fetch at once for each export.
+    :param int max_concurrent_fetches:
+        If set, the maximum number of messages to fetch at once across all
+        exports served by this resource. This must be at least 1.
+    :param int reorder_buffer_size:
+        The maximum number of messages to hold back for ordered exports.
+    :param job_scheduler:
+        An optional :class:`ExportJobScheduler` to run export jobs with.
+        Export jobs aren't available without one.
+    """
 
-    def __init__(self, message_store):
+    def __init__(self, message_store, concurrency=DEFAULT_CONCURRENCY,
+                 max_concurrent_fetches=None,
+                 reorder_buffer_size=DEFAULT_REORDER_BUFFER_SIZE,
+                 job_scheduler=None):
         Resource.__init__(self)
         self.message_store = message_store
+        self.concurrency = concurrency
+        self.fetch_limiter = None
+        if max_concurrent_fetches is not None:
+            if max_concurrent_fetches < 1:
+                # A semaphore with no tokens would never let a fetch start.
+                raise ValueError(
+                    "max_concurrent_fetches must be at least 1, not %r" % (
+                        max_concurrent_fetches,))
+            self.fetch_limiter = DeferredSemaphore(max_concurrent_fetches)
+        self.reorder_buffer_size = reorder_buffer_size
+        self.job_scheduler = job_scheduler
 
     def getChild(self, path, request):
-        return BatchResource(self.message_store, path)
+        return BatchResource(
+            self.message_store, path, concurrency=self.concurrency,
+            fetch_limiter=self.fetch_limiter,
+            reorder_buffer_size=self.reorder_buffer_size,
+            job_scheduler=self.job_scheduler)
@@ -4,14 +4,18 @@ from twisted.web import http
 from twisted.web.resource import Resource
 
 from vumi.config import (
-    ConfigDict, ConfigText, ConfigServerEndpoint, ServerEndpointFallback)
+    ConfigDict, ConfigInt, ConfigText, ConfigServerEndpoint,
+    ServerEndpointFallback)
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.utils import build_web_site
 from vumi.worker import BaseWorker
 from vumi_message_store.message_store import QueryMessageStore
+from vumi_message_store.api.message_export_jobs import (
+    DEFAULT_CHUNK_SIZE, DEFAULT_JOB_EXPIRY, DEFAULT_MAX_CONCURRENT_JOBS,
+    ExportJobScheduler)
 from vumi_message_store.api.message_export_resources import (
-    MessageExportResource)
+    DEFAULT_CONCURRENCY, DEFAULT_REORDER_BUFFER_SIZE, MessageExportResource)
 
 
 class HealthResource(Resource):
@@ -39,6 +43,40 @@ class MessageExportWorker(BaseWorker):
             'Riak client configuration.', default={}, static=True)
         redis_manager = ConfigDict(
             'Redis client configuration.', default={}, static=True)
+        export_concurrency = ConfigInt(
+            'The maximum number of messages to fetch at once for each export.',
+            default=DEFAULT_CONCURRENCY, static=True)
+        max_concurrent_fetches = ConfigInt(
+            'The maximum number of messages to fetch at once across all '
+            'exports. Must be at least 1 if set. Unlimited if unset.',
+            default=None, static=True)
+        reorder_buffer_size = ConfigInt(
+            'The maximum number of messages to hold back for each ordered '
+            'export while waiting for earlier messages to be fetched. Must '
+            'be at least 1.', default=DEFAULT_REORDER_BUFFER_SIZE, static=True)
+        export_job_dir = ConfigText(
+            'The local directory to write the files for export jobs to. '
+            'Export jobs are disabled if unset.', default=None, static=True)
+        max_concurrent_export_jobs = ConfigInt(
+            'The maximum number of export jobs to run at once.',
+            default=DEFAULT_MAX_CONCURRENT_JOBS, static=True)
+        export_job_chunk_size = ConfigInt(
+            'The number of uncompressed bytes to write to each export job '
+            'file before starting a new one.',
+            default=DEFAULT_CHUNK_SIZE, static=True)
+        export_job_expiry = ConfigInt(
+            'The number of seconds to keep finished export jobs for. Their '
+            'files are left in place.', default=DEFAULT_JOB_EXPIRY,
+            static=True)
+
+        def post_validate(self):
+            if self.reorder_buffer_size < 1:
+                self.raise_config_error(
+                    "reorder_buffer_size must be at least 1.")
+            if (self.max_concurrent_fetches is not None and
+                    self.max_concurrent_fetches < 1):
+                self.raise_config_error(
+                    "max_concurrent_fetches must be at least 1.")
 
     @inlineCallbacks
     def setup_worker(self):
@@ -46,9 +84,20 @@ class MessageExportWorker(BaseWorker):
         self._riak = yield self.create_riak_manager(config)
         self._redis = yield self.create_redis_manager(config)
         self.store = QueryMessageStore(self._riak, self._redis)
+        self.job_scheduler = None
+        if config.export_job_dir is not None:
+            self.job_scheduler = ExportJobScheduler(
+                config.export_job_dir,
+                max_concurrent_jobs=config.max_concurrent_export_jobs,
+                chunk_size=config.export_job_chunk_size,
+                job_expiry=config.export_job_expiry)
 
         site = build_web_site({
-            config.web_path: MessageExportResource(self.store),
+            config.web_path: MessageExportResource(
+                self.store, concurrency=config.export_concurrency,
+                max_concurrent_fetches=config.max_concurrent_fetches,
+                reorder_buffer_size=config.reorder_buffer_size,
+                job_scheduler=self.job_scheduler),
             config.health_path: HealthResource(),
         })
         self.addService(
@@ -62,6 +111,9 @@ class MessageExportWorker(BaseWorker):
 
     @inlineCallbacks
     def teardown_worker(self):
+        if self.job_scheduler is not None:
+            # Running jobs use the managers, so they need to stop first.
+            yield self.job_scheduler.stop()
         yield self._riak.close_manager()
         yield self._redis.close_manager()
 
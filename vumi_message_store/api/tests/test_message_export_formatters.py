@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import json
+import zlib
+
 from twisted.web.test.test_web import DummyRequest
+from vumi.message import format_vumi_date
 
 from zope.interface.verify import verifyObject
 
 from vumi_message_store.api.message_export_formatters import (
-    IMessageExportFormatter, JsonFormatter, CsvFormatter)
+    IMessageExportFormatter, JsonFormatter, RawJsonFormatter, CsvFormatter,
+    ColumnarJsonFormatter, EventCsvFormatter, GzipFormatter, GzipWriter,
+    MessageStatusCsvFormatter, MessageStatusJsonFormatter, WriteBuffer,
+    check_fields)
 
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 
@@ -45,10 +52,180 @@ class TestJsonFormatter(VumiTestCase):
         """
         msg = self.msg_helper.make_inbound("foo")
         self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            msg.to_json() + "\n",
+        ])
+
+    def test_write_row_selected_fields(self):
+        """
+        If fields are selected, only those fields are written.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.select_fields(["content", "timestamp", "bar"])
+        self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            '{"content": "foo", "timestamp": "%s", "bar": null}\n' % (
+                format_vumi_date(msg['timestamp']),),
+        ])
+
+    def test_write_row_buffered(self):
+        """
+        Messages aren't written to the request until the formatter is flushed,
+        and are then written in a single chunk.
+        """
+        msg1 = self.msg_helper.make_inbound("foo")
+        msg2 = self.msg_helper.make_inbound("bar")
+        self.formatter.write_row(self.request, msg1)
+        self.formatter.write_row(self.request, msg2)
+        self.assertEqual(self.request.written, [])
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            msg1.to_json() + "\n" + msg2.to_json() + "\n",
+        ])
+
+    def test_write_row_flush_bytes(self):
+        """
+        The buffer is flushed once it holds `flush_bytes` bytes.
+        """
+        msg1 = self.msg_helper.make_inbound("foo")
+        msg2 = self.msg_helper.make_inbound("bar")
+        formatter = JsonFormatter(flush_bytes=len(msg1.to_json()) + 2)
+        formatter.write_row(self.request, msg1)
+        self.assertEqual(self.request.written, [])
+        formatter.write_row(self.request, msg2)
+        self.assertEqual(self.request.written, [
+            msg1.to_json() + "\n" + msg2.to_json() + "\n",
+        ])
+
+    def test_flush_empty(self):
+        """
+        Flushing an empty buffer writes nothing.
+        """
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [])
+
+    def test_write_cursor(self):
+        """
+        Cursors are written in order with the messages as JSON objects.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.write_row(self.request, msg)
+        self.formatter.write_cursor(self.request, "abc=")
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            msg.to_json() + "\n" + '{"cursor": "abc="}\n',
+        ])
+
+    def test_write_row_footer(self):
+        """
+        Writing the row footer writes any buffered rows.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.write_row(self.request, msg)
+        self.formatter.write_row_footer(self.request)
+        self.assertEqual(len(self.request.written), 1)
+
+
+class TestRawJsonFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.formatter = RawJsonFormatter()
+
+    def test_implements_IMessageFormatter(self):
+        """
+        RawJsonFormatter implements the IMessageFormatter interface.
+        """
+        self.assertTrue(IMessageExportFormatter.providedBy(self.formatter))
+        self.assertTrue(verifyObject(IMessageExportFormatter, self.formatter))
+
+    def test_raw_json(self):
+        """
+        RawJsonFormatter asks for messages as JSON strings.
+        """
+        self.assertEqual(self.formatter.raw_json, True)
+        self.assertEqual(JsonFormatter.raw_json, False)
+        self.assertEqual(CsvFormatter.raw_json, False)
+
+    def test_write_row(self):
+        """
+        The message JSON is written as is.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.write_row(self.request, msg.to_json())
+        self.formatter.flush(self.request)
         self.assertEqual(self.request.written, [
-            msg.to_json(), "\n",
+            msg.to_json() + "\n",
         ])
 
+    def test_write_row_selected_fields(self):
+        """
+        If fields are selected, only those fields of the message JSON are
+        written.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.select_fields(["message_id", "content"])
+        self.formatter.write_row(self.request, msg.to_json())
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            '{"message_id": "%s", "content": "foo"}\n' % (
+                msg['message_id'],),
+        ])
+
+    def test_write_row_flush_bytes(self):
+        """
+        The buffer is flushed once it holds `flush_bytes` bytes.
+        """
+        formatter = RawJsonFormatter(flush_bytes=9)
+        formatter.write_row(self.request, '{"a":1}')
+        self.assertEqual(self.request.written, [])
+        formatter.write_row(self.request, '{"b":2}')
+        self.assertEqual(self.request.written, ['{"a":1}\n{"b":2}\n'])
+
+
+class TestCheckFields(VumiTestCase):
+
+    def test_known_fields(self):
+        """
+        Available fields are returned as a tuple.
+        """
+        self.assertEqual(check_fields(["b", "a"], ("a", "b")), ("b", "a"))
+
+    def test_unknown_fields(self):
+        """
+        Unavailable fields raise an error listing them.
+        """
+        err = self.assertRaises(
+            ValueError, check_fields, ["a", "c", "d"], ("a", "b"))
+        self.assertEqual(str(err), "Unknown fields: c, d")
+
+
+class TestWriteBuffer(VumiTestCase):
+
+    def test_write(self):
+        """
+        Written chunks are collected and their total size is tracked.
+        """
+        buf = WriteBuffer()
+        buf.write("foo")
+        buf.write("ba")
+        self.assertEqual(buf.chunks, ["foo", "ba"])
+        self.assertEqual(buf.size, 5)
+
+    def test_pop(self):
+        """
+        Popping the buffer returns the collected data and empties the buffer.
+        """
+        buf = WriteBuffer()
+        buf.write("foo")
+        buf.write("bar")
+        self.assertEqual(buf.pop(), "foobar")
+        self.assertEqual(buf.chunks, [])
+        self.assertEqual(buf.size, 0)
+        self.assertEqual(buf.pop(), "")
+
 
 class TestCsvFormatter(VumiTestCase):
     def setUp(self):
@@ -94,6 +271,7 @@ class TestCsvFormatter(VumiTestCase):
         """
         msg = self.msg_helper.make_inbound("foo")
         self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
         self._assert_row_written(
             self.request.written,
             "%(ts)s,%(id)s,9292,+41791234567,,,foo,\r\n", msg)
@@ -105,6 +283,7 @@ class TestCsvFormatter(VumiTestCase):
         """
         msg = self.msg_helper.make_inbound("foo", in_reply_to="msg-2")
         self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
         self._assert_row_written(
             self.request.written,
             "%(ts)s,%(id)s,9292,+41791234567,msg-2,,foo,\r\n", msg)
@@ -116,6 +295,7 @@ class TestCsvFormatter(VumiTestCase):
         """
         msg = self.msg_helper.make_inbound("foo", session_event="new")
         self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
         self._assert_row_written(
             self.request.written,
             "%(ts)s,%(id)s,9292,+41791234567,,new,foo,\r\n", msg)
@@ -126,6 +306,7 @@ class TestCsvFormatter(VumiTestCase):
         """
         msg = self.msg_helper.make_inbound("foo", group="#channel")
         self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
         self._assert_row_written(
             self.request.written,
             "%(ts)s,%(id)s,9292,+41791234567,,,foo,#channel\r\n", msg)
@@ -136,8 +317,521 @@ class TestCsvFormatter(VumiTestCase):
         """
         msg = self.msg_helper.make_inbound(u"føø", group="#channel")
         self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
         self._assert_row_written(
             self.request.written,
             u"%(ts)s,%(id)s,9292,+41791234567,,,føø,#channel\r\n".encode(
                 "utf-8"),
             msg)
+
+    def test_select_fields(self):
+        """
+        If fields are selected, only those columns are written.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.select_fields(["content", "message_id"])
+        self.formatter.write_row_header(self.request)
+        self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            "content,message_id\r\n",
+            "foo,%s\r\n" % (msg['message_id'],),
+        ])
+
+    def test_select_unknown_fields(self):
+        """
+        Selecting fields that aren't CSV columns raises an error.
+        """
+        err = self.assertRaises(
+            ValueError, self.formatter.select_fields, ["content", "foo"])
+        self.assertEqual(str(err), "Unknown fields: foo")
+
+    def test_write_row_buffered(self):
+        """
+        Rows aren't written to the request until the formatter is flushed.
+        """
+        msg1 = self.msg_helper.make_inbound("foo")
+        msg2 = self.msg_helper.make_inbound("bar")
+        self.formatter.write_row(self.request, msg1)
+        self.formatter.write_row(self.request, msg2)
+        self.assertEqual(self.request.written, [])
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            "%s,%s,9292,+41791234567,,,foo,\r\n"
+            "%s,%s,9292,+41791234567,,,bar,\r\n" % (
+                msg1['timestamp'].isoformat(), msg1['message_id'],
+                msg2['timestamp'].isoformat(), msg2['message_id']),
+        ])
+
+    def test_flush_empty(self):
+        """
+        Flushing an empty buffer writes nothing.
+        """
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [])
+
+    def test_write_cursor(self):
+        """
+        Cursors are written as rows starting with ``#cursor``.
+        """
+        self.formatter.write_cursor(self.request, "abc=")
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, ["#cursor,abc=\r\n"])
+
+    def test_write_row_footer(self):
+        """
+        Writing the row footer writes any buffered rows.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.write_row(self.request, msg)
+        self.formatter.write_row_footer(self.request)
+        self.assertEqual(len(self.request.written), 1)
+
+    def test_write_row_flush_rows(self):
+        """
+        The buffer is flushed once it holds `flush_rows` rows.
+        """
+        formatter = CsvFormatter(flush_rows=2)
+        formatter.write_row(self.request, self.msg_helper.make_inbound("a"))
+        self.assertEqual(len(self.request.written), 0)
+        formatter.write_row(self.request, self.msg_helper.make_inbound("b"))
+        self.assertEqual(len(self.request.written), 1)
+        formatter.write_row(self.request, self.msg_helper.make_inbound("c"))
+        self.assertEqual(len(self.request.written), 1)
+        formatter.write_row(self.request, self.msg_helper.make_inbound("d"))
+        self.assertEqual(len(self.request.written), 2)
+
+    def test_write_row_flush_bytes(self):
+        """
+        The buffer is flushed once it holds `flush_bytes` bytes.
+        """
+        formatter = CsvFormatter(flush_bytes=200)
+        formatter.write_row(self.request, self.msg_helper.make_inbound("a"))
+        self.assertEqual(len(self.request.written), 0)
+        formatter.write_row(
+            self.request, self.msg_helper.make_inbound("b" * 200))
+        self.assertEqual(len(self.request.written), 1)
+        self.assertTrue(len(self.request.written[0]) >= 200)
+
+
+class TestEventCsvFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.formatter = EventCsvFormatter()
+
+    def test_implements_IMessageFormatter(self):
+        """
+        EventCsvFormatter implements the IMessageFormatter interface.
+        """
+        self.assertTrue(IMessageExportFormatter.providedBy(self.formatter))
+        self.assertTrue(verifyObject(IMessageExportFormatter, self.formatter))
+
+    def test_write_row_header(self):
+        """
+        The CSV row headers are written correctly.
+        """
+        self.formatter.write_row_header(self.request)
+        self.assertEqual(self.request.written, [
+            "timestamp,event_id,event_type,user_message_id,sent_message_id,"
+            "delivery_status,nack_reason\r\n"
+        ])
+
+    def test_write_row_ack(self):
+        """
+        An ack is written as a CSV row correctly.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        ack = self.msg_helper.make_ack(msg)
+        self.formatter.write_row(self.request, ack)
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            "%s,%s,ack,%s,%s,,\r\n" % (
+                ack['timestamp'].isoformat(), ack['event_id'],
+                msg['message_id'], ack['sent_message_id']),
+        ])
+
+    def test_write_row_delivery_report(self):
+        """
+        A delivery report is written as a CSV row correctly.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        dr = self.msg_helper.make_delivery_report(msg)
+        self.formatter.write_row(self.request, dr)
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            "%s,%s,delivery_report,%s,,delivered,\r\n" % (
+                dr['timestamp'].isoformat(), dr['event_id'],
+                msg['message_id']),
+        ])
+
+
+class TestMessageStatusJsonFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.formatter = MessageStatusJsonFormatter()
+
+    def test_implements_IMessageFormatter(self):
+        """
+        MessageStatusJsonFormatter implements the IMessageFormatter interface.
+        """
+        self.assertTrue(IMessageExportFormatter.providedBy(self.formatter))
+        self.assertTrue(verifyObject(IMessageExportFormatter, self.formatter))
+        self.assertEqual(self.formatter.raw_json, True)
+
+    def test_write_row(self):
+        """
+        The message JSON is written along with its status.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        self.formatter.write_row(self.request, (
+            msg.to_json(), "2014-11-01 12:00:00.000000", "ack"))
+        self.formatter.flush(self.request)
+        [row] = self.request.written
+        self.assertTrue(row.endswith("\n"))
+        self.assertEqual(json.loads(row), {
+            "message": json.loads(msg.to_json()),
+            "status_timestamp": "2014-11-01 12:00:00.000000",
+            "status": "ack",
+        })
+
+    def test_write_row_selected_fields(self):
+        """
+        If fields are selected, only those fields of the message are written.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        self.formatter.select_fields(["content"])
+        self.formatter.write_row(self.request, (msg.to_json(), None, "ack"))
+        self.formatter.flush(self.request)
+        [row] = self.request.written
+        self.assertEqual(json.loads(row), {
+            "message": {"content": "foo"},
+            "status_timestamp": None,
+            "status": "ack",
+        })
+
+    def test_write_row_no_status(self):
+        """
+        A message without a status is written with null status fields.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        self.formatter.write_row(self.request, (msg.to_json(), None, None))
+        self.formatter.flush(self.request)
+        [row] = self.request.written
+        self.assertEqual(json.loads(row), {
+            "message": json.loads(msg.to_json()),
+            "status_timestamp": None,
+            "status": None,
+        })
+
+
+class TestMessageStatusCsvFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.formatter = MessageStatusCsvFormatter()
+
+    def test_implements_IMessageFormatter(self):
+        """
+        MessageStatusCsvFormatter implements the IMessageFormatter interface.
+        """
+        self.assertTrue(IMessageExportFormatter.providedBy(self.formatter))
+        self.assertTrue(verifyObject(IMessageExportFormatter, self.formatter))
+
+    def test_write_row_header(self):
+        """
+        The CSV row headers include the status fields.
+        """
+        self.formatter.write_row_header(self.request)
+        self.assertEqual(self.request.written, [
+            "timestamp,message_id,to_addr,from_addr,in_reply_to,session_event,"
+            "content,group,status_timestamp,status\r\n"
+        ])
+
+    def test_write_row(self):
+        """
+        A message is written as a CSV row with its status.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        self.formatter.write_row(self.request, (
+            msg, u"2014-11-01 12:00:00.000000", u"delivery_report.delivered"))
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            "%s,%s,+41791234567,9292,,,foo,,2014-11-01 12:00:00.000000,"
+            "delivery_report.delivered\r\n" % (
+                msg['timestamp'].isoformat(), msg['message_id']),
+        ])
+
+    def test_write_row_no_status(self):
+        """
+        A message without a status is written with empty status fields.
+        """
+        msg = self.msg_helper.make_outbound("foo")
+        self.formatter.write_row(self.request, (msg, None, None))
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [
+            "%s,%s,+41791234567,9292,,,foo,,,\r\n" % (
+                msg['timestamp'].isoformat(), msg['message_id']),
+        ])
+
+
+class TestColumnarJsonFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.formatter = ColumnarJsonFormatter()
+
+    def test_implements_IMessageFormatter(self):
+        """
+        ColumnarJsonFormatter implements the IMessageFormatter interface.
+        """
+        self.assertTrue(IMessageExportFormatter.providedBy(self.formatter))
+        self.assertTrue(verifyObject(IMessageExportFormatter, self.formatter))
+
+    def test_add_http_headers(self):
+        """
+        The correct Content-Type response header is written.
+        """
+        self.formatter.add_http_headers(self.request)
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders('Content-Type'),
+            ['application/json; charset=utf-8'])
+
+    def test_write_row_header(self):
+        """
+        No row headers are written.
+        """
+        self.formatter.write_row_header(self.request)
+        self.assertEqual(self.request.written, [])
+
+    def test_write_rows(self):
+        """
+        Messages are written as a row group with a list of values for each
+        field.
+        """
+        msg1 = self.msg_helper.make_inbound("foo")
+        msg2 = self.msg_helper.make_inbound(
+            u"føø", session_event="new", group="#channel")
+        self.formatter.write_row(self.request, msg1)
+        self.formatter.write_row(self.request, msg2)
+        self.assertEqual(self.request.written, [])
+        self.formatter.flush(self.request)
+        [row_group] = self.request.written
+        self.assertTrue(row_group.endswith("\n"))
+        self.assertEqual(json.loads(row_group), {
+            "num_rows": 2,
+            "columns": {
+                "timestamp": [
+                    msg1["timestamp"].isoformat(),
+                    msg2["timestamp"].isoformat()],
+                "message_id": [msg1["message_id"], msg2["message_id"]],
+                "to_addr": ["9292", "9292"],
+                "from_addr": ["+41791234567", "+41791234567"],
+                "in_reply_to": [None, None],
+                "session_event": [None, "new"],
+                "content": ["foo", u"føø"],
+                "group": [None, "#channel"],
+            },
+        })
+
+    def test_columns_in_field_order(self):
+        """
+        Columns are written in the same order as the CSV fields.
+        """
+        self.formatter.write_row(
+            self.request, self.msg_helper.make_inbound("foo"))
+        self.formatter.flush(self.request)
+        [row_group] = self.request.written
+        row_group = json.loads(row_group, object_pairs_hook=lambda p: p)
+        self.assertEqual(
+            [name for name, _ in dict(row_group)["columns"]],
+            list(CsvFormatter.FIELDS))
+
+    def test_write_cursor(self):
+        """
+        Writing a cursor ends the current row group and writes the cursor
+        after it.
+        """
+        self.formatter.write_row(
+            self.request, self.msg_helper.make_inbound("foo"))
+        self.formatter.write_cursor(self.request, "abc=")
+        self.assertEqual(len(self.request.written), 2)
+        row_group, cursor = self.request.written
+        self.assertEqual(json.loads(row_group)["num_rows"], 1)
+        self.assertEqual(cursor, '{"cursor": "abc="}\n')
+
+    def test_select_fields(self):
+        """
+        If fields are selected, only those columns are written.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        self.formatter.select_fields(["message_id", "content"])
+        self.formatter.write_row(self.request, msg)
+        self.formatter.flush(self.request)
+        [row_group] = self.request.written
+        self.assertEqual(json.loads(row_group), {
+            "num_rows": 1,
+            "columns": {
+                "message_id": [msg["message_id"]],
+                "content": ["foo"],
+            },
+        })
+        self.assertRaises(ValueError, self.formatter.select_fields, ["foo"])
+
+    def test_row_group_size(self):
+        """
+        A row group is written once it holds `row_group_size` rows.
+        """
+        formatter = ColumnarJsonFormatter(row_group_size=2)
+        for content in ["a", "b", "c"]:
+            formatter.write_row(
+                self.request, self.msg_helper.make_inbound(content))
+        self.assertEqual(len(self.request.written), 1)
+        formatter.write_row_footer(self.request)
+        self.assertEqual(
+            [json.loads(group)["num_rows"] for group in self.request.written],
+            [2, 1])
+
+    def test_flush_empty(self):
+        """
+        Flushing with no buffered rows writes nothing.
+        """
+        self.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [])
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class TestGzipWriter(VumiTestCase):
+    def setUp(self):
+        self.request = DummyRequest([''])
+
+    def test_write_and_close(self):
+        """
+        Data written to the writer is written to the request as a gzip stream
+        once the writer is closed.
+        """
+        writer = GzipWriter(self.request)
+        writer.write("foo")
+        writer.write("bar")
+        writer.close()
+        self.assertEqual(gunzip("".join(self.request.written)), "foobar")
+
+    def test_flush(self):
+        """
+        Flushing the writer writes everything compressed so far to the request.
+        """
+        writer = GzipWriter(self.request)
+        writer.write("foo")
+        writer.flush()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(
+            decompressor.decompress("".join(self.request.written)), "foo")
+
+    def test_flush_nothing_written(self):
+        """
+        Flushing the writer when nothing has been written since the last flush
+        doesn't write anything.
+        """
+        writer = GzipWriter(self.request)
+        writer.write("foo")
+        writer.flush()
+        written = list(self.request.written)
+        writer.flush()
+        self.assertEqual(self.request.written, written)
+
+
+class TestGzipFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+
+    def test_implements_IMessageFormatter(self):
+        """
+        GzipFormatter implements the IMessageFormatter interface.
+        """
+        formatter = GzipFormatter(CsvFormatter())
+        self.assertTrue(IMessageExportFormatter.providedBy(formatter))
+        self.assertTrue(verifyObject(IMessageExportFormatter, formatter))
+
+    def test_raw_json(self):
+        """
+        GzipFormatter asks for messages in the same form as the formatter it
+        wraps.
+        """
+        self.assertEqual(GzipFormatter(CsvFormatter()).raw_json, False)
+        self.assertEqual(GzipFormatter(RawJsonFormatter()).raw_json, True)
+
+    def test_add_http_headers(self):
+        """
+        Gzip files are sent with the gzip content type.
+        """
+        formatter = GzipFormatter(CsvFormatter())
+        formatter.add_http_headers(self.request)
+        headers = self.request.responseHeaders
+        self.assertEqual(
+            headers.getRawHeaders('Content-Type'), ['application/gzip'])
+        self.assertEqual(headers.getRawHeaders('Content-Encoding'), None)
+
+    def test_add_http_headers_content_encoding(self):
+        """
+        Compressed responses keep the wrapped formatter's content type and
+        are sent with a gzip content encoding.
+        """
+        formatter = GzipFormatter(CsvFormatter(), content_encoding=True)
+        formatter.add_http_headers(self.request)
+        headers = self.request.responseHeaders
+        self.assertEqual(
+            headers.getRawHeaders('Content-Type'), ['text/csv; charset=utf-8'])
+        self.assertEqual(headers.getRawHeaders('Content-Encoding'), ['gzip'])
+        self.assertEqual(headers.getRawHeaders('Vary'), ['Accept-Encoding'])
+
+    def test_select_fields(self):
+        """
+        Fields are selected on the wrapped formatter.
+        """
+        formatter = GzipFormatter(CsvFormatter())
+        formatter.select_fields(["content"])
+        self.assertEqual(formatter.formatter.fields, ("content",))
+
+    def test_write_rows(self):
+        """
+        The wrapped formatter's output is gzipped.
+        """
+        formatter = GzipFormatter(JsonFormatter())
+        msg1 = self.msg_helper.make_inbound("foo")
+        msg2 = self.msg_helper.make_inbound("bar")
+        formatter.write_row_header(self.request)
+        formatter.write_row(self.request, msg1)
+        formatter.flush(self.request)
+        formatter.write_row(self.request, msg2)
+        formatter.write_row_footer(self.request)
+        self.assertEqual(
+            gunzip("".join(self.request.written)),
+            msg1.to_json() + "\n" + msg2.to_json() + "\n")
+
+    def test_write_cursor(self):
+        """
+        Cursors are written by the wrapped formatter and compressed.
+        """
+        formatter = GzipFormatter(CsvFormatter())
+        formatter.write_cursor(self.request, "abc=")
+        formatter.write_row_footer(self.request)
+        self.assertEqual(
+            gunzip("".join(self.request.written)), "#cursor,abc=\r\n")
+
+    def test_flush(self):
+        """
+        Flushing the formatter writes the rows compressed so far.
+        """
+        formatter = GzipFormatter(CsvFormatter())
+        formatter.write_row_header(self.request)
+        formatter.flush(self.request)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(
+            decompressor.decompress("".join(self.request.written)),
+            "timestamp,message_id,to_addr,from_addr,in_reply_to,session_event,"
+            "content,group\r\n")
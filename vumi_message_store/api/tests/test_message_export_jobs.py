@@ -0,0 +1,353 @@
+import gzip
+import os
+
+from twisted.internet.defer import Deferred, fail, inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi_message_store.api import message_export_jobs
+from vumi_message_store.api.message_export_jobs import (
+    ChunkedGzipWriter, ExportJob, ExportJobScheduler)
+from vumi_message_store.api.message_export_resources import ParameterError
+
+from vumi.tests.helpers import VumiTestCase
+
+
+def read_gzip(path):
+    f = gzip.GzipFile(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class FakeExportResource(object):
+    """
+    Just enough of an export resource to run jobs with. Each export writes
+    its rows and then waits until it's told to finish.
+    """
+
+    batch_id = 'batch'
+
+    def __init__(self, rows=(), error=None):
+        self.rows = rows
+        self.error = error
+        self.started = []
+        self.exports = {}
+        self._start_waiters = []
+
+    def parse_export_args(self, request):
+        if 'bad' in request.args:
+            raise ParameterError("Invalid 'bad' parameter")
+        return (None, None, None, 1)
+
+    def start_export(self, request, start, end, cursor, shards):
+        if self.error is not None:
+            return fail(self.error)
+        for row in self.rows:
+            request.write(row)
+            request.export_rows += 1
+        d = Deferred()
+        d.addCallback(lambda _: request.finish())
+        self.started.append(d)
+        self.exports[request] = d
+        waiters, self._start_waiters = self._start_waiters, []
+        for count, waiter in waiters:
+            self._notify_started(count, waiter)
+        return d
+
+    def _notify_started(self, count, d):
+        if len(self.started) >= count:
+            d.callback(None)
+        else:
+            self._start_waiters.append((count, d))
+
+    def wait_for_start(self, count=1):
+        """
+        Return a Deferred that fires once `count` exports have started.
+        Jobs create their directories in a thread, so exports don't start
+        as soon as they're run.
+        """
+        d = Deferred()
+        self._notify_started(count, d)
+        return d
+
+
+class TestChunkedGzipWriter(VumiTestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.makedirs(self.path)
+
+    def test_write(self):
+        """
+        Data is written to a single gzip file if it's smaller than the chunk
+        size.
+        """
+        writer = ChunkedGzipWriter(self.path, 'out-%d.gz', chunk_size=10)
+        writer.write('abc\n')
+        writer.write('def\n')
+        writer.close()
+        self.assertEqual(writer.filenames, ['out-0.gz'])
+        self.assertEqual(
+            read_gzip(os.path.join(self.path, 'out-0.gz')), 'abc\ndef\n')
+
+    def test_write_chunks(self):
+        """
+        A new file is started once the current one holds `chunk_size` bytes,
+        but writes are never split across files.
+        """
+        writer = ChunkedGzipWriter(self.path, 'out-%d.gz', chunk_size=6)
+        writer.write('abc\n')
+        writer.write('def\n')
+        writer.write('ghi\n')
+        writer.close()
+        self.assertEqual(writer.filenames, ['out-0.gz', 'out-1.gz'])
+        self.assertEqual(
+            read_gzip(os.path.join(self.path, 'out-0.gz')), 'abc\ndef\n')
+        self.assertEqual(
+            read_gzip(os.path.join(self.path, 'out-1.gz')), 'ghi\n')
+
+    def test_no_writes(self):
+        """
+        No files are written if nothing is written.
+        """
+        writer = ChunkedGzipWriter(self.path, 'out-%d.gz')
+        writer.close()
+        self.assertEqual(writer.filenames, [])
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class TestExportJob(VumiTestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'job')
+
+    def test_parse_args(self):
+        """
+        The export parameters are parsed when the job is created.
+        """
+        self.assertRaises(
+            ParameterError, ExportJob, 'job', 'inbound.csv', {'bad': ['1']},
+            FakeExportResource(), self.path)
+
+    @inlineCallbacks
+    def test_run(self):
+        """
+        Running a job writes the export to its directory and records its
+        progress.
+        """
+        resource = FakeExportResource(rows=['a\n', 'b\n'])
+        job = ExportJob('job', 'inbound.csv', {}, resource, self.path)
+        self.assertEqual(job.status, ExportJob.QUEUED)
+        d = job.run()
+        self.assertEqual(job.status, ExportJob.RUNNING)
+        yield resource.wait_for_start()
+        self.assertEqual(job.export_rows, 2)
+        finished_d = job.notify_finished()
+        self.assertEqual(finished_d.called, False)
+
+        resource.started[0].callback(None)
+        yield d
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertEqual((yield finished_d), job)
+        self.assertEqual(job.get_status(), {
+            'job_id': 'job',
+            'batch_id': 'batch',
+            'export': 'inbound.csv',
+            'status': 'done',
+            'error': None,
+            'messages_exported': 2,
+            'bytes_written': 4,
+            'files': ['inbound-00000.csv.gz'],
+        })
+        self.assertEqual(
+            read_gzip(os.path.join(self.path, 'inbound-00000.csv.gz')),
+            'a\nb\n')
+
+    @inlineCallbacks
+    def test_run_failed(self):
+        """
+        If the export fails, the job records the error.
+        """
+        resource = FakeExportResource(error=ValueError("Riak is down"))
+        job = ExportJob('job', 'events.json', {}, resource, self.path)
+        yield job.run()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertEqual(job.error, "Riak is down")
+        self.assertEqual(job.connection_has_been_closed, True)
+        self.assertEqual((yield job.notify_finished()), job)
+        [err] = self.flushLoggedErrors(ValueError)
+
+    @inlineCallbacks
+    def test_write_buffer_full(self):
+        """
+        The job's producer is paused while too much data is waiting to be
+        written, and resumed once it has been written.
+        """
+        self.patch(message_export_jobs, 'WRITE_BUFFER_SIZE', 4)
+        # The first row is written straight away, and the next two fill the
+        # buffer while it's being written.
+        resource = FakeExportResource(rows=['ab\n', 'cd\n', 'ef\n'])
+        job = ExportJob('job', 'inbound.csv', {}, resource, self.path)
+        d = job.run()
+        yield resource.wait_for_start()
+        self.assertEqual(job.export_producer.paused, True)
+        yield job.export_producer.wait_for_resume()
+        self.assertEqual(job.export_producer.paused, False)
+
+        resource.started[0].callback(None)
+        yield d
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertEqual(
+            read_gzip(os.path.join(self.path, 'inbound-00000.csv.gz')),
+            'ab\ncd\nef\n')
+
+    @inlineCallbacks
+    def test_write_failed(self):
+        """
+        If the files can't be written, the export is stopped and the job
+        records the error.
+        """
+        resource = FakeExportResource(rows=['a\n'])
+        job = ExportJob('job', 'inbound.csv', {}, resource, self.path)
+
+        def write(data):
+            raise IOError("Disk full")
+
+        self.patch(job.writer, 'write', write)
+        d = job.run()
+        yield resource.wait_for_start()
+        yield job._writing
+        self.assertEqual(job.connection_has_been_closed, True)
+
+        resource.started[0].callback(None)
+        yield d
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertEqual(job.error, "Disk full")
+        self.assertEqual(job.bytes_written, 0)
+        [err] = self.flushLoggedErrors(IOError)
+
+
+class TestExportJobScheduler(VumiTestCase):
+
+    def setUp(self):
+        self.export_dir = self.mktemp()
+        self.clock = Clock()
+
+    def test_create_job(self):
+        """
+        Jobs are created in a directory named after the job.
+        """
+        scheduler = ExportJobScheduler(self.export_dir, chunk_size=10)
+        job = scheduler.create_job(FakeExportResource(), 'inbound.json', {})
+        self.assertEqual(job.path, os.path.join(self.export_dir, job.job_id))
+        self.assertEqual(job.writer.chunk_size, 10)
+        self.assertEqual(job.args, {})
+        self.assertEqual(scheduler.get_job(job.job_id), None)
+
+    @inlineCallbacks
+    def test_submit(self):
+        """
+        No more than `max_concurrent_jobs` jobs are run at once, and the rest
+        are queued until a running job finishes.
+        """
+        scheduler = ExportJobScheduler(
+            self.export_dir, max_concurrent_jobs=2, clock=self.clock)
+        resource = FakeExportResource()
+        jobs = [
+            scheduler.create_job(resource, 'inbound.json', {})
+            for _ in range(3)]
+        submitted = [scheduler.submit(job) for job in jobs]
+        self.assertEqual(
+            [scheduler.get_job(job.job_id) for job in jobs], jobs)
+        self.assertEqual(
+            [job.status for job in jobs], ['running', 'running', 'queued'])
+
+        yield resource.wait_for_start(2)
+        resource.exports[jobs[0]].callback(None)
+        yield submitted[0]
+        self.assertEqual(
+            [job.status for job in jobs], ['done', 'running', 'running'])
+
+        yield resource.wait_for_start(3)
+        resource.exports[jobs[1]].callback(None)
+        resource.exports[jobs[2]].callback(None)
+        yield submitted[1]
+        yield submitted[2]
+        self.assertEqual(
+            [job.status for job in jobs], ['done', 'done', 'done'])
+
+    @inlineCallbacks
+    def test_job_expiry(self):
+        """
+        Finished jobs are forgotten and their files are deleted once they've
+        expired.
+        """
+        scheduler = ExportJobScheduler(
+            self.export_dir, job_expiry=60, clock=self.clock)
+        resource = FakeExportResource(rows=['a\n'])
+        job = scheduler.create_job(resource, 'inbound.json', {})
+        d = scheduler.submit(job)
+        yield resource.wait_for_start()
+        self.clock.advance(60)
+        self.assertEqual(scheduler.get_job(job.job_id), job)
+
+        resource.started[0].callback(None)
+        yield d
+        self.assertEqual(os.listdir(job.path), ['inbound-00000.json.gz'])
+        self.clock.advance(59)
+        self.assertEqual(scheduler.get_job(job.job_id), job)
+        self.clock.advance(1)
+        self.assertEqual(scheduler.get_job(job.job_id), None)
+        # Stopping the scheduler waits for the files to be deleted.
+        yield scheduler.stop()
+        self.assertEqual(os.path.exists(job.path), False)
+
+    @inlineCallbacks
+    def test_stop(self):
+        """
+        Stopping the scheduler cancels any pending job expiries.
+        """
+        scheduler = ExportJobScheduler(
+            self.export_dir, job_expiry=60, clock=self.clock)
+        resource = FakeExportResource()
+        job = scheduler.create_job(resource, 'inbound.json', {})
+        d = scheduler.submit(job)
+        yield resource.wait_for_start()
+        resource.started[0].callback(None)
+        yield d
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        yield scheduler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(job.status, ExportJob.DONE)
+
+    @inlineCallbacks
+    def test_stop_running_jobs(self):
+        """
+        Stopping the scheduler stops any running or queued jobs, the same way
+        a closed connection stops an export, and waits for them to finish.
+        The stopped jobs are marked as failed.
+        """
+        scheduler = ExportJobScheduler(
+            self.export_dir, max_concurrent_jobs=1, job_expiry=60,
+            clock=self.clock)
+        resource = FakeExportResource()
+        running = scheduler.create_job(resource, 'inbound.json', {})
+        queued = scheduler.create_job(resource, 'inbound.json', {})
+        scheduler.submit(running)
+        scheduler.submit(queued)
+        yield resource.wait_for_start()
+
+        d = scheduler.stop()
+        self.assertEqual(running.connection_has_been_closed, True)
+        self.assertEqual(running.export_producer.stopped, True)
+        self.assertEqual(d.called, False)
+
+        # The export stops once it sees the closed connection.
+        resource.started[0].callback(None)
+        yield d
+        self.assertEqual(len(resource.started), 1)
+        for job in [running, queued]:
+            self.assertEqual(job.status, ExportJob.FAILED)
+            self.assertEqual(job.error, "Export job was stopped.")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
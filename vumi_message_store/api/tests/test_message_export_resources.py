@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet.defer import fail, inlineCallbacks, succeed
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.test.test_web import DummyRequest
+
+from zope.interface.verify import verifyObject
+
+from vumi_message_store.api.message_export_formatters import JsonFormatter
+from vumi_message_store.api.message_export_resources import (
+    ExportProducer, InboundResource, MessageExportResource, ReorderBuffer,
+    accepts_gzip, export_shard_ranges)
+
+from vumi.tests.helpers import VumiTestCase, MessageHelper
+
+
+class FakeMessageStore(object):
+    """
+    Just enough of a message store to hand out inbound messages.
+    """
+
+    def __init__(self, messages, failing_ids=()):
+        self.messages = dict((msg['message_id'], msg) for msg in messages)
+        self.failing_ids = failing_ids
+        self.fetched = []
+
+    def get_inbound_message(self, msg_id):
+        self.fetched.append(msg_id)
+        if msg_id in self.failing_ids:
+            return fail(Exception("Riak is down."))
+        return succeed(self.messages.get(msg_id))
+
+
+class TestExportShardRanges(VumiTestCase):
+
+    def test_one_shard(self):
+        """
+        A single shard covers the whole time range.
+        """
+        self.assertEqual(
+            export_shard_ranges(
+                "2014-11-01 00:00:00.000000", "2014-11-05 00:00:00.000000", 1),
+            [("2014-11-01 00:00:00.000000", "2014-11-05 00:00:00.000000")])
+
+    def test_shards(self):
+        """
+        The time range is split into contiguous shards of equal length, newest
+        first.
+        """
+        self.assertEqual(
+            export_shard_ranges(
+                "2014-11-01 00:00:00.000000", "2014-11-04 00:00:00.000000", 3),
+            [
+                ("2014-11-03 00:00:00.000000", "2014-11-04 00:00:00.000000"),
+                ("2014-11-02 00:00:00.000000", "2014-11-02 23:59:59.000000"),
+                ("2014-11-01 00:00:00.000000", "2014-11-01 23:59:59.000000"),
+            ])
+
+    def test_short_range(self):
+        """
+        A time range too short to split on whole seconds is split into fewer
+        shards.
+        """
+        self.assertEqual(
+            export_shard_ranges(
+                "2014-11-01 00:00:00.000000", "2014-11-01 00:00:01.000000", 4),
+            [
+                ("2014-11-01 00:00:00.000000", "2014-11-01 00:00:01.000000"),
+            ])
+        self.assertEqual(
+            export_shard_ranges(
+                "2014-11-01 00:00:00.500000", "2014-11-01 00:00:04.000000", 2),
+            [
+                ("2014-11-01 00:00:02.000000", "2014-11-01 00:00:04.000000"),
+                ("2014-11-01 00:00:00.500000", "2014-11-01 00:00:01.000000"),
+            ])
+
+
+class TestAcceptsGzip(VumiTestCase):
+
+    def make_request(self, *accept_encodings):
+        request = DummyRequest([''])
+        for accept_encoding in accept_encodings:
+            request.requestHeaders.addRawHeader(
+                'Accept-Encoding', accept_encoding)
+        return request
+
+    def test_no_header(self):
+        """
+        Requests without an Accept-Encoding header don't accept gzip.
+        """
+        self.assertEqual(accepts_gzip(self.make_request()), False)
+
+    def test_gzip(self):
+        """
+        Requests that list gzip as an acceptable encoding accept gzip.
+        """
+        self.assertEqual(accepts_gzip(self.make_request('gzip')), True)
+        self.assertEqual(
+            accepts_gzip(self.make_request('deflate, GZip;q=0.5')), True)
+        self.assertEqual(
+            accepts_gzip(self.make_request('deflate', 'x-gzip')), True)
+
+    def test_not_gzip(self):
+        """
+        Requests that don't list gzip, or give it a quality of 0, don't
+        accept gzip.
+        """
+        self.assertEqual(accepts_gzip(self.make_request('deflate')), False)
+        self.assertEqual(accepts_gzip(self.make_request('gzip;q=0')), False)
+        self.assertEqual(accepts_gzip(self.make_request('gzip;q=x')), False)
+
+
+class TestExportProducer(VumiTestCase):
+
+    def test_implements_IPushProducer(self):
+        """
+        ExportProducer implements the IPushProducer interface.
+        """
+        producer = ExportProducer()
+        self.assertTrue(IPushProducer.providedBy(producer))
+        self.assertTrue(verifyObject(IPushProducer, producer))
+
+    def test_wait_for_resume_not_paused(self):
+        """
+        If the producer isn't paused, waiting for it to resume returns
+        immediately.
+        """
+        producer = ExportProducer()
+        self.assertEqual(producer.wait_for_resume().called, True)
+
+    def test_wait_for_resume_paused(self):
+        """
+        If the producer is paused, waiting for it to resume only returns once
+        it's resumed.
+        """
+        producer = ExportProducer()
+        producer.pauseProducing()
+        d = producer.wait_for_resume()
+        self.assertEqual(d.called, False)
+        producer.resumeProducing()
+        self.assertEqual(d.called, True)
+        self.assertEqual(producer.paused, False)
+
+    def test_wait_for_resume_stopped(self):
+        """
+        If the producer is stopped while paused, waiting for it to resume
+        returns so that the caller can stop.
+        """
+        producer = ExportProducer()
+        producer.pauseProducing()
+        d = producer.wait_for_resume()
+        producer.stopProducing()
+        self.assertEqual(d.called, True)
+        self.assertEqual(producer.stopped, True)
+        self.assertEqual(producer.wait_for_resume().called, True)
+
+
+class TestReorderBuffer(VumiTestCase):
+
+    def test_add_in_order(self):
+        """
+        Results added in order are written immediately.
+        """
+        written = []
+        buf = ReorderBuffer(written.append, 2)
+        buf.add(0, "a")
+        self.assertEqual(written, ["a"])
+        buf.add(1, "b")
+        self.assertEqual(written, ["a", "b"])
+
+    def test_add_out_of_order(self):
+        """
+        Results added out of order are held back until the results ahead of
+        them have been written.
+        """
+        written = []
+        buf = ReorderBuffer(written.append, 3)
+        buf.add(2, "c")
+        buf.add(1, "b")
+        self.assertEqual(written, [])
+        buf.add(0, "a")
+        self.assertEqual(written, ["a", "b", "c"])
+
+    def test_wait_for_room(self):
+        """
+        Waiting for room only returns once the result's index is within
+        `size` of the next result to be written.
+        """
+        written = []
+        buf = ReorderBuffer(written.append, 2)
+        self.assertEqual(buf.wait_for_room(0).called, True)
+        self.assertEqual(buf.wait_for_room(1).called, True)
+        d2 = buf.wait_for_room(2)
+        d3 = buf.wait_for_room(3)
+        self.assertEqual(d2.called, False)
+        buf.add(1, "b")
+        self.assertEqual(d2.called, False)
+        buf.add(0, "a")
+        self.assertEqual(d2.called, True)
+        self.assertEqual(d3.called, True)
+        self.assertEqual(written, ["a", "b"])
+
+
+class TestMessageExportProxyResource(VumiTestCase):
+
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.request.connection_has_been_closed = False
+        self.request.export_producer = ExportProducer()
+        self.request.export_addrs = None
+        self.request.export_filters = {}
+        self.request.export_rows = 0
+
+    def test_handle_message_waits_while_paused(self):
+        """
+        Messages aren't fetched while the request's producer is paused.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        store = FakeMessageStore([msg])
+        resource = InboundResource(store, "batch", JsonFormatter())
+
+        self.request.export_producer.pauseProducing()
+        d = resource.handle_message(msg['message_id'], self.request)
+        self.assertEqual(store.fetched, [])
+        self.assertEqual(self.request.written, [])
+
+        self.request.export_producer.resumeProducing()
+        self.assertEqual(d.called, True)
+        self.assertEqual(store.fetched, [msg['message_id']])
+        resource.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [msg.to_json() + "\n"])
+
+    def test_handle_message_connection_closed_while_paused(self):
+        """
+        If the connection is closed while the producer is paused, the message
+        isn't fetched at all.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        store = FakeMessageStore([msg])
+        resource = InboundResource(store, "batch", JsonFormatter())
+
+        self.request.export_producer.pauseProducing()
+        d = resource.handle_message(msg['message_id'], self.request)
+        self.request.connection_has_been_closed = True
+        self.request.export_producer.stopProducing()
+        self.assertEqual(d.called, True)
+        self.assertEqual(store.fetched, [])
+        self.assertEqual(self.request.written, [])
+
+    @inlineCallbacks
+    def test_handle_message_fetch_failed(self):
+        """
+        If a message can't be fetched, the failure is passed on and nothing
+        is written.
+        """
+        msg = self.msg_helper.make_inbound("foo")
+        store = FakeMessageStore([msg], failing_ids=[msg['message_id']])
+        resource = InboundResource(store, "batch", JsonFormatter())
+
+        d = resource.handle_message(msg['message_id'], self.request)
+        err = yield self.assertFailure(d, Exception)
+        self.assertEqual(str(err), "Riak is down.")
+        self.assertEqual(store.fetched, [msg['message_id']])
+        resource.formatter.flush(self.request)
+        self.assertEqual(self.request.written, [])
+
+
+class TestMessageExportResource(VumiTestCase):
+
+    def test_max_concurrent_fetches(self):
+        """
+        If a limit on concurrent fetches is given, all exports share a
+        limiter that allows that many fetches at once.
+        """
+        resource = MessageExportResource(
+            FakeMessageStore([]), max_concurrent_fetches=3)
+        self.assertEqual(resource.fetch_limiter.tokens, 3)
+        resource = MessageExportResource(FakeMessageStore([]))
+        self.assertEqual(resource.fetch_limiter, None)
+
+    def test_invalid_max_concurrent_fetches(self):
+        """
+        A limit on concurrent fetches that wouldn't let any fetch start is
+        rejected.
+        """
+        self.assertRaises(
+            ValueError, MessageExportResource, FakeMessageStore([]),
+            max_concurrent_fetches=0)
@@ -1,16 +1,32 @@
 # -*- coding: utf-8 -*-
 
+import gc
+import gzip
 import json
+import os
+import zlib
 from datetime import datetime
 from urllib import urlencode
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, fail, gatherResults, inlineCallbacks,
+    returnValue)
+from twisted.internet import reactor
+from twisted.internet.task import Clock
 from twisted.web import http
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, ResponseFailed, readBody)
+from twisted.web.http_headers import Headers
 
 from vumi_message_store.message_store import (
     MessageStoreBatchManager, OperationalMessageStore)
+from vumi_message_store.api import message_export_resources
+from vumi_message_store.api.message_export_resources import InboundResource
 from vumi_message_store.api.message_export_worker import MessageExportWorker
+from vumi_message_store.riak_backend import IndexPageWrapper
 
+from vumi.config import ConfigError
+from vumi.persist.model import VumiRiakError
 from vumi.utils import http_request_full
 
 from vumi.tests.helpers import (
@@ -39,11 +55,12 @@ class TestMessageExportWorker(VumiTestCase):
         returnValue((riak, redis))
 
     @inlineCallbacks
-    def start_server(self):
+    def start_server(self, **extra_config):
         config = self.persistence_helper.mk_config({
             'twisted_endpoint': 'tcp:0',
             'web_path': '/resource_path/',
         })
+        config.update(extra_config)
 
         worker = yield self.worker_helper.get_worker(
             MessageExportWorker, config)
@@ -53,7 +70,9 @@ class TestMessageExportWorker(VumiTestCase):
         addr = port.getHost()
         self.url = 'http://%s:%s' % (addr.host, addr.port)
 
+        self.worker_store = worker.store
         self.worker_backend = worker.store.riak_backend
+        self.worker_job_scheduler = worker.job_scheduler
 
         self.addCleanup(self.stop_server, port)
 
@@ -65,30 +84,59 @@ class TestMessageExportWorker(VumiTestCase):
     def make_batch(self, tag):
         return self.batch_manager.batch_start([tag])
 
-    def make_outbound(self, batch_id, content, timestamp=None):
+    def make_outbound(self, batch_id, content, timestamp=None, **kw):
         if timestamp is None:
             timestamp = datetime.utcnow()
-        msg = self.msg_helper.make_outbound(content, timestamp=timestamp)
+        msg = self.msg_helper.make_outbound(content, timestamp=timestamp, **kw)
         d = self.operational_store.add_outbound_message(msg,
                                                         batch_ids=[batch_id])
         d.addCallback(lambda _: msg)
         return d
 
-    def make_inbound(self, batch_id, content, timestamp=None):
+    def make_inbound(self, batch_id, content, timestamp=None, **kw):
         if timestamp is None:
             timestamp = datetime.utcnow()
-        msg = self.msg_helper.make_inbound(content, timestamp=timestamp)
+        msg = self.msg_helper.make_inbound(content, timestamp=timestamp, **kw)
         d = self.operational_store.add_inbound_message(msg,
                                                        batch_ids=[batch_id])
         d.addCallback(lambda _: msg)
         return d
 
+    def make_event(self, batch_id, event):
+        d = self.operational_store.add_event(event, batch_ids=[batch_id])
+        d.addCallback(lambda _: event)
+        return d
+
     def make_request(self, method, batch_id, leaf, **params):
         url = '%s/%s/%s/%s' % (self.url, 'resource_path', batch_id, leaf)
         if params:
             url = '%s?%s' % (url, urlencode(params))
         return http_request_full(method=method, url=url)
 
+    @inlineCallbacks
+    def make_undecoded_request(self, batch_id, leaf, headers={}, **params):
+        """
+        Make a GET request with a plain agent, which neither asks for nor
+        decodes compressed responses the way :func:`http_request_full` does.
+        """
+        url = '%s/%s/%s/%s' % (self.url, 'resource_path', batch_id, leaf)
+        if params:
+            url = '%s?%s' % (url, urlencode(params))
+        agent = Agent(
+            reactor, pool=HTTPConnectionPool(reactor, persistent=False))
+        resp = yield agent.request('GET', url, Headers(dict(
+            (name, [value]) for name, value in headers.iteritems())))
+        body = yield readBody(resp)
+        returnValue((resp, body))
+
+    def read_job_files(self, job):
+        data = []
+        for filename in job.writer.filenames:
+            f = gzip.GzipFile(os.path.join(job.path, filename))
+            data.append(f.read())
+            f.close()
+        return ''.join(data)
+
     def get_batch_resource(self, batch_id):
         return self.store_resource.getChild(batch_id, None)
 
@@ -100,6 +148,24 @@ class TestMessageExportWorker(VumiTestCase):
             } for row_template, msg in expected
         ]))
 
+    @inlineCallbacks
+    def test_invalid_reorder_buffer_size(self):
+        """
+        The reorder buffer must have room for at least one message, or
+        ordered exports would never make progress.
+        """
+        yield self.assertFailure(
+            self.start_server(reorder_buffer_size=0), ConfigError)
+
+    @inlineCallbacks
+    def test_invalid_max_concurrent_fetches(self):
+        """
+        The limit on concurrent fetches must allow at least one fetch, or
+        exports would never make progress.
+        """
+        yield self.assertFailure(
+            self.start_server(max_concurrent_fetches=0), ConfigError)
+
     @inlineCallbacks
     def test_get_invalid_path(self):
         """
@@ -221,6 +287,125 @@ class TestMessageExportWorker(VumiTestCase):
             ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg2),
         ])
 
+    @inlineCallbacks
+    def test_get_outbound_columns_json(self):
+        """
+        Fetch some outbound messages via the export API in columnar JSON
+        format, with one row group for each index page.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 2
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for i in range(3):
+            msg = yield self.make_outbound(batch_id, 'føø')
+            msgs.append(msg)
+        resp = yield self.make_request(
+            'GET', batch_id, 'outbound.columns.json')
+        row_groups = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [row_group['num_rows'] for row_group in row_groups], [2, 1])
+        self.assertEqual(
+            sorted(sum([
+                row_group['columns']['message_id']
+                for row_group in row_groups], [])),
+            sorted(msg['message_id'] for msg in msgs))
+        self.assertEqual(
+            set(sum([
+                row_group['columns']['content']
+                for row_group in row_groups], [])),
+            set([u'føø']))
+
+    @inlineCallbacks
+    def test_get_events(self):
+        """
+        Fetch some events via the export API in JSON format.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø')
+        ack = yield self.make_event(batch_id, self.msg_helper.make_ack(msg))
+        dr = yield self.make_event(
+            batch_id, self.msg_helper.make_delivery_report(msg))
+        resp = yield self.make_request('GET', batch_id, 'events.json')
+        events = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            sorted(events, key=lambda event: event['event_id']),
+            sorted([json.loads(ack.to_json()), json.loads(dr.to_json())],
+                   key=lambda event: event['event_id']))
+
+    @inlineCallbacks
+    def test_get_events_csv(self):
+        """
+        Fetch some events via the export API in CSV format.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø')
+        ack = yield self.make_event(batch_id, self.msg_helper.make_ack(msg))
+        resp = yield self.make_request('GET', batch_id, 'events.csv')
+        self.assertEqual(resp.delivered_body, (
+            "timestamp,event_id,event_type,user_message_id,sent_message_id,"
+            "delivery_status,nack_reason\r\n"
+            "%s,%s,ack,%s,%s,,\r\n" % (
+                ack['timestamp'].isoformat(), ack['event_id'],
+                msg['message_id'], ack['sent_message_id'])))
+
+    @inlineCallbacks
+    def test_get_outbound_status(self):
+        """
+        Fetch some outbound messages with the status of their latest events
+        via the export API in JSON format.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_outbound(batch_id, 'føø')
+        msg2 = yield self.make_outbound(batch_id, 'føø')
+        yield self.make_event(batch_id, self.msg_helper.make_ack(
+            msg1, timestamp=datetime(2014, 11, 1, 12, 0, 0)))
+        yield self.make_event(batch_id, self.msg_helper.make_delivery_report(
+            msg1, timestamp=datetime(2014, 11, 1, 12, 0, 5)))
+        resp = yield self.make_request(
+            'GET', batch_id, 'outbound_status.json')
+        rows = map(json.loads, filter(None, resp.delivered_body.split('\n')))
+        rows = dict((row['message']['message_id'], row) for row in rows)
+        self.assertEqual(rows, {
+            msg1['message_id']: {
+                'message': json.loads(msg1.to_json()),
+                'status_timestamp': '2014-11-01 12:00:05.000000',
+                'status': 'delivery_report.delivered',
+            },
+            msg2['message_id']: {
+                'message': json.loads(msg2.to_json()),
+                'status_timestamp': None,
+                'status': None,
+            },
+        })
+
+    @inlineCallbacks
+    def test_get_outbound_status_csv(self):
+        """
+        Fetch some outbound messages with the status of their latest events
+        via the export API in CSV format.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø')
+        yield self.make_event(batch_id, self.msg_helper.make_ack(
+            msg, timestamp=datetime(2014, 11, 1, 12, 0, 0)))
+        resp = yield self.make_request('GET', batch_id, 'outbound_status.csv')
+        rows = resp.delivered_body.split('\r\n')
+        header, rows = rows[0], rows[1:-1]
+        self.assertEqual(header, (
+            "timestamp,message_id,to_addr,from_addr,in_reply_to,session_event,"
+            "content,group,status_timestamp,status"))
+        self.assert_csv_rows(rows, [
+            ("%(ts)s,%(id)s,+41791234567,9292,,,føø,,"
+             "2014-11-01 12:00:00.000000,ack", msg),
+        ])
+
     @inlineCallbacks
     def test_get_inbound_multiple_pages(self):
         """
@@ -229,7 +414,7 @@ class TestMessageExportWorker(VumiTestCase):
         """
         yield self.start_server()
         # Poke at the riak backend to ensure multiple pages are transferred
-        self.worker_backend.DEFAULT_MAX_RESULTS = 1
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
         batch_id = yield self.make_batch(('foo', 'bar'))
         msg1 = yield self.make_inbound(batch_id, 'føø')
         msg2 = yield self.make_inbound(batch_id, 'føø')
@@ -240,6 +425,829 @@ class TestMessageExportWorker(VumiTestCase):
             set([msg['message_id'] for msg in messages]),
             set([msg1['message_id'], msg2['message_id']]))
 
+    @inlineCallbacks
+    def test_get_inbound_json_skips_deserialisation(self):
+        """
+        JSON exports write the stored message JSON without building message
+        objects.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø')
+
+        def get_inbound_message(msg_id):
+            raise Exception("Message objects shouldn't be built.")
+
+        self.patch(
+            self.worker_store, 'get_inbound_message', get_inbound_message)
+        resp = yield self.make_request('GET', batch_id, 'inbound.json')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(messages, [json.loads(msg.to_json())])
+
+    @inlineCallbacks
+    def test_get_inbound_json_gz(self):
+        """
+        Fetch some inbound messages as a gzipped JSON file.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_inbound(batch_id, 'føø')
+        msg2 = yield self.make_inbound(batch_id, 'føø')
+        resp, body = yield self.make_undecoded_request(
+            batch_id, 'inbound.json.gz')
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'), ['application/gzip'])
+        self.assertEqual(resp.headers.getRawHeaders('Content-Encoding'), None)
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        messages = map(json.loads, filter(None, body.split('\n')))
+        self.assertEqual(
+            set([msg['message_id'] for msg in messages]),
+            set([msg1['message_id'], msg2['message_id']]))
+
+    @inlineCallbacks
+    def test_get_outbound_csv_gz(self):
+        """
+        Fetch some outbound messages as a gzipped CSV file.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_outbound(batch_id, 'føø')
+        msg2 = yield self.make_outbound(batch_id, 'føø')
+        resp, body = yield self.make_undecoded_request(
+            batch_id, 'outbound.csv.gz')
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'), ['application/gzip'])
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        rows = body.split('\r\n')
+        header, rows = rows[0], rows[1:-1]
+        self.assertEqual(header, (
+            "timestamp,message_id,to_addr,from_addr,in_reply_to,session_event,"
+            "content,group"))
+        self.assert_csv_rows(rows, [
+            ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg1),
+            ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg2),
+        ])
+
+    @inlineCallbacks
+    def test_get_invalid_gz_path(self):
+        """
+        Only known exports are available gzipped.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request('GET', batch_id, 'inbound.xml.gz')
+        self.assertEqual(resp.code, http.NOT_FOUND)
+        resp = yield self.make_request('GET', batch_id, 'inbound.json.gz.gz')
+        self.assertEqual(resp.code, http.NOT_FOUND)
+
+    @inlineCallbacks
+    def test_get_inbound_accept_encoding_gzip(self):
+        """
+        If the client accepts gzip, the export is sent with a gzip content
+        encoding.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø')
+        resp, body = yield self.make_undecoded_request(
+            batch_id, 'inbound.json',
+            headers={'Accept-Encoding': 'deflate, gzip'})
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['application/json; charset=utf-8'])
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Encoding'), ['gzip'])
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.assertEqual(
+            map(json.loads, filter(None, body.split('\n'))),
+            [json.loads(msg.to_json())])
+
+    @inlineCallbacks
+    def test_get_inbound_no_accept_encoding(self):
+        """
+        If the client doesn't ask for gzip, the export isn't compressed.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø')
+        resp, body = yield self.make_undecoded_request(
+            batch_id, 'inbound.json')
+        self.assertEqual(resp.headers.getRawHeaders('Content-Encoding'), None)
+        self.assertEqual(
+            map(json.loads, filter(None, body.split('\n'))),
+            [json.loads(msg.to_json())])
+
+    @inlineCallbacks
+    def test_get_inbound_accept_encoding_gzip_refused(self):
+        """
+        If the client refuses gzip, the export isn't compressed.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø')
+        resp, body = yield self.make_undecoded_request(
+            batch_id, 'inbound.json',
+            headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertEqual(resp.headers.getRawHeaders('Content-Encoding'), None)
+        self.assertEqual(
+            map(json.loads, filter(None, body.split('\n'))),
+            [json.loads(msg.to_json())])
+
+    def track_concurrent_fetches(self):
+        """
+        Patch the worker's message store to record the number of inbound
+        messages being fetched at once.
+        """
+        fetching = []
+        max_fetching = [0]
+        get_inbound_message = self.worker_store.get_inbound_message_json
+
+        def done(result, msg_id):
+            fetching.remove(msg_id)
+            return result
+
+        def get_message(msg_id):
+            fetching.append(msg_id)
+            max_fetching[0] = max(max_fetching[0], len(fetching))
+            d = get_inbound_message(msg_id)
+            return d.addBoth(done, msg_id)
+
+        self.patch(self.worker_store, 'get_inbound_message_json', get_message)
+        return max_fetching
+
+    @inlineCallbacks
+    def test_get_inbound_fetch_failed(self):
+        """
+        If a message can't be fetched, the failure is logged and the export
+        fails instead of finishing without the message.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        yield self.make_inbound(batch_id, 'føø')
+        yield self.make_inbound(batch_id, 'føø')
+        get_inbound_message = self.worker_store.get_inbound_message_json
+        fetched = []
+
+        def get_message(msg_id):
+            fetched.append(msg_id)
+            if len(fetched) == 2:
+                return fail(Exception("Riak is down."))
+            return get_inbound_message(msg_id)
+
+        self.patch(self.worker_store, 'get_inbound_message_json', get_message)
+        d = self.make_undecoded_request(batch_id, 'inbound.json')
+        yield self.assertFailure(d, ResponseFailed)
+        self.assertEqual(len(fetched), 2)
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak is down.")
+
+    @inlineCallbacks
+    def test_get_inbound_export_failed_before_writing(self):
+        """
+        If the export fails before anything has been written, the failure is
+        logged and an error response is returned.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        self.patch(
+            self.worker_store, 'list_batch_inbound_messages',
+            lambda *a, **kw: fail(Exception("Riak is down.")))
+        resp = yield self.make_request('GET', batch_id, 'inbound.json')
+        self.assertEqual(resp.code, 500)
+        self.assertEqual(resp.delivered_body, 'Export failed')
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak is down.")
+
+    @inlineCallbacks
+    def test_get_inbound_export_failed_while_writing(self):
+        """
+        If the export fails after the response has been started, the failure
+        is logged and the connection is closed without finishing the
+        response.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        yield self.make_inbound(batch_id, 'føø')
+        yield self.make_inbound(batch_id, 'føø')
+        self.patch(
+            IndexPageWrapper, 'next_page',
+            lambda self: fail(Exception("Riak is down.")))
+        d = self.make_undecoded_request(batch_id, 'inbound.csv')
+        yield self.assertFailure(d, ResponseFailed)
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak is down.")
+
+    @inlineCallbacks
+    def test_get_inbound_export_concurrency(self):
+        """
+        No more than the configured number of messages are fetched at once for
+        an export.
+        """
+        yield self.start_server(export_concurrency=2)
+        max_fetching = self.track_concurrent_fetches()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for i in range(5):
+            msg = yield self.make_inbound(batch_id, 'føø')
+            msgs.append(msg)
+        resp = yield self.make_request('GET', batch_id, 'inbound.json')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            set([msg['message_id'] for msg in messages]),
+            set([msg['message_id'] for msg in msgs]))
+        self.assertEqual(max_fetching[0], 2)
+
+    @inlineCallbacks
+    def test_get_inbound_max_concurrent_fetches(self):
+        """
+        No more than the configured number of messages are fetched at once
+        across all exports.
+        """
+        yield self.start_server(
+            export_concurrency=5, max_concurrent_fetches=1)
+        max_fetching = self.track_concurrent_fetches()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        for i in range(3):
+            yield self.make_inbound(batch_id, 'føø')
+        resp1, resp2 = yield gatherResults([
+            self.make_request('GET', batch_id, 'inbound.json'),
+            self.make_request('GET', batch_id, 'inbound.json'),
+        ])
+        for resp in [resp1, resp2]:
+            messages = filter(None, resp.delivered_body.split('\n'))
+            self.assertEqual(len(messages), 3)
+        self.assertEqual(max_fetching[0], 1)
+
+    @inlineCallbacks
+    def test_get_outbound_status_max_concurrent_fetches(self):
+        """
+        The event index query for each message's status is limited along
+        with the message fetches.
+        """
+        yield self.start_server(
+            export_concurrency=5, max_concurrent_fetches=1)
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        for i in range(3):
+            yield self.make_outbound(batch_id, 'føø')
+
+        querying = []
+        max_querying = [0]
+        list_message_events = self.worker_store.list_message_events
+
+        def done(result, msg_id):
+            querying.remove(msg_id)
+            return result
+
+        def list_events(msg_id):
+            querying.append(msg_id)
+            max_querying[0] = max(max_querying[0], len(querying))
+            d = list_message_events(msg_id)
+            return d.addBoth(done, msg_id)
+
+        self.patch(self.worker_store, 'list_message_events', list_events)
+        resp = yield self.make_request(
+            'GET', batch_id, 'outbound_status.json')
+        rows = filter(None, resp.delivered_body.split('\n'))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(max_querying[0], 1)
+
+    @inlineCallbacks
+    def test_get_inbound_ordered(self):
+        """
+        If the ``ordered`` parameter is set, messages are written in
+        descending timestamp order even if they're fetched in a different
+        order.
+        """
+        yield self.start_server(export_concurrency=5)
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for day in range(1, 6):
+            msg = yield self.make_inbound(
+                batch_id, 'føø', timestamp=datetime(2014, 11, day, 12, 0, 0))
+            msgs.append(msg)
+
+        # Hold back all the fetches and then finish them in reverse order.
+        pending = []
+        get_inbound_message = self.worker_store.get_inbound_message_json
+
+        def get_message(msg_id):
+            d = Deferred()
+            pending.append((d, msg_id))
+            if len(pending) == len(msgs):
+                for d_pending, pending_id in reversed(pending):
+                    get_inbound_message(pending_id).chainDeferred(d_pending)
+            return d
+
+        self.patch(self.worker_store, 'get_inbound_message_json', get_message)
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', ordered='true')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [msg['message_id'] for msg in messages],
+            [msg['message_id'] for msg in reversed(msgs)])
+
+    @inlineCallbacks
+    def test_get_inbound_ordered_multiple_pages(self):
+        """
+        Ordered exports keep their order across pages, even when the reorder
+        buffer is smaller than the page.
+        """
+        yield self.start_server(reorder_buffer_size=1)
+        self.worker_backend.DEFAULT_PAGE_SIZE = 2
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for day in range(1, 6):
+            msg = yield self.make_inbound(
+                batch_id, 'føø', timestamp=datetime(2014, 11, day, 12, 0, 0))
+            msgs.append(msg)
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', ordered='true')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [msg['message_id'] for msg in messages],
+            [msg['message_id'] for msg in reversed(msgs)])
+
+    @inlineCallbacks
+    def test_get_inbound_ordered_bad_args(self):
+        """
+        The server rejects requests with an invalid ``ordered`` parameter and
+        returns a 400 response code.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', ordered='yes')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'ordered' parameter: Must be 'true' or 'false'")
+
+    @inlineCallbacks
+    def test_get_inbound_fields(self):
+        """
+        Only the requested fields are exported in JSON format.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø')
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', fields='message_id,content')
+        self.assertEqual(resp.delivered_body, (
+            '{"message_id": "%s", "content": "f\\u00f8\\u00f8"}\n' % (
+                msg['message_id'],)))
+
+    @inlineCallbacks
+    def test_get_outbound_csv_fields(self):
+        """
+        Only the requested columns are exported in CSV format, in the order
+        they were requested.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø')
+        resp = yield self.make_request(
+            'GET', batch_id, 'outbound.csv', fields='content,message_id')
+        self.assertEqual(
+            resp.delivered_body,
+            "content,message_id\r\nføø,%s\r\n" % (msg['message_id'],))
+
+    @inlineCallbacks
+    def test_get_inbound_fields_bad_args(self):
+        """
+        The server rejects requests for unknown fields and returns a 400
+        response code.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.csv', fields='content,foo')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'fields' parameter: Unknown fields: foo")
+
+    @inlineCallbacks
+    def test_get_inbound_addr_filter(self):
+        """
+        Only messages from the requested addresses are exported, and other
+        messages are never fetched.
+        """
+        yield self.start_server()
+        fetched = []
+        get_inbound_message = self.worker_store.get_inbound_message_json
+
+        def get_message(msg_id):
+            fetched.append(msg_id)
+            return get_inbound_message(msg_id)
+
+        self.patch(self.worker_store, 'get_inbound_message_json', get_message)
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_inbound(batch_id, 'føø', from_addr='+1')
+        msg2 = yield self.make_inbound(batch_id, 'føø', from_addr='+2')
+        yield self.make_inbound(batch_id, 'føø', from_addr='+3')
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json?addr=%2B1&addr=%2B2')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            set([msg['message_id'] for msg in messages]),
+            set([msg1['message_id'], msg2['message_id']]))
+        self.assertEqual(
+            sorted(fetched), sorted([msg1['message_id'], msg2['message_id']]))
+
+    @inlineCallbacks
+    def test_get_outbound_addr_filter(self):
+        """
+        Only messages to the requested address are exported.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø', to_addr='+1')
+        yield self.make_outbound(batch_id, 'føø', to_addr='+2')
+        resp = yield self.make_request(
+            'GET', batch_id, 'outbound.json', addr='+1')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [m['message_id'] for m in messages], [msg['message_id']])
+
+    @inlineCallbacks
+    def test_get_inbound_session_event_filter(self):
+        """
+        Only messages with the requested session event are exported.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø', session_event='new')
+        yield self.make_inbound(batch_id, 'føø', session_event='resume')
+        yield self.make_inbound(batch_id, 'føø')
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.csv', session_event='new')
+        rows = resp.delivered_body.split('\r\n')[1:-1]
+        self.assert_csv_rows(rows, [
+            ("%(ts)s,%(id)s,9292,+41791234567,,new,føø,", msg),
+        ])
+
+    @inlineCallbacks
+    def test_get_outbound_group_filter(self):
+        """
+        Only messages in the requested group are exported.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø', group='g1')
+        yield self.make_outbound(batch_id, 'føø', group='g2')
+        yield self.make_outbound(batch_id, 'føø')
+        resp = yield self.make_request(
+            'GET', batch_id, 'outbound.json', group='g1')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [m['message_id'] for m in messages], [msg['message_id']])
+
+    @inlineCallbacks
+    def test_get_events_filter_bad_args(self):
+        """
+        The server rejects filters on exports that don't support them and
+        returns a 400 response code.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request(
+            'GET', batch_id, 'events.json', addr='+1')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'addr' parameter: Not supported for this export")
+
+    @inlineCallbacks
+    def test_get_inbound_with_cursors(self):
+        """
+        If cursors are requested, one is written after each index page except
+        the last.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 2
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        for i in range(5):
+            yield self.make_inbound(batch_id, 'føø')
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', with_cursors='true')
+        lines = map(json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            ['cursor' in line for line in lines],
+            [False, False, True, False, False, True, False])
+
+    @inlineCallbacks
+    def test_get_inbound_resume_from_cursor(self):
+        """
+        An export resumed from a cursor continues exactly where the cursor
+        was written.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 2
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for day in range(1, 6):
+            msg = yield self.make_inbound(
+                batch_id, 'føø', timestamp=datetime(2014, 11, day, 12, 0, 0))
+            msgs.append(msg)
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', ordered='true',
+            with_cursors='true')
+        lines = map(json.loads, filter(None, resp.delivered_body.split('\n')))
+        cursor = lines[2]['cursor']
+
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', ordered='true', cursor=cursor)
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [msg['message_id'] for msg in messages],
+            [msg['message_id'] for msg in reversed(msgs[:3])])
+
+    @inlineCallbacks
+    def test_get_inbound_bad_cursor(self):
+        """
+        The server rejects requests with a malformed ``cursor`` parameter and
+        returns a 400 response code.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.csv', cursor='not a cursor!')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'cursor' parameter: Not a valid cursor")
+
+    @inlineCallbacks
+    def test_get_inbound_cursor_rejected(self):
+        """
+        If Riak rejects a well-formed cursor, the server returns a 400
+        response code.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        self.patch(
+            self.worker_store, 'list_batch_inbound_messages',
+            lambda *a, **kw: fail(VumiRiakError("Bad continuation.")))
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', cursor='Zm9vYmFy')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'cursor' parameter: Bad continuation.")
+
+    @inlineCallbacks
+    def test_get_inbound_csv_resume_from_cursor(self):
+        """
+        A resumed CSV export doesn't repeat the header row, so it can be
+        appended to the interrupted export.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_inbound(
+            batch_id, 'føø', timestamp=datetime(2014, 11, 1, 12, 0, 0))
+        yield self.make_inbound(
+            batch_id, 'føø', timestamp=datetime(2014, 11, 2, 12, 0, 0))
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.csv', with_cursors='true')
+        rows = resp.delivered_body.split('\r\n')
+        self.assertTrue(rows[2].startswith('#cursor,'))
+        cursor = rows[2][len('#cursor,'):]
+
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.csv', cursor=cursor)
+        self.assertEqual(
+            resp.delivered_body.split('\r\n')[:-1],
+            ["%s,%s,9292,+41791234567,,,føø," % (
+                msg1['timestamp'].isoformat(), msg1['message_id'])])
+
+    @inlineCallbacks
+    def test_get_inbound_sharded(self):
+        """
+        A sharded export scans its shards concurrently and writes every
+        message in descending timestamp order.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for day in range(1, 7):
+            msg = yield self.make_inbound(
+                batch_id, 'føø', timestamp=datetime(2014, 11, day, 12, 0, 0))
+            msgs.append(msg)
+
+        # Hold back the first page of each shard until every shard has asked
+        # for one.
+        listed = []
+        list_inbound = self.worker_store.list_batch_inbound_messages
+
+        def list_batch_inbound_messages(batch_id, start=None, end=None,
+                                        continuation=None):
+            d = Deferred()
+            listed.append((d, start, end))
+            if len(listed) == 3:
+                for d_listed, start, end in listed:
+                    list_inbound(batch_id, start=start, end=end).chainDeferred(
+                        d_listed)
+            return d
+
+        self.patch(
+            self.worker_store, 'list_batch_inbound_messages',
+            list_batch_inbound_messages)
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', start='2014-11-01 00:00:00',
+            end='2014-11-07 00:00:00', shards='3')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            [msg['message_id'] for msg in messages],
+            [msg['message_id'] for msg in reversed(msgs)])
+        self.assertEqual([(start, end) for _, start, end in listed], [
+            ('2014-11-05 00:00:00.000000', '2014-11-07 00:00:00.000000'),
+            ('2014-11-03 00:00:00.000000', '2014-11-04 23:59:59.000000'),
+            ('2014-11-01 00:00:00.000000', '2014-11-02 23:59:59.000000'),
+        ])
+
+    @inlineCallbacks
+    def test_get_inbound_csv_sharded(self):
+        """
+        A sharded CSV export writes the header once, followed by every
+        message.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_inbound(
+            batch_id, 'føø', timestamp=datetime(2014, 11, 1, 12, 0, 0))
+        msg2 = yield self.make_inbound(
+            batch_id, 'føø', timestamp=datetime(2014, 11, 3, 12, 0, 0))
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.csv', start='2014-11-01 00:00:00',
+            end='2014-11-04 00:00:00', shards='2')
+        rows = resp.delivered_body.split('\r\n')
+        header, rows = rows[0], rows[1:-1]
+        self.assertEqual(header, (
+            "timestamp,message_id,to_addr,from_addr,in_reply_to,session_event,"
+            "content,group"))
+        self.assertEqual(rows, [
+            "%s,%s,9292,+41791234567,,,føø," % (
+                msg['timestamp'].isoformat(), msg['message_id'])
+            for msg in [msg2, msg1]])
+
+    @inlineCallbacks
+    def test_get_inbound_sharded_shard_failed(self):
+        """
+        If a shard fails, the other shards stop scanning and the export
+        fails instead of waiting for them forever.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        for day in range(1, 7):
+            yield self.make_inbound(
+                batch_id, 'føø', timestamp=datetime(2014, 11, day, 12, 0, 0))
+
+        scans = []
+        scan_shard = InboundResource._scan_shard
+
+        def _scan_shard(*args):
+            d = scan_shard(*args)
+            scans.append(d)
+            return d
+
+        self.patch(InboundResource, '_scan_shard', _scan_shard)
+
+        # Fail the newest shard once the others are waiting for slots.
+        listed = []
+        waiting = []
+
+        class Slots(DeferredSemaphore):
+            def acquire(self):
+                d = DeferredSemaphore.acquire(self)
+                if not d.called:
+                    waiting.append(d)
+                    if len(waiting) == 2:
+                        reactor.callLater(
+                            0, listed[0].errback, Exception("Riak is down."))
+                return d
+
+        self.patch(message_export_resources, 'DeferredSemaphore', Slots)
+
+        list_inbound = self.worker_store.list_batch_inbound_messages
+
+        def list_batch_inbound_messages(batch_id, start=None, end=None,
+                                        continuation=None):
+            if listed:
+                return list_inbound(batch_id, start=start, end=end)
+            d = Deferred()
+            listed.append(d)
+            return d
+
+        self.patch(
+            self.worker_store, 'list_batch_inbound_messages',
+            list_batch_inbound_messages)
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', start='2014-11-01 00:00:00',
+            end='2014-11-07 00:00:00', shards='3')
+        self.assertEqual(resp.code, 500)
+        # The other scans would wait forever if they weren't stopped.
+        yield gatherResults(scans)
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak is down.")
+
+    @inlineCallbacks
+    def test_get_inbound_sharded_concurrency(self):
+        """
+        The shards of a sharded export share the export's limit on messages
+        being fetched at once.
+        """
+        yield self.start_server(export_concurrency=2)
+        max_fetching = self.track_concurrent_fetches()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for day in range(1, 5):
+            for hour in range(3):
+                msg = yield self.make_inbound(
+                    batch_id, 'føø',
+                    timestamp=datetime(2014, 11, day, hour, 0, 0))
+                msgs.append(msg)
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', start='2014-11-01 00:00:00',
+            end='2014-11-05 00:00:00', shards='4')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            set([msg['message_id'] for msg in messages]),
+            set([msg['message_id'] for msg in msgs]))
+        self.assertEqual(max_fetching[0], 2)
+
+    @inlineCallbacks
+    def test_get_inbound_sharded_next_page_failed(self):
+        """
+        If fetching the next page fails for shards that have already been
+        stopped, only the failure that ended the export is logged.
+        """
+        yield self.start_server()
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        for day in range(1, 7):
+            yield self.make_inbound(
+                batch_id, 'føø', timestamp=datetime(2014, 11, day, 12, 0, 0))
+        self.patch(
+            IndexPageWrapper, 'next_page',
+            lambda self: fail(Exception("Riak is down.")))
+        d = self.make_undecoded_request(
+            batch_id, 'inbound.json', start='2014-11-01 00:00:00',
+            end='2014-11-07 00:00:00', shards='3')
+        yield self.assertFailure(d, ResponseFailed)
+        # Unhandled failures are only logged once they're garbage collected.
+        gc.collect()
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak is down.")
+
+    @inlineCallbacks
+    def test_get_inbound_sharded_bad_args(self):
+        """
+        The server rejects sharded export requests with invalid arguments and
+        returns a 400 response code.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        start, end = '2014-11-01 00:00:00', '2014-11-04 00:00:00'
+
+        for shards in ['foo', '0', '17']:
+            resp = yield self.make_request(
+                'GET', batch_id, 'inbound.json', start=start, end=end,
+                shards=shards)
+            self.assertEqual(resp.code, 400)
+            self.assertEqual(
+                resp.delivered_body,
+                "Invalid 'shards' parameter: Must be an integer from 1 to 16")
+
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', start=start, shards='2')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'shards' parameter: 'start' and 'end' are required")
+
+        resp = yield self.make_request(
+            'GET', batch_id, 'inbound.json', start=start, end=end, shards='2',
+            with_cursors='true')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'shards' parameter: Sharded exports can't be resumed")
+
     def test_connection_drop_during_page_iteration_stops(self):
         """
         If the connection drops while the server is iterating through index
@@ -488,3 +1496,136 @@ class TestMessageExportWorker(VumiTestCase):
             ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg2),
             ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg3),
         ])
+
+    @inlineCallbacks
+    def test_export_job(self):
+        """
+        Start an export job and fetch its status once it's done. The export
+        is written to local gzip files, with a new file for each chunk.
+        """
+        yield self.start_server(
+            export_job_dir=self.mktemp(), export_job_chunk_size=50)
+        self.worker_backend.DEFAULT_PAGE_SIZE = 1
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msgs = []
+        for i in range(3):
+            msg = yield self.make_inbound(batch_id, 'føø')
+            msgs.append(msg)
+        resp = yield self.make_request('POST', batch_id, 'jobs/inbound.csv')
+        self.assertEqual(resp.code, 202)
+        self.assertEqual(
+            resp.headers.getRawHeaders('content-type'),
+            ['application/json; charset=utf-8'])
+        job_status = json.loads(resp.delivered_body)
+        self.assertEqual(job_status['batch_id'], batch_id)
+        self.assertEqual(job_status['export'], 'inbound.csv')
+        self.assertEqual(job_status['status'], 'running')
+
+        job = self.worker_job_scheduler.get_job(job_status['job_id'])
+        yield job.notify_finished()
+        resp = yield self.make_request(
+            'GET', batch_id, 'jobs/%s' % (job_status['job_id'],))
+        self.assertEqual(resp.code, 200)
+        job_status = json.loads(resp.delivered_body)
+        self.assertEqual(job_status['status'], 'done')
+        self.assertEqual(job_status['messages_exported'], 3)
+        self.assertEqual(len(job_status['files']), 4)
+        self.assertEqual(job_status['files'][0], 'inbound-00000.csv.gz')
+        self.assertEqual(job_status['files'], job.writer.filenames)
+        self.assertNotIn('path', job_status)
+
+        rows = self.read_job_files(job).split('\r\n')
+        header, rows = rows[0], rows[1:-1]
+        self.assertEqual(header, (
+            "timestamp,message_id,to_addr,from_addr,in_reply_to,session_event,"
+            "content,group"))
+        self.assert_csv_rows(rows, [
+            ("%(ts)s,%(id)s,9292,+41791234567,,,føø,", msg)
+            for msg in msgs])
+
+    @inlineCallbacks
+    def test_export_job_with_params(self):
+        """
+        Export jobs take the same parameters as exports over HTTP.
+        """
+        yield self.start_server(export_job_dir=self.mktemp())
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_outbound(batch_id, 'føø', to_addr='+1')
+        yield self.make_outbound(batch_id, 'føø', to_addr='+2')
+        resp = yield self.make_request(
+            'POST', batch_id, 'jobs/outbound.json', addr='+1',
+            fields='message_id')
+        job_status = json.loads(resp.delivered_body)
+        job = self.worker_job_scheduler.get_job(job_status['job_id'])
+        yield job.notify_finished()
+        self.assertEqual(
+            self.read_job_files(job),
+            '{"message_id": "%s"}\n' % (msg['message_id'],))
+
+    @inlineCallbacks
+    def test_export_job_bad_args(self):
+        """
+        The server rejects export jobs with invalid parameters and returns a
+        400 response code.
+        """
+        yield self.start_server(export_job_dir=self.mktemp())
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request(
+            'POST', batch_id, 'jobs/inbound.json', ordered='yes')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(
+            resp.delivered_body,
+            "Invalid 'ordered' parameter: Must be 'true' or 'false'")
+        self.assertEqual(self.worker_job_scheduler.jobs, {})
+
+    @inlineCallbacks
+    def test_export_job_invalid_paths(self):
+        """
+        Unknown exports, unknown jobs and jobs for other batches aren't found.
+        """
+        yield self.start_server(export_job_dir=self.mktemp())
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        other_batch_id = yield self.make_batch(('foo', 'baz'))
+        resp = yield self.make_request(
+            'POST', batch_id, 'jobs/inbound.json.gz')
+        self.assertEqual(resp.code, 404)
+        resp = yield self.make_request('GET', batch_id, 'jobs/unknown')
+        self.assertEqual(resp.code, 404)
+
+        resp = yield self.make_request('POST', batch_id, 'jobs/inbound.json')
+        job_id = json.loads(resp.delivered_body)['job_id']
+        yield self.worker_job_scheduler.get_job(job_id).notify_finished()
+        resp = yield self.make_request(
+            'GET', other_batch_id, 'jobs/%s' % (job_id,))
+        self.assertEqual(resp.code, 404)
+        resp = yield self.make_request('GET', batch_id, 'jobs/%s' % (job_id,))
+        self.assertEqual(resp.code, 200)
+
+    @inlineCallbacks
+    def test_export_job_expiry(self):
+        """
+        Finished jobs aren't found once they've expired.
+        """
+        yield self.start_server(
+            export_job_dir=self.mktemp(), export_job_expiry=60)
+        clock = self.worker_job_scheduler.clock = Clock()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request('POST', batch_id, 'jobs/inbound.json')
+        job_id = json.loads(resp.delivered_body)['job_id']
+        yield self.worker_job_scheduler.get_job(job_id).notify_finished()
+        resp = yield self.make_request('GET', batch_id, 'jobs/%s' % (job_id,))
+        self.assertEqual(resp.code, 200)
+
+        clock.advance(60)
+        resp = yield self.make_request('GET', batch_id, 'jobs/%s' % (job_id,))
+        self.assertEqual(resp.code, 404)
+
+    @inlineCallbacks
+    def test_export_jobs_disabled(self):
+        """
+        Export jobs aren't available if there's no export job directory.
+        """
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        resp = yield self.make_request('POST', batch_id, 'jobs/inbound.json')
+        self.assertEqual(resp.code, 404)
@@ -1,15 +1,21 @@
 # -*- test-case-name: vumi_message_store.tests.test_batch_info_cache -*-
 # -*- coding: utf-8 -*-
 
+import json
 from calendar import timegm
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha1
 
-from twisted.internet.defer import returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue
+from txredis.exceptions import NoScript
 
 from vumi.persist.redis_base import Manager
-from vumi.message import TransportEvent, VUMI_DATE_FORMAT
+from vumi.message import TransportEvent, VUMI_DATE_FORMAT, format_vumi_date
 from vumi.errors import VumiError
 
+from vumi_message_store.redis_commands import RedisCommands
+from vumi_message_store.utils import gather_results
+
 
 def to_timestamp(timestamp):
     """
@@ -23,14 +29,111 @@ def to_timestamp(timestamp):
     return timegm(timestamp.timetuple())
 
 
+def time_shard_ranges(boundaries):
+    """
+    Split time into contiguous (start, end) ranges at the given boundaries.
+
+    The first range has no start and the last range has no end, so together
+    the ranges cover everything. Index timestamps only have a resolution of
+    one second, so each range ends one second before the next one starts to
+    avoid overlaps.
+    """
+    starts = []
+    for boundary in boundaries:
+        if isinstance(boundary, basestring):
+            boundary = datetime.strptime(boundary, VUMI_DATE_FORMAT)
+        starts.append(boundary.replace(microsecond=0))
+    starts = sorted(set(starts))
+    ends = [format_vumi_date(start - timedelta(seconds=1)) for start in starts]
+    starts = [format_vumi_date(start) for start in starts]
+    return zip([None] + starts, ends + [None])
+
+
 class BatchInfoCacheException(VumiError):
     pass
 
 
+class RedisScript(object):
+    """
+    A Lua script that is invoked by its SHA1 digest and only sent to Redis
+    with ``SCRIPT LOAD`` when the server doesn't already have it cached.
+
+    NOTE: This requires a txredis client. Use
+          :meth:`vumi_message_store.redis_commands.RedisCommands.run_script`
+          to run it on a Redis manager's client.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha1 = sha1(source).hexdigest()
+
+    @inlineCallbacks
+    def __call__(self, client, keys=(), args=()):
+        try:
+            result = yield client.evalsha(self.sha1, keys, args)
+        except NoScript:
+            # The script cache is empty after a server restart or a
+            # SCRIPT FLUSH, so we load the script and try again.
+            yield client.script_load(self.source)
+            result = yield client.evalsha(self.sha1, keys, args)
+        returnValue(result)
+
+
+# KEYS: zset, counter, status hash
+# ARGV: truncate_at (0 to leave the zset as it is), followed by
+#       (member, score, event_type) triples where event_type is empty if there
+#       is no status to increment.
+ADD_KEYS_SCRIPT = RedisScript("""
+local added = 0
+for i = 2, #ARGV, 3 do
+    if redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i]) == 1 then
+        added = added + 1
+        local event_type = ARGV[i + 2]
+        if event_type ~= '' then
+            redis.call('HINCRBY', KEYS[3], event_type, 1)
+            if string.sub(event_type, 1, 16) == 'delivery_report.' then
+                redis.call('HINCRBY', KEYS[3], 'delivery_report', 1)
+            end
+        end
+    end
+end
+if added == 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[2], added)
+local truncate_at = tonumber(ARGV[1])
+if truncate_at > 0 and redis.call('ZCARD', KEYS[1]) > truncate_at then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -truncate_at - 1)
+end
+return added
+""")
+
+
+# KEYS: checkpoint, followed by (shadow key, live key) pairs
+SWAP_KEYS_SCRIPT = RedisScript("""
+redis.call('DEL', KEYS[1])
+for i = 2, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 1])
+    else
+        redis.call('DEL', KEYS[i + 1])
+    end
+end
+return (#KEYS - 1) / 2
+""")
+
+
 class BatchInfoCache(object):
     """
     Redis-based cache for assorted batch-related information that is expensive
     to acquire from Riak but useful to have low-latency access to.
+
+    If :attr:`USE_LUA_SCRIPTS` is set and the Redis client supports it,
+    adding a message or event key is done atomically in a single round trip
+    by a Lua script. Otherwise, independent Redis commands are issued together
+    instead of waiting for each response before sending the next command, so
+    a message costs at most two round trips: one for the zadd (and pfadd) and
+    one for the counter updates that depend on whether the key was new.
     """
     BATCH_KEY = 'batches'
     OUTBOUND_KEY = 'outbound'
@@ -42,12 +145,19 @@ class BatchInfoCache(object):
     EVENT_KEY = 'event'
     EVENT_COUNT_KEY = 'event_count'
     STATUS_KEY = 'status'
+    REBUILD_KEY = 'rebuild'
+    REBUILD_CHECKPOINT_KEY = 'rebuild_checkpoint'
+    REBUILD_WRITES_KEY = 'rebuild_writes'
     TRUNCATE_MESSAGE_KEY_ZSET_AT = 2000
+    # The scripts are only exercised against a real Redis server, which the
+    # test suite skips when there isn't one, so they're off by default.
+    USE_LUA_SCRIPTS = False
 
     def __init__(self, redis):
         # Store redis as `manager` as well since @Manager.calls_manager
         # requires it to be named as such.
         self.redis = self.manager = redis
+        self.redis_commands = RedisCommands(redis)
 
     def key(self, *args):
         return ':'.join([unicode(a) for a in args])
@@ -82,6 +192,28 @@ class BatchInfoCache(object):
     def event_count_key(self, batch_id):
         return self.batch_key(self.EVENT_COUNT_KEY, batch_id)
 
+    def rebuild_checkpoint_key(self, batch_id):
+        return self.batch_key(self.REBUILD_CHECKPOINT_KEY, batch_id)
+
+    def rebuild_writes_key(self, zset_key):
+        return self.key(zset_key, self.REBUILD_WRITES_KEY)
+
+    def cache_keys(self, batch_id):
+        """
+        Return a list of all the keys that hold cached data for a batch.
+        """
+        return [
+            self.inbound_key(batch_id),
+            self.inbound_count_key(batch_id),
+            self.outbound_key(batch_id),
+            self.outbound_count_key(batch_id),
+            self.event_key(batch_id),
+            self.event_count_key(batch_id),
+            self.status_key(batch_id),
+            self.from_addr_key(batch_id),
+            self.to_addr_key(batch_id),
+        ]
+
     def obsolete_keys(self, batch_id):
         """
         Return a list of obsolete keys that should be cleared.
@@ -91,6 +223,88 @@ class BatchInfoCache(object):
             self.batch_key("from_addr", batch_id),
         ]
 
+    def _use_scripts(self):
+        """
+        Return ``True`` if Lua scripts are enabled and can be run on our Redis
+        client.
+        """
+        return (self.USE_LUA_SCRIPTS and
+                self.redis_commands.supports_scripting())
+
+    @Manager.calls_manager
+    def _add_keys(self, batch_id, zset_key, count_key, entries,
+                  truncate=True):
+        """
+        Add keys, weighted with their timestamps, to a zset. For each key that
+        is new, increment the counter and the event status if an event_type is
+        given. The zset is truncated afterwards unless `truncate` is false.
+
+        While a resumable rebuild is running, the keys older than its cutoff
+        are also recorded for the rebuild, because its scans may already have
+        passed them and the keys we update here are replaced when it finishes.
+
+        :param entries:
+            Sequence of (key, timestamp, event_type) tuples. The event_type
+            may be ``None``.
+
+        :returns:
+            The number of new keys.
+        """
+        entries = [(key.encode('utf-8'), timestamp, event_type)
+                   for key, timestamp, event_type in entries]
+        if not entries:
+            returnValue(0)
+
+        added, cutoff = yield gather_results([
+            self._add_live_keys(
+                batch_id, zset_key, count_key, entries, truncate),
+            self.redis.hget(self.rebuild_checkpoint_key(batch_id), 'cutoff'),
+        ])
+        if cutoff is not None:
+            cutoff = to_timestamp(cutoff)
+            writes = dict(
+                (key, json.dumps([timestamp, event_type]))
+                for key, timestamp, event_type in entries
+                if timestamp <= cutoff)
+            if writes:
+                yield self.redis.hmset(
+                    self.rebuild_writes_key(zset_key), writes)
+        returnValue(added)
+
+    @Manager.calls_manager
+    def _add_live_keys(self, batch_id, zset_key, count_key, entries,
+                       truncate):
+        if self._use_scripts():
+            keys = [zset_key, count_key, self.status_key(batch_id)]
+            args = [self.TRUNCATE_MESSAGE_KEY_ZSET_AT if truncate else 0]
+            for key, timestamp, event_type in entries:
+                args.extend([key, timestamp, event_type or ''])
+            added = yield self.redis_commands.run_script(
+                ADD_KEYS_SCRIPT, keys, args)
+            returnValue(added)
+
+        # We can only tell how many keys a zadd added, not which ones, so we
+        # need a separate zadd for each event_type to count statuses.
+        keys_by_event_type = {}
+        for key, timestamp, event_type in entries:
+            keys_by_event_type.setdefault(event_type, {})[key] = timestamp
+        keys_by_event_type = keys_by_event_type.items()
+        added_counts = yield gather_results([
+            self.redis.zadd(zset_key, **keys)
+            for _, keys in keys_by_event_type])
+        added = sum(added_counts)
+        if added:
+            updates = [self.redis.incr(count_key, added)]
+            if truncate:
+                updates.append(self._truncate_keys(zset_key, None))
+            for (event_type, _), count in zip(
+                    keys_by_event_type, added_counts):
+                if event_type is not None and count:
+                    updates.append(self.increment_event_status(
+                        batch_id, event_type, count))
+            yield gather_results(updates)
+        returnValue(added)
+
     @Manager.calls_manager
     def _truncate_keys(self, redis_key, truncate_at):
         truncate_at = (truncate_at or self.TRUNCATE_MESSAGE_KEY_ZSET_AT)
@@ -125,13 +339,18 @@ class BatchInfoCache(object):
         yield self.redis.set(self.event_count_key(batch_id), 0)
         # If the status hash already exists and has any keys in it, this will
         # not reset those keys to zero.
-        events = (TransportEvent.EVENT_TYPES.keys() +
-                  ['delivery_report.%s' % status
-                   for status in TransportEvent.DELIVERY_STATUSES] +
-                  ['sent'])
-        for event in events:
+        for event in self._status_fields():
             yield self.redis.hsetnx(self.status_key(batch_id), event, 0)
 
+    def _status_fields(self):
+        """
+        Return the fields that the status hash for a batch starts with.
+        """
+        return (TransportEvent.EVENT_TYPES.keys() +
+                ['delivery_report.%s' % status
+                 for status in TransportEvent.DELIVERY_STATUSES] +
+                ['sent'])
+
     def batch_exists(self, batch_id):
         return self.redis.sismember(self.batch_key(), batch_id)
 
@@ -163,21 +382,37 @@ class BatchInfoCache(object):
         Add an inbound message to the cache for the given batch_id.
         """
         timestamp = to_timestamp(msg["timestamp"])
-        yield self.add_inbound_message_key(
-            batch_id, msg["message_id"], timestamp)
-        yield self.add_from_addr(batch_id, msg['from_addr'])
+        yield gather_results([
+            self.add_inbound_message_key(
+                batch_id, msg["message_id"], timestamp),
+            self.add_from_addr(batch_id, msg['from_addr']),
+        ])
 
-    @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
         """
-        new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
-            message_key.encode('utf-8'): timestamp,
-        })
-        if new_entry:
-            yield self.redis.incr(self.inbound_count_key(batch_id))
-            yield self.truncate_inbound_message_keys(batch_id)
+        return self._add_keys(
+            batch_id, self.inbound_key(batch_id),
+            self.inbound_count_key(batch_id),
+            [(message_key, timestamp, None)])
+
+    @Manager.calls_manager
+    def add_inbound_messages(self, batch_id, msgs):
+        """
+        Add several inbound messages to the cache for the given batch_id.
+
+        This updates each counter once for all the messages.
+        """
+        yield gather_results([
+            self._add_keys(
+                batch_id, self.inbound_key(batch_id),
+                self.inbound_count_key(batch_id),
+                [(msg["message_id"], to_timestamp(msg["timestamp"]), None)
+                 for msg in msgs]),
+            self.add_from_addr(
+                batch_id, *set(msg['from_addr'] for msg in msgs)),
+        ])
 
     def add_from_addr(self, batch_id, *from_addrs):
         """
@@ -186,7 +421,9 @@ class BatchInfoCache(object):
         if len(from_addrs) == 0:
             return
         from_addrs = [from_addr.encode('utf-8') for from_addr in from_addrs]
-        return self.redis.pfadd(self.from_addr_key(batch_id), *from_addrs)
+        return self._add_addrs(
+            batch_id, self.from_addr_key(batch_id),
+            self._rebuild_shadow().from_addr_key(batch_id), from_addrs)
 
     @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
@@ -194,22 +431,36 @@ class BatchInfoCache(object):
         Add an outbound message to the cache for the given batch_id.
         """
         timestamp = to_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(
-            batch_id, msg['message_id'], timestamp)
-        yield self.add_to_addr(batch_id, msg['to_addr'])
+        yield gather_results([
+            self.add_outbound_message_key(
+                batch_id, msg['message_id'], timestamp),
+            self.add_to_addr(batch_id, msg['to_addr']),
+        ])
 
-    @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
         """
-        new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
-            message_key.encode('utf-8'): timestamp,
-        })
-        if new_entry:
-            yield self.increment_event_status(batch_id, 'sent')
-            yield self.redis.incr(self.outbound_count_key(batch_id))
-            yield self.truncate_outbound_message_keys(batch_id)
+        return self._add_keys(
+            batch_id, self.outbound_key(batch_id),
+            self.outbound_count_key(batch_id),
+            [(message_key, timestamp, 'sent')])
+
+    @Manager.calls_manager
+    def add_outbound_messages(self, batch_id, msgs):
+        """
+        Add several outbound messages to the cache for the given batch_id.
+
+        This updates each counter once for all the messages.
+        """
+        yield gather_results([
+            self._add_keys(
+                batch_id, self.outbound_key(batch_id),
+                self.outbound_count_key(batch_id),
+                [(msg["message_id"], to_timestamp(msg["timestamp"]), 'sent')
+                 for msg in msgs]),
+            self.add_to_addr(batch_id, *set(msg['to_addr'] for msg in msgs)),
+        ])
 
     def add_to_addr(self, batch_id, *to_addrs):
         """
@@ -218,7 +469,34 @@ class BatchInfoCache(object):
         if len(to_addrs) == 0:
             return
         to_addrs = [to_addr.encode('utf-8') for to_addr in to_addrs]
-        return self.redis.pfadd(self.to_addr_key(batch_id), *to_addrs)
+        return self._add_addrs(
+            batch_id, self.to_addr_key(batch_id),
+            self._rebuild_shadow().to_addr_key(batch_id), to_addrs)
+
+    @Manager.calls_manager
+    def _add_addrs(self, batch_id, addr_key, shadow_addr_key, addrs):
+        """
+        Add addresses to a HyperLogLog. While a resumable rebuild is running,
+        they're added to its shadow HyperLogLog as well, since that replaces
+        the live one when the rebuild finishes.
+        """
+        added, rebuilding = yield gather_results([
+            self.redis.pfadd(addr_key, *addrs),
+            self.redis.exists(self.rebuild_checkpoint_key(batch_id)),
+        ])
+        if rebuilding:
+            yield self.redis.pfadd(shadow_addr_key, *addrs)
+        returnValue(added)
+
+    def _event_status(self, event):
+        """
+        Return the status to count an event under. For delivery reports, this
+        includes the delivery status.
+        """
+        event_type = event['event_type']
+        if event_type == 'delivery_report':
+            event_type = "%s.%s" % (event_type, event['delivery_status'])
+        return event_type
 
     @Manager.calls_manager
     def add_event(self, batch_id, event):
@@ -227,24 +505,30 @@ class BatchInfoCache(object):
         """
         event_id = event['event_id']
         timestamp = to_timestamp(event['timestamp'])
-        event_type = event['event_type']
-        if event_type == 'delivery_report':
-            event_type = "%s.%s" % (event_type, event['delivery_status'])
+        event_type = self._event_status(event)
         yield self.add_event_key(batch_id, event_id, event_type, timestamp)
 
-    @Manager.calls_manager
+    def add_events(self, batch_id, events):
+        """
+        Add several events to the cache for the given batch_id.
+
+        This updates each counter once for all the events.
+        """
+        return self._add_keys(
+            batch_id, self.event_key(batch_id),
+            self.event_count_key(batch_id),
+            [(event['event_id'], to_timestamp(event['timestamp']),
+              self._event_status(event)) for event in events])
+
     def add_event_key(self, batch_id, event_key, event_type, timestamp):
         """
         Add the event key to the set of known event keys. If the event is a
         delivery report, event_type should include the delivery status.
         """
-        new_entry = yield self.redis.zadd(self.event_key(batch_id), **{
-            event_key.encode('utf-8'): timestamp,
-        })
-        if new_entry:
-            yield self.redis.incr(self.event_count_key(batch_id))
-            yield self.truncate_event_keys(batch_id)
-            yield self.increment_event_status(batch_id, event_type)
+        return self._add_keys(
+            batch_id, self.event_key(batch_id),
+            self.event_count_key(batch_id),
+            [(event_key, timestamp, event_type)])
 
     @Manager.calls_manager
     def increment_event_status(self, batch_id, event_type, count=1):
@@ -254,9 +538,11 @@ class BatchInfoCache(object):
         delivery status.
         """
         status_key = self.status_key(batch_id)
-        yield self.redis.hincrby(status_key, event_type, count)
+        updates = [self.redis.hincrby(status_key, event_type, count)]
         if event_type.startswith("delivery_report."):
-            yield self.redis.hincrby(status_key, "delivery_report", count)
+            updates.append(
+                self.redis.hincrby(status_key, "delivery_report", count))
+        yield gather_results(updates)
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -326,113 +612,580 @@ class BatchInfoCache(object):
         return self.redis.pfcount(self.to_addr_key(batch_id))
 
     @Manager.calls_manager
-    def rebuild_cache(self, batch_id, qms, page_size=None):
+    def get_counts_for_batches(self, batch_ids):
+        """
+        Return a dictionary mapping each of the given batch_ids to a dictionary
+        containing its event stats and message and event counts.
+
+        The counters for all the batches are fetched with a single ``MGET`` if
+        the Redis client supports it, otherwise with a ``GET`` for each one.
+        The status hashes are fetched at the same time.
+        """
+        batch_ids = list(batch_ids)
+        count_keys = []
+        for batch_id in batch_ids:
+            count_keys.extend([
+                self.inbound_count_key(batch_id),
+                self.outbound_count_key(batch_id),
+                self.event_count_key(batch_id),
+            ])
+        counts = self.redis_commands.mget(count_keys)
+        statuses = gather_results(
+            [self.get_batch_status(batch_id) for batch_id in batch_ids])
+        counts, statuses = yield gather_results([counts, statuses])
+
+        counts = [0 if count is None else int(count) for count in counts]
+        result = {}
+        for i, (batch_id, status) in enumerate(zip(batch_ids, statuses)):
+            result[batch_id] = {
+                'status': status,
+                'inbound_count': counts[3 * i],
+                'outbound_count': counts[3 * i + 1],
+                'event_count': counts[3 * i + 2],
+            }
+        returnValue(result)
+
+    def get_merged_from_addr_count(self, batch_ids):
+        """
+        Return the count of unique from addresses across all the given
+        batches.
+        """
+        return self.redis_commands.pfcount(
+            [self.from_addr_key(batch_id) for batch_id in batch_ids])
+
+    def get_merged_to_addr_count(self, batch_ids):
+        """
+        Return the count of unique to addresses across all the given batches.
+        """
+        return self.redis_commands.pfcount(
+            [self.to_addr_key(batch_id) for batch_id in batch_ids])
+
+    @Manager.calls_manager
+    def get_batch_summary(self, batch_id):
+        """
+        Return a dictionary containing the event stats, message and event
+        counts and address counts for the given batch_id.
+
+        The Redis commands for these are all issued together, so this only
+        waits for one round trip.
+        """
+        summaries = yield self.get_batch_summaries([batch_id])
+        returnValue(summaries[batch_id])
+
+    @Manager.calls_manager
+    def get_batch_summaries(self, batch_ids):
+        """
+        Return a dictionary mapping each of the given batch_ids to its batch
+        summary, as returned by :meth:`get_batch_summary`.
+
+        The Redis commands for all the batches are issued together.
+        """
+        batch_ids = list(batch_ids)
+        getters = [
+            ('status', self.get_batch_status),
+            ('inbound_count', self.get_inbound_message_count),
+            ('outbound_count', self.get_outbound_message_count),
+            ('event_count', self.get_event_count),
+            ('from_addr_count', self.get_from_addr_count),
+            ('to_addr_count', self.get_to_addr_count),
+        ]
+        results = yield gather_results([
+            getter(batch_id)
+            for batch_id in batch_ids for _, getter in getters])
+        summaries = {}
+        for i, batch_id in enumerate(batch_ids):
+            batch_results = results[i * len(getters):(i + 1) * len(getters)]
+            summaries[batch_id] = dict(
+                (name, result)
+                for (name, _), result in zip(getters, batch_results))
+        returnValue(summaries)
+
+    @Manager.calls_manager
+    def rebuild_cache(self, batch_id, qms, page_size=None,
+                      shard_boundaries=()):
         """
         Rebuild the cache using the provided IQueryMessageStore implementation.
+
+        The inbound message, outbound message and event indexes are scanned
+        concurrently. If `shard_boundaries` are given, each index is split
+        into time ranges at those timestamps (see :func:`time_shard_ranges`)
+        and the ranges are scanned concurrently as well.
+
+        This works because each range adds its own most recent keys to the
+        zsets and all counters are updated by incrementing them. Each range
+        truncates a zset once it has been scanned, which only ever removes
+        keys that are older than the most recent ones seen in any range.
+
+        The counters are incremented rather than set from the scan totals
+        because messages and events stored while the rebuild is running
+        update them as well.
         """
         yield self.clear_batch(batch_id)
         yield self.batch_start(batch_id)
 
-        yield self._rebuild_inbound_messages(batch_id, qms, page_size)
-        yield self._rebuild_outbound_messages(batch_id, qms, page_size)
-        yield self._rebuild_events(batch_id, qms, page_size)
+        rebuilders = [
+            self._rebuild_inbound_messages,
+            self._rebuild_outbound_messages,
+            self._rebuild_events,
+        ]
+        yield gather_results([
+            rebuild(batch_id, qms, page_size, start=start, end=end)
+            for rebuild in rebuilders
+            for start, end in time_shard_ranges(shard_boundaries)])
 
     @Manager.calls_manager
-    def _rebuild_inbound_messages(self, batch_id, qms, page_size=None):
+    def _rebuild_inbound_messages(self, batch_id, qms, page_size=None,
+                                  start=None, end=None):
         """
         Rebuild the cache by loading the latest inbound messages for the given
         batch into the cache and counting all the messages.
         """
         inbound_page = yield qms.list_batch_inbound_messages(
-            batch_id, page_size=page_size)
-        count = 0
-        recents_added = False
-        while inbound_page is not None:
-            from_addrs = set()
-            for key, timestamp, from_addr in inbound_page:
-                count += 1
-                from_addrs.add(from_addr)
-                # Treat the most recent messages as though we were recording
-                # them in flight.
-                if not recents_added:
-                    yield self.add_inbound_message_key(
-                        batch_id, key, to_timestamp(timestamp))
-                    yield self.add_from_addr(batch_id, from_addr)
-                    if count == self.TRUNCATE_MESSAGE_KEY_ZSET_AT:
-                        recents_added = True
-                        count = 0
-
-            yield self.add_from_addr(batch_id, *from_addrs)
-            # After storing the most recent messages, count the rest, updating
-            # the count in Redis after processing each page.
-            if recents_added:
-                yield self.add_inbound_message_count(batch_id, count)
-                count = 0
-
-            inbound_page = yield inbound_page.next_page()
+            batch_id, start=start, end=end, page_size=page_size)
+        yield self._rebuild_index(
+            batch_id, inbound_page, self.inbound_key(batch_id),
+            self.inbound_count_key(batch_id), lambda value: None,
+            self.add_from_addr, self._count_inbound_page)
+
+    def _count_inbound_page(self, batch_id, from_addrs):
+        return [
+            self.add_inbound_message_count(batch_id, len(from_addrs)),
+            self.add_from_addr(batch_id, *set(from_addrs)),
+        ]
 
     @Manager.calls_manager
-    def _rebuild_outbound_messages(self, batch_id, qms, page_size=None):
+    def _rebuild_outbound_messages(self, batch_id, qms, page_size=None,
+                                   start=None, end=None):
         """
         Rebuild the cache by loading the latest outbound messages for the given
         batch into the cache and counting all the messages.
         """
         outbound_page = yield qms.list_batch_outbound_messages(
-            batch_id, page_size=page_size)
-        count = 0
-        recents_added = False
-        while outbound_page is not None:
-            to_addrs = set()
-            for key, timestamp, to_addr in outbound_page:
-                count += 1
-                to_addrs.add(to_addr)
-                # Treat the most recent messages as though we were recording
-                # them in flight.
-                if not recents_added:
-                    yield self.add_outbound_message_key(
-                        batch_id, key, to_timestamp(timestamp))
-                    if count == self.TRUNCATE_MESSAGE_KEY_ZSET_AT:
-                        recents_added = True
-                        count = 0
-
-            yield self.add_to_addr(batch_id, *to_addrs)
-            # After storing the most recent messages, count the rest, updating
-            # the count in Redis after processing each page.
-            if recents_added:
-                yield self.add_outbound_message_count(batch_id, count)
-                count = 0
-
-            outbound_page = yield outbound_page.next_page()
+            batch_id, start=start, end=end, page_size=page_size)
+        yield self._rebuild_index(
+            batch_id, outbound_page, self.outbound_key(batch_id),
+            self.outbound_count_key(batch_id), lambda value: 'sent',
+            self.add_to_addr, self._count_outbound_page)
+
+    def _count_outbound_page(self, batch_id, to_addrs):
+        return [
+            self.add_outbound_message_count(batch_id, len(to_addrs)),
+            self.add_to_addr(batch_id, *set(to_addrs)),
+        ]
 
     @Manager.calls_manager
-    def _rebuild_events(self, batch_id, qms, page_size=None):
+    def _rebuild_events(self, batch_id, qms, page_size=None, start=None,
+                        end=None):
         """
         Rebuild the cache by loading the latest events for the given batch into
         the cache and counting all the events.
         """
-        event_page = yield qms.list_batch_events(batch_id, page_size=page_size)
-        count = 0
-        recents_added = False
-        statuses = {}
-        while event_page is not None:
-            for key, timestamp, status in event_page:
-                count += 1
-                # Treat the most recent events as though we were recording
-                # them in flight.
-                if not recents_added:
-                    yield self.add_event_key(
-                        batch_id, key, status, to_timestamp(timestamp))
-                    if count == self.TRUNCATE_MESSAGE_KEY_ZSET_AT:
-                        recents_added = True
-                        count = 0
+        event_page = yield qms.list_batch_events(
+            batch_id, start=start, end=end, page_size=page_size)
+        yield self._rebuild_index(
+            batch_id, event_page, self.event_key(batch_id),
+            self.event_count_key(batch_id), lambda value: value, None,
+            self._count_event_page)
+
+    def _count_event_page(self, batch_id, event_statuses):
+        counts = {}
+        for status in event_statuses:
+            counts[status] = counts.get(status, 0) + 1
+        return [
+            self.add_event_count(batch_id, status, count)
+            for status, count in counts.iteritems()]
+
+    @Manager.calls_manager
+    def _rebuild_index(self, batch_id, index_page, zset_key, count_key,
+                       event_type, add_addrs, count_page):
+        """
+        Add the most recent keys from an index to a zset and count all of
+        them.
+
+        The keys that fall within the most recent window are added to the zset
+        in a single call to :meth:`_add_keys` for each page, which only counts
+        the keys that are new. The zset is only truncated once, after the last
+        page. Messages and events stored while the rebuild is
+        running are added to the zset as well, so they aren't counted twice.
+        Older keys can't be added concurrently, so they're counted in bulk by
+        `count_page` without touching the zset.
+
+        :param event_type:
+            Callable that takes an index value and returns the event type to
+            count a new key under, or ``None``.
+        :param add_addrs:
+            Callable that adds the index values to an address HyperLogLog, or
+            ``None`` if the index values aren't addresses.
+        :param count_page:
+            Callable that takes the batch_id and a list of index values and
+            returns a list of counter updates.
+        """
+        recents_left = self.TRUNCATE_MESSAGE_KEY_ZSET_AT
+        # Fetch the next page while we're writing the current one.
+        pages = index_page.iter_pages()
+        index_page = yield pages.next_page()
+        while index_page is not None:
+            recents = []
+            recent_values = set()
+            values = []
+            for key, timestamp, value in index_page:
+                if len(recents) < recents_left:
+                    recents.append(
+                        (key, to_timestamp(timestamp), event_type(value)))
+                    recent_values.add(value)
                 else:
-                    statuses[status] = statuses.get(status, 0) + 1
+                    values.append(value)
+            recents_left -= len(recents)
+
+            updates = count_page(batch_id, values) if values else []
+            if recents:
+                updates.append(self._add_keys(
+                    batch_id, zset_key, count_key, recents, truncate=False))
+                if add_addrs is not None:
+                    updates.append(add_addrs(batch_id, *recent_values))
+            yield gather_results(updates)
+            index_page = yield pages.next_page()
+        if recents_left < self.TRUNCATE_MESSAGE_KEY_ZSET_AT:
+            yield self._truncate_keys(zset_key, None)
+
+    def _rebuild_shadow(self):
+        """
+        Return a cache that stores its data in shadow keys that are only
+        swapped in at the end of a resumable rebuild.
+        """
+        shadow = type(self)(self.redis)
+        shadow.BATCH_KEY = self.batch_key(self.REBUILD_KEY)
+        shadow.TRUNCATE_MESSAGE_KEY_ZSET_AT = self.TRUNCATE_MESSAGE_KEY_ZSET_AT
+        shadow.USE_LUA_SCRIPTS = self.USE_LUA_SCRIPTS
+        return shadow
+
+    @Manager.calls_manager
+    def rebuild_cache_resumable(self, batch_id, qms, page_size=None,
+                                shard_boundaries=()):
+        """
+        Rebuild the cache using the provided IQueryMessageStore implementation
+        without clearing it first.
+
+        Unlike :meth:`rebuild_cache`, the new data is built in shadow keys and
+        swapped in with ``RENAME`` at the end, so the existing counters remain
+        available while the indexes are scanned. After each page, the index
+        continuation token and the counts so far are saved in a checkpoint.
+        If the rebuild is interrupted, calling this again resumes from the
+        checkpoint instead of starting over. A resumed rebuild uses the shard
+        boundaries it was started with and ignores `shard_boundaries`.
+
+        Messages and events added while the rebuild is running update the
+        live keys, which are replaced by the swap. To avoid losing them, the
+        scans stop at a cutoff just before the rebuild started, and the index
+        entries newer than the cutoff are added to the live keys again once
+        the new data has been swapped in. Entries at or before the cutoff can
+        land in a part of the index the scans have already passed, so these
+        are also recorded in a hash for each index while the checkpoint
+        exists (see :meth:`_add_keys`). The scans skip recorded keys, and the
+        recorded keys are added to the shadow keys before the swap.
+
+        A key that is recorded between a scan listing a page that contains
+        it and checking that page against the recorded keys is counted
+        twice. Without Lua scripts, the swap isn't atomic, and messages added
+        while the keys are being renamed can still be lost.
+        """
+        shadow = self._rebuild_shadow()
+        checkpoint_key = self.rebuild_checkpoint_key(batch_id)
+        checkpoint = yield self.redis.hgetall(checkpoint_key)
+        if 'shards' in checkpoint:
+            shards = json.loads(checkpoint['shards'])
+            cutoff = checkpoint['cutoff']
+        else:
+            # Start from scratch, in case a previous rebuild left shadow data
+            # behind without a checkpoint.
+            cutoff = format_vumi_date(
+                datetime.utcnow().replace(microsecond=0) -
+                timedelta(seconds=1))
+            shards = [
+                (start, cutoff if end is None else min(end, cutoff))
+                for start, end in time_shard_ranges(shard_boundaries)]
+            yield gather_results([
+                self.redis.delete(key)
+                for key in (shadow.cache_keys(batch_id) +
+                            self._rebuild_writes_keys(batch_id))])
+            yield self.redis.hmset(checkpoint_key, {
+                'shards': json.dumps(shards),
+                'cutoff': cutoff,
+            })
+
+        writes_keys = self._rebuild_writes_keys(batch_id)
+        scans = [
+            ('inbound', qms.list_batch_inbound_messages,
+             shadow._rebuild_inbound_page),
+            ('outbound', qms.list_batch_outbound_messages,
+             shadow._rebuild_outbound_page),
+            ('event', qms.list_batch_events, shadow._rebuild_event_page),
+        ]
+        states = yield gather_results([
+            self._resumable_scan(
+                batch_id, checkpoint_key, '%s:%s' % (name, i), list_func,
+                process_page, writes_key, page_size, start, end)
+            for (name, list_func, process_page), writes_key in zip(
+                scans, writes_keys)
+            for i, (start, end) in enumerate(shards)])
+        names = [name for name, _, _ in scans for _ in shards]
+        yield self._finish_rebuild(batch_id, shadow, zip(names, states))
+        yield self._merge_after_cutoff(batch_id, qms, cutoff, page_size)
+
+    def _rebuild_writes_keys(self, batch_id):
+        """
+        Return the keys of the hashes that record the inbound messages,
+        outbound messages and events added during a resumable rebuild.
+        """
+        return [
+            self.rebuild_writes_key(self.inbound_key(batch_id)),
+            self.rebuild_writes_key(self.outbound_key(batch_id)),
+            self.rebuild_writes_key(self.event_key(batch_id)),
+        ]
+
+    @Manager.calls_manager
+    def _resumable_scan(self, batch_id, checkpoint_key, field, list_func,
+                        process_page, writes_key, page_size, start, end):
+        """
+        Process pages of index results until there are none left, saving the
+        scan state in the checkpoint after each page. Keys recorded in
+        `writes_key` are left out, since they're added separately.
+
+        :returns:
+            The final scan state, a dict containing the number of index
+            entries seen and a count of each status seen.
+        """
+        state = yield self.redis.hget(checkpoint_key, field)
+        if state is None:
+            state = {
+                'continuation': None, 'count': 0, 'statuses': {},
+                'done': False,
+            }
+        else:
+            state = json.loads(state)
+        while not state['done']:
+            page = yield list_func(
+                batch_id, start=start, end=end, page_size=page_size,
+                continuation=state['continuation'])
+            written = yield self.redis.hgetall(writes_key)
+            yield process_page(
+                batch_id, [entry for entry in page if entry[0] not in written],
+                state)
+            state['continuation'] = page.continuation
+            state['done'] = page.continuation is None
+            yield self.redis.hset(checkpoint_key, field, json.dumps(state))
+        returnValue(state)
+
+    def _rebuild_inbound_page(self, batch_id, page, state):
+        return self._rebuild_page(
+            self.inbound_key(batch_id), self.from_addr_key(batch_id), page,
+            state)
+
+    def _rebuild_outbound_page(self, batch_id, page, state):
+        return self._rebuild_page(
+            self.outbound_key(batch_id), self.to_addr_key(batch_id), page,
+            state)
+
+    def _rebuild_event_page(self, batch_id, page, state):
+        return self._rebuild_page(self.event_key(batch_id), None, page, state)
+
+    def _rebuild_page(self, zset_key, addr_key, page, state):
+        """
+        Add the keys from a page of index results to the zset if they're
+        among the most recent keys in this scan and count them all in the scan
+        state. Addresses are added to `addr_key` if given, otherwise the index
+        values are counted as statuses.
 
-            # After storing the most recent events, count the rest, updating
-            # the count in Redis after processing each page.
-            if recents_added:
-                for status, count in statuses.iteritems():
-                    yield self.add_event_count(batch_id, status, count)
-                statuses.clear()
+        Everything written to Redis here is idempotent, so reprocessing a page
+        after an interrupted rebuild is harmless.
+        """
+        recents = {}
+        addrs = set()
+        for key, timestamp, value in page:
+            if state['count'] < self.TRUNCATE_MESSAGE_KEY_ZSET_AT:
+                recents[key.encode('utf-8')] = to_timestamp(timestamp)
+            state['count'] += 1
+            if addr_key is None:
+                state['statuses'][value] = state['statuses'].get(value, 0) + 1
+            else:
+                addrs.add(value.encode('utf-8'))
+
+        writes = []
+        if recents:
+            writes.append(self.redis.zadd(zset_key, **recents))
+        if addrs:
+            writes.append(self.redis.pfadd(addr_key, *addrs))
+        return gather_results(writes)
+
+    @Manager.calls_manager
+    def _finish_rebuild(self, batch_id, shadow, named_states):
+        """
+        Write the counts from a resumable rebuild and the keys recorded while
+        it was running to the shadow keys and swap them in. Keys that are
+        recorded after we've read them are added to the live keys after the
+        swap.
+        """
+        # (name, live zset, live counter, shadow zset)
+        indexes = [
+            ('inbound', self.inbound_key(batch_id),
+             self.inbound_count_key(batch_id), shadow.inbound_key(batch_id)),
+            ('outbound', self.outbound_key(batch_id),
+             self.outbound_count_key(batch_id),
+             shadow.outbound_key(batch_id)),
+            ('event', self.event_key(batch_id),
+             self.event_count_key(batch_id), shadow.event_key(batch_id)),
+        ]
+        writes_keys = self._rebuild_writes_keys(batch_id)
+        writes = yield gather_results(
+            [self.redis.hgetall(key) for key in writes_keys])
+
+        counts = {'inbound': 0, 'outbound': 0, 'event': 0}
+        statuses = dict.fromkeys(self._status_fields(), 0)
+        for name, state in named_states:
+            counts[name] += state['count']
+            for status, count in state['statuses'].iteritems():
+                statuses[status] = statuses.get(status, 0) + count
+        zadds = []
+        for (name, _, _, shadow_key), written in zip(indexes, writes):
+            if not written:
+                continue
+            counts[name] += len(written)
+            keys = {}
+            for key, (timestamp, event_type) in self._load_writes(written):
+                keys[key] = timestamp
+                if name == 'event':
+                    statuses[event_type] = statuses.get(event_type, 0) + 1
+            zadds.append(self.redis.zadd(shadow_key, **keys))
+        yield gather_results(zadds)
+        statuses['sent'] = counts['outbound']
+        statuses['delivery_report'] = sum(
+            count for status, count in statuses.iteritems()
+            if status.startswith('delivery_report.'))
+
+        yield gather_results([
+            self.redis.set(
+                shadow.inbound_count_key(batch_id), counts['inbound']),
+            self.redis.set(
+                shadow.outbound_count_key(batch_id), counts['outbound']),
+            self.redis.set(shadow.event_count_key(batch_id), counts['event']),
+            self.redis.hmset(shadow.status_key(batch_id), statuses),
+            shadow.truncate_inbound_message_keys(batch_id),
+            shadow.truncate_outbound_message_keys(batch_id),
+            shadow.truncate_event_keys(batch_id),
+        ])
+        yield self._swap_keys(
+            self.rebuild_checkpoint_key(batch_id),
+            zip(shadow.cache_keys(batch_id), self.cache_keys(batch_id)))
+
+        # Nothing is recorded once the checkpoint is gone, so whatever was
+        # recorded since we read the hashes only went to the live keys that
+        # the swap replaced.
+        late_writes = yield gather_results(
+            [self.redis.hgetall(key) for key in writes_keys])
+        yield gather_results([
+            self._add_keys(batch_id, zset_key, count_key, [
+                (key.decode('utf-8'), timestamp, event_type)
+                for key, (timestamp, event_type) in self._load_writes(late)
+                if key not in written])
+            for (_, zset_key, count_key, _), written, late in zip(
+                indexes, writes, late_writes)])
+        yield gather_results(
+            [self.redis.delete(key) for key in writes_keys])
+        yield self.redis.sadd(self.batch_key(), batch_id)
+        for key in self.obsolete_keys(batch_id):
+            yield self.redis.delete(key)
+
+    def _load_writes(self, written):
+        """
+        Return (key, (timestamp, event_type)) pairs for the keys recorded in
+        a hash by :meth:`_add_keys`.
+        """
+        return [(key, json.loads(value)) for key, value in written.iteritems()]
+
+    @Manager.calls_manager
+    def _merge_after_cutoff(self, batch_id, qms, cutoff, page_size=None):
+        """
+        Add the index entries newer than a resumable rebuild's cutoff to the
+        live keys.
+
+        These are the messages and events that were added while the rebuild
+        was running, along with any added since the swap. Keys that are
+        already in the zsets aren't counted again.
+        """
+        start = format_vumi_date(
+            datetime.strptime(cutoff, VUMI_DATE_FORMAT) +
+            timedelta(seconds=1))
+        inbound_page, outbound_page, event_page = yield gather_results([
+            qms.list_batch_inbound_messages(
+                batch_id, start=start, page_size=page_size),
+            qms.list_batch_outbound_messages(
+                batch_id, start=start, page_size=page_size),
+            qms.list_batch_events(batch_id, start=start, page_size=page_size),
+        ])
+        yield gather_results([
+            self._merge_index(
+                batch_id, inbound_page, self.inbound_key(batch_id),
+                self.inbound_count_key(batch_id), lambda value: None,
+                self.add_from_addr),
+            self._merge_index(
+                batch_id, outbound_page, self.outbound_key(batch_id),
+                self.outbound_count_key(batch_id), lambda value: 'sent',
+                self.add_to_addr),
+            self._merge_index(
+                batch_id, event_page, self.event_key(batch_id),
+                self.event_count_key(batch_id), lambda value: value, None),
+        ])
+
+    @Manager.calls_manager
+    def _merge_index(self, batch_id, index_page, zset_key, count_key,
+                     event_type, add_addrs):
+        """
+        Add all the keys from an index to a zset the same way they're added
+        when messages and events are stored.
+
+        :param event_type:
+            Callable that takes an index value and returns the event type to
+            count a new key under, or ``None``.
+        :param add_addrs:
+            Callable that adds the index values to an address HyperLogLog, or
+            ``None`` if the index values aren't addresses.
+        """
+        pages = index_page.iter_pages()
+        index_page = yield pages.next_page()
+        while index_page is not None:
+            entries = []
+            values = set()
+            for key, timestamp, value in index_page:
+                entries.append(
+                    (key, to_timestamp(timestamp), event_type(value)))
+                values.add(value)
+            updates = [self._add_keys(batch_id, zset_key, count_key, entries)]
+            if add_addrs is not None:
+                updates.append(add_addrs(batch_id, *values))
+            yield gather_results(updates)
+            index_page = yield pages.next_page()
+
+    @Manager.calls_manager
+    def _swap_keys(self, checkpoint_key, key_pairs):
+        """
+        Delete the checkpoint and rename each shadow key over its live key. If
+        a shadow key doesn't exist, the live key is deleted instead.
+
+        This is atomic if we can run Lua scripts. Otherwise, the checkpoint is
+        deleted first so that an interrupted swap is followed by a fresh
+        rebuild rather than a resumed one that finds half its data missing.
+        """
+        if self._use_scripts():
+            keys = [checkpoint_key]
+            for shadow_key, live_key in key_pairs:
+                keys.extend([shadow_key, live_key])
+            yield self.redis_commands.run_script(SWAP_KEYS_SCRIPT, keys)
+            return
 
-            event_page = yield event_page.next_page()
+        yield self.redis.delete(checkpoint_key)
+        for shadow_key, live_key in key_pairs:
+            exists = yield self.redis.exists(shadow_key)
+            if exists:
+                yield self.redis.rename(shadow_key, live_key)
+            else:
+                yield self.redis.delete(live_key)
@@ -65,7 +65,7 @@ class IMessageStoreBatchManager(Interface):
             If async, a Deferred is returned instead.
         """
 
-    def rebuild_cache(batch_id, qms):
+    def rebuild_cache(batch_id, qms, shard_boundaries=()):
         """
         Rebuild the cache using the provided IQueryMessageStore implementation.
 
@@ -75,6 +75,31 @@ class IMessageStoreBatchManager(Interface):
         :param qms:
             An `IQueryMessageStore` provider to rebuild the cache from.
 
+        :param shard_boundaries:
+            Sequence of timestamps to split the indexes into time ranges at.
+            The ranges are scanned concurrently.
+
+        :returns:
+            ``None``.
+            If async, a Deferred is returned instead.
+        """
+
+    def rebuild_cache_resumable(batch_id, qms, shard_boundaries=()):
+        """
+        Rebuild the cache in shadow keys using the provided IQueryMessageStore
+        implementation and swap them in at the end, resuming an interrupted
+        rebuild if there is one.
+
+        :param batch_id:
+            The batch identifier for the batch to operate on.
+
+        :param qms:
+            An `IQueryMessageStore` provider to rebuild the cache from.
+
+        :param shard_boundaries:
+            Sequence of timestamps to split the indexes into time ranges at.
+            The ranges are scanned concurrently. Ignored when resuming.
+
         :returns:
             ``None``.
             If async, a Deferred is returned instead.
@@ -104,6 +129,20 @@ class IOperationalMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
+    def add_inbound_messages(msgs, batch_ids=()):
+        """
+        Add several inbound mesages to the message store.
+
+        :param msgs:
+            Sequence of TransportUserMessages to add.
+        :param batch_ids:
+            Sequence of batch identifiers to add the messages to.
+
+        :returns:
+            ``None``.
+            If async, a Deferred is returned instead.
+        """
+
     def get_inbound_message(msg_id):
         """
         Get an inbound mesage from the message store.
@@ -130,6 +169,20 @@ class IOperationalMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
+    def add_outbound_messages(msgs, batch_ids=()):
+        """
+        Add several outbound mesages to the message store.
+
+        :param msgs:
+            Sequence of TransportUserMessages to add.
+        :param batch_ids:
+            Sequence of batch identifiers to add the messages to.
+
+        :returns:
+            ``None``.
+            If async, a Deferred is returned instead.
+        """
+
     def get_outbound_message(msg_id):
         """
         Get an outbound mesage from the message store.
@@ -156,6 +209,20 @@ class IOperationalMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
+    def add_events(events, batch_ids=()):
+        """
+        Add several events to the message store.
+
+        :param events:
+            Sequence of TransportEvents to add.
+        :param batch_ids:
+            Sequence of batch identifiers to add the events to.
+
+        :returns:
+            ``None``.
+            If async, a Deferred is returned instead.
+        """
+
     def get_event(event_id):
         """
         Get an event from the message store.
@@ -224,7 +291,48 @@ class IQueryMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
-    def list_batch_inbound_messages(batch_id, start=None, end=None):
+    def get_inbound_message_json(msg_id):
+        """
+        Get an inbound mesage from the message store as JSON, without building
+        a message object. The stored record is still loaded and decoded.
+
+        :param msg_id:
+            The identifier of the message to retrieve.
+
+        :returns:
+            The message serialised as a JSON string, or ``None`` if the message
+            is not found. If async, a Deferred is returned instead.
+        """
+
+    def get_outbound_message_json(msg_id):
+        """
+        Get an outbound mesage from the message store as JSON, without
+        building a message object. The stored record is still loaded and
+        decoded.
+
+        :param msg_id:
+            The identifier of the message to retrieve.
+
+        :returns:
+            The message serialised as a JSON string, or ``None`` if the message
+            is not found. If async, a Deferred is returned instead.
+        """
+
+    def get_event_json(event_id):
+        """
+        Get an event from the message store as JSON, without building an event
+        object. The stored record is still loaded and decoded.
+
+        :param event_id:
+            The identifier of the event to retrieve.
+
+        :returns:
+            The event serialised as a JSON string, or ``None`` if the event is
+            not found. If async, a Deferred is returned instead.
+        """
+
+    def list_batch_inbound_messages(batch_id, start=None, end=None,
+                                    continuation=None):
         """
         List inbound message keys with timestamps and source addresses for the
         given batch.
@@ -238,6 +346,10 @@ class IQueryMessageStore(Interface):
         :param end:
             Timestamp denoting the end of a range query.
 
+        :param continuation:
+            Continuation token from a previous IndexPage to resume listing
+            from.
+
         :returns:
             An IndexPage object containing a list of tuples of inbound message
             key, timestamp, and from_addr. The list will be in descending
@@ -245,7 +357,8 @@ class IQueryMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
-    def list_batch_outbound_messages(batch_id, start=None, end=None):
+    def list_batch_outbound_messages(batch_id, start=None, end=None,
+                                     continuation=None):
         """
         List outbound message keys with timestamps and destination addresses
         for the given batch.
@@ -259,6 +372,10 @@ class IQueryMessageStore(Interface):
         :param end:
             Timestamp denoting the end of a range query.
 
+        :param continuation:
+            Continuation token from a previous IndexPage to resume listing
+            from.
+
         :returns:
             An IndexPage object containing a list of tuples of outbound message
             key, timestamp, and to_addr. The list will be in descending
@@ -287,7 +404,7 @@ class IQueryMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
-    def list_batch_events(batch_id, start=None, end=None):
+    def list_batch_events(batch_id, start=None, end=None, continuation=None):
         """
         List event keys with timestamps and statuses for the given batch.
 
@@ -300,6 +417,10 @@ class IQueryMessageStore(Interface):
         :param end:
             Timestamp denoting the end of a range query.
 
+        :param continuation:
+            Continuation token from a previous IndexPage to resume listing
+            from.
+
         :returns:
             An IndexPage object containing a list of tuples of event key,
             timestamp, and event status. The list will be in descending
@@ -307,6 +428,93 @@ class IQueryMessageStore(Interface):
             If async, a Deferred is returned instead.
         """
 
+    def iter_batch_inbound_messages(batch_id, start=None, end=None,
+                                    page_size=None, concurrency=None):
+        """
+        Iterate over pages of inbound messages for the given batch.
+
+        :param batch_id:
+            The batch identifier for the batch to operate on.
+
+        :param start:
+            Timestamp denoting the start of a range query.
+
+        :param end:
+            Timestamp denoting the end of a range query.
+
+        :param page_size:
+            The maximum number of inbound messages in each page. If ``None``,
+            the backend's default page size is used.
+
+        :param concurrency:
+            The maximum number of inbound messages to fetch at once.
+
+        :returns:
+            An iterator with a ``next_page()`` method that returns the next
+            page of inbound messages in descending timestamp order, or ``None``
+            once there are no more. ``next_page()`` returns a Deferred if
+            async.
+            If async, a Deferred is returned instead.
+        """
+
+    def iter_batch_outbound_messages(batch_id, start=None, end=None,
+                                     page_size=None, concurrency=None):
+        """
+        Iterate over pages of outbound messages for the given batch.
+
+        :param batch_id:
+            The batch identifier for the batch to operate on.
+
+        :param start:
+            Timestamp denoting the start of a range query.
+
+        :param end:
+            Timestamp denoting the end of a range query.
+
+        :param page_size:
+            The maximum number of outbound messages in each page. If ``None``,
+            the backend's default page size is used.
+
+        :param concurrency:
+            The maximum number of outbound messages to fetch at once.
+
+        :returns:
+            An iterator with a ``next_page()`` method that returns the next
+            page of outbound messages in descending timestamp order, or
+            ``None`` once there are no more. ``next_page()`` returns a
+            Deferred if async.
+            If async, a Deferred is returned instead.
+        """
+
+    def iter_batch_events(batch_id, start=None, end=None, page_size=None,
+                          concurrency=None):
+        """
+        Iterate over pages of events for the given batch.
+
+        :param batch_id:
+            The batch identifier for the batch to operate on.
+
+        :param start:
+            Timestamp denoting the start of a range query.
+
+        :param end:
+            Timestamp denoting the end of a range query.
+
+        :param page_size:
+            The maximum number of events in each page. If ``None``,
+            the backend's default page size is used.
+
+        :param concurrency:
+            The maximum number of events to fetch at once.
+
+        :returns:
+            An iterator with a ``next_page()`` method that returns the next
+            page of events in descending timestamp order, or ``None``
+            once there are no more. ``next_page()`` returns a Deferred if
+            async.
+            If async, a Deferred is returned instead.
+        """
+
     def get_batch_info_status(batch_id):
         """
         Return a dictionary containing the latest event stats for the given
@@ -355,3 +563,71 @@ class IQueryMessageStore(Interface):
             The number of events in the batch.
             If async, a Deferred is returned instead.
         """
+
+    def get_batch_summary(batch_id):
+        """
+        Return a dictionary containing the event stats, message and event
+        counts and address counts for the given batch_id.
+
+        :param batch_id:
+            The batch identifier for the batch to operate on.
+
+        :returns:
+            A dictionary with ``status``, ``inbound_count``,
+            ``outbound_count``, ``event_count``, ``from_addr_count`` and
+            ``to_addr_count`` keys. The status is a dictionary as returned by
+            :meth:`get_batch_info_status`.
+            If async, a Deferred is returned instead.
+        """
+
+    def get_batch_summaries(batch_ids):
+        """
+        Return batch summaries for several batches at once.
+
+        :param batch_ids:
+            A list of batch identifiers for the batches to operate on.
+
+        :returns:
+            A dictionary mapping each batch identifier to a batch summary as
+            returned by :meth:`get_batch_summary`.
+            If async, a Deferred is returned instead.
+        """
+
+    def get_counts_for_batches(batch_ids):
+        """
+        Return event stats and message and event counts for several batches
+        at once.
+
+        :param batch_ids:
+            A list of batch identifiers for the batches to operate on.
+
+        :returns:
+            A dictionary mapping each batch identifier to a dictionary with
+            ``status``, ``inbound_count``, ``outbound_count`` and
+            ``event_count`` keys.
+            If async, a Deferred is returned instead.
+        """
+
+    def get_merged_from_addr_count(batch_ids):
+        """
+        Return the count of unique from addresses across several batches.
+
+        :param batch_ids:
+            A list of batch identifiers for the batches to operate on.
+
+        :returns:
+            The approximate number of unique from addresses.
+            If async, a Deferred is returned instead.
+        """
+
+    def get_merged_to_addr_count(batch_ids):
+        """
+        Return the count of unique to addresses across several batches.
+
+        :param batch_ids:
+            A list of batch identifiers for the batches to operate on.
+
+        :returns:
+            The approximate number of unique to addresses.
+            If async, a Deferred is returned instead.
+        """
@@ -274,6 +274,10 @@ class FakeMemoryIndexPage(object):
         return self._state.get_index_page(
             continuation=self._continuation, **self._params)
 
+    @property
+    def continuation(self):
+        return self._continuation
+
     def has_next_page(self):
         return self._continuation is not None
 
@@ -10,6 +10,7 @@ from vumi_message_store.interfaces import (
     IMessageStoreBatchManager, IOperationalMessageStore, IQueryMessageStore)
 from vumi_message_store.batch_info_cache import BatchInfoCache
 from vumi_message_store.riak_backend import MessageStoreRiakBackend
+from vumi_message_store.utils import gather_results
 
 
 @implementer(IMessageStoreBatchManager)
@@ -63,11 +64,23 @@ class MessageStoreBatchManager(object):
         """
         return self.riak_backend.get_tag_info(tag)
 
-    def rebuild_cache(self, batch_id, qms):
+    def rebuild_cache(self, batch_id, qms, shard_boundaries=()):
         """
         Rebuild the cache using the provided IQueryMessageStore implementation.
+
+        If `shard_boundaries` are given, the indexes are scanned in concurrent
+        time ranges split at those timestamps.
+        """
+        return self.batch_info_cache.rebuild_cache(
+            batch_id, qms, shard_boundaries=shard_boundaries)
+
+    def rebuild_cache_resumable(self, batch_id, qms, shard_boundaries=()):
+        """
+        Rebuild the cache in shadow keys using the provided IQueryMessageStore
+        implementation, resuming an interrupted rebuild if there is one.
         """
-        return self.batch_info_cache.rebuild_cache(batch_id, qms)
+        return self.batch_info_cache.rebuild_cache_resumable(
+            batch_id, qms, shard_boundaries=shard_boundaries)
 
 
 @implementer(IOperationalMessageStore)
@@ -75,13 +88,21 @@ class OperationalMessageStore(object):
     """
     Operational message store that uses Riak directly.
 
-    This proxies a subset of MessageStoreRiakBackend and BatchInfoCache.
+    This proxies a subset of MessageStoreRiakBackend and BatchInfoCache. When
+    adding messages or events, the cache for each batch is only updated once
+    the Riak write has succeeded, so a failed write isn't counted. The cache
+    updates for the different batches happen concurrently.
+
+    If `blind_writes` is ``True``, messages and events are written to Riak
+    without loading existing records first. This is only safe if each message
+    and event is only ever added once. See MessageStoreRiakBackend.
     """
 
-    def __init__(self, riak_manager, redis_manager):
+    def __init__(self, riak_manager, redis_manager, blind_writes=False):
         self.manager = riak_manager
         self.redis = redis_manager
-        self.riak_backend = MessageStoreRiakBackend(self.manager)
+        self.riak_backend = MessageStoreRiakBackend(
+            self.manager, blind_writes=blind_writes)
         self.batch_info_cache = BatchInfoCache(self.redis)
 
     @Manager.calls_manager
@@ -90,8 +111,19 @@ class OperationalMessageStore(object):
         Add an inbound message to the message store.
         """
         yield self.riak_backend.add_inbound_message(msg, batch_ids=batch_ids)
-        for batch_id in batch_ids:
-            yield self.batch_info_cache.add_inbound_message(batch_id, msg)
+        yield gather_results([
+            self.batch_info_cache.add_inbound_message(batch_id, msg)
+            for batch_id in batch_ids])
+
+    @Manager.calls_manager
+    def add_inbound_messages(self, msgs, batch_ids=()):
+        """
+        Add several inbound messages to the message store.
+        """
+        yield self.riak_backend.add_inbound_messages(msgs, batch_ids=batch_ids)
+        yield gather_results([
+            self.batch_info_cache.add_inbound_messages(batch_id, msgs)
+            for batch_id in batch_ids])
 
     def get_inbound_message(self, msg_id):
         """
@@ -105,8 +137,20 @@ class OperationalMessageStore(object):
         Add an outbound message to the message store.
         """
         yield self.riak_backend.add_outbound_message(msg, batch_ids=batch_ids)
-        for batch_id in batch_ids:
-            yield self.batch_info_cache.add_outbound_message(batch_id, msg)
+        yield gather_results([
+            self.batch_info_cache.add_outbound_message(batch_id, msg)
+            for batch_id in batch_ids])
+
+    @Manager.calls_manager
+    def add_outbound_messages(self, msgs, batch_ids=()):
+        """
+        Add several outbound messages to the message store.
+        """
+        yield self.riak_backend.add_outbound_messages(
+            msgs, batch_ids=batch_ids)
+        yield gather_results([
+            self.batch_info_cache.add_outbound_messages(batch_id, msgs)
+            for batch_id in batch_ids])
 
     def get_outbound_message(self, msg_id):
         """
@@ -120,8 +164,19 @@ class OperationalMessageStore(object):
         Add an event to the message store.
         """
         yield self.riak_backend.add_event(event, batch_ids=batch_ids)
-        for batch_id in batch_ids:
-            yield self.batch_info_cache.add_event(batch_id, event)
+        yield gather_results([
+            self.batch_info_cache.add_event(batch_id, event)
+            for batch_id in batch_ids])
+
+    @Manager.calls_manager
+    def add_events(self, events, batch_ids=()):
+        """
+        Add several events to the message store.
+        """
+        yield self.riak_backend.add_events(events, batch_ids=batch_ids)
+        yield gather_results([
+            self.batch_info_cache.add_events(batch_id, events)
+            for batch_id in batch_ids])
 
     def get_event(self, event_id):
         """
@@ -168,23 +223,43 @@ class QueryMessageStore(object):
         """
         return self.riak_backend.get_event(event_id)
 
+    def get_inbound_message_json(self, msg_id):
+        """
+        Get an inbound message from the message store as a JSON string.
+        """
+        return self.riak_backend.get_inbound_message_json(msg_id)
+
+    def get_outbound_message_json(self, msg_id):
+        """
+        Get an outbound message from the message store as a JSON string.
+        """
+        return self.riak_backend.get_outbound_message_json(msg_id)
+
+    def get_event_json(self, event_id):
+        """
+        Get an event from the message store as a JSON string.
+        """
+        return self.riak_backend.get_event_json(event_id)
+
     def list_batch_inbound_messages(self, batch_id, start=None, end=None,
-                                    page_size=None):
+                                    page_size=None, continuation=None):
         """
         List inbound message keys with timestamps and addresses in descending
         timestamp order for the given batch.
         """
         return self.riak_backend.list_batch_inbound_messages(
-            batch_id, start=start, end=end, page_size=page_size)
+            batch_id, start=start, end=end, page_size=page_size,
+            continuation=continuation)
 
     def list_batch_outbound_messages(self, batch_id, start=None, end=None,
-                                     page_size=None):
+                                     page_size=None, continuation=None):
         """
         List outbound message keys with timestamps and addresses in descending
         timestamp order for the given batch.
         """
         return self.riak_backend.list_batch_outbound_messages(
-            batch_id, start=start, end=end, page_size=page_size)
+            batch_id, start=start, end=end, page_size=page_size,
+            continuation=continuation)
 
     def list_message_events(self, message_id, start=None, end=None,
                             page_size=None):
@@ -196,13 +271,44 @@ class QueryMessageStore(object):
             message_id, start=start, end=end, page_size=page_size)
 
     def list_batch_events(self, batch_id, start=None, end=None,
-                          page_size=None):
+                          page_size=None, continuation=None):
         """
         List event keys with timestamps and statuses in descending timestamp
         order for the given batch.
         """
         return self.riak_backend.list_batch_events(
-            batch_id, start=start, end=end, page_size=page_size)
+            batch_id, start=start, end=end, page_size=page_size,
+            continuation=continuation)
+
+    def iter_batch_inbound_messages(self, batch_id, start=None, end=None,
+                                    page_size=None, concurrency=None):
+        """
+        Iterate over pages of inbound messages in descending timestamp order
+        for the given batch.
+        """
+        return self.riak_backend.iter_batch_inbound_messages(
+            batch_id, start=start, end=end, page_size=page_size,
+            concurrency=concurrency)
+
+    def iter_batch_outbound_messages(self, batch_id, start=None, end=None,
+                                     page_size=None, concurrency=None):
+        """
+        Iterate over pages of outbound messages in descending timestamp order
+        for the given batch.
+        """
+        return self.riak_backend.iter_batch_outbound_messages(
+            batch_id, start=start, end=end, page_size=page_size,
+            concurrency=concurrency)
+
+    def iter_batch_events(self, batch_id, start=None, end=None,
+                          page_size=None, concurrency=None):
+        """
+        Iterate over pages of events in descending timestamp order for the
+        given batch.
+        """
+        return self.riak_backend.iter_batch_events(
+            batch_id, start=start, end=end, page_size=page_size,
+            concurrency=concurrency)
 
     def get_batch_info_status(self, batch_id):
         """
@@ -225,3 +331,37 @@ class QueryMessageStore(object):
 
     def get_batch_to_addr_count(self, batch_id):
         return self.batch_info_cache.get_to_addr_count(batch_id)
+
+    def get_batch_summary(self, batch_id):
+        """
+        Return a dictionary containing the event stats, message and event
+        counts and address counts for the given batch_id.
+        """
+        return self.batch_info_cache.get_batch_summary(batch_id)
+
+    def get_batch_summaries(self, batch_ids):
+        """
+        Return a dictionary mapping each of the given batch_ids to its batch
+        summary.
+        """
+        return self.batch_info_cache.get_batch_summaries(batch_ids)
+
+    def get_counts_for_batches(self, batch_ids):
+        """
+        Return a dictionary mapping each of the given batch_ids to a dictionary
+        containing its event stats and message and event counts.
+        """
+        return self.batch_info_cache.get_counts_for_batches(batch_ids)
+
+    def get_merged_from_addr_count(self, batch_ids):
+        """
+        Return the count of unique from addresses across all the given
+        batches.
+        """
+        return self.batch_info_cache.get_merged_from_addr_count(batch_ids)
+
+    def get_merged_to_addr_count(self, batch_ids):
+        """
+        Return the count of unique to addresses across all the given batches.
+        """
+        return self.batch_info_cache.get_merged_to_addr_count(batch_ids)
@@ -0,0 +1,121 @@
+# -*- test-case-name: vumi_message_store.tests.test_redis_commands -*-
+
+"""
+Redis commands that vumi's Redis managers don't provide.
+"""
+
+from copy import deepcopy
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.redis_base import Manager
+from vumi.persist.txredis_manager import VumiRedis
+
+from vumi_message_store.utils import gather_results
+
+
+class RedisCommands(object):
+    """
+    Commands that vumi's Redis managers don't wrap, run on the client
+    underneath a manager where the client supports them.
+
+    The managers only wrap single-key commands and have no scripting support,
+    so this is the only code that relies on how a manager holds its client
+    and prefixes its keys.
+
+    :param manager:
+        The Redis manager to run commands for.
+    """
+
+    def __init__(self, manager):
+        # Store this as `manager` since @Manager.calls_manager requires it to
+        # be named as such.
+        self.manager = manager
+
+    def _client(self):
+        return self.manager._client
+
+    def _keys(self, keys):
+        # Keys sent straight to the client don't get the manager's prefix
+        # added, so we need to do that ourselves.
+        return [self.manager._key(key) for key in keys]
+
+    def supports_scripting(self):
+        """
+        Return ``True`` if Lua scripts can be run on the manager's client.
+
+        Only txredis clients can run them. The stand-ins used in tests don't
+        support scripting at all.
+        """
+        return isinstance(self._client(), VumiRedis)
+
+    @Manager.calls_manager
+    def run_script(self, script, keys=(), args=()):
+        """
+        Run a :class:`vumi_message_store.batch_info_cache.RedisScript` with
+        the given (unprefixed) keys and arguments.
+        """
+        if not self.supports_scripting():
+            raise NotImplementedError(
+                "Lua scripts require a txredis client.")
+        result = yield script(self._client(), self._keys(keys), args)
+        returnValue(result)
+
+    @Manager.calls_manager
+    def mget(self, keys):
+        """
+        Return the values of several string keys, with ``None`` for each key
+        that doesn't exist.
+
+        This is a single ``MGET`` if the client supports it, otherwise a
+        ``GET`` for each key.
+        """
+        keys = list(keys)
+        client = self._client()
+        if not keys or isinstance(client, FakeRedis):
+            values = yield gather_results(
+                [self.manager.get(key) for key in keys])
+        elif isinstance(client, VumiRedis):
+            values = yield client.mget(*self._keys(keys))
+        else:
+            values = client.mget(self._keys(keys))
+        returnValue(values)
+
+    @Manager.calls_manager
+    def pfcount(self, keys):
+        """
+        Return the approximate number of unique values across all the
+        HyperLogLogs at the given keys.
+
+        Adding up the count for each key would count values that appear in
+        several of them more than once, so we need ``PFCOUNT`` to merge them.
+        """
+        keys = list(keys)
+        if not keys:
+            returnValue(0)
+        if len(keys) == 1:
+            count = yield self.manager.pfcount(keys[0])
+            returnValue(count)
+
+        client = self._client()
+        if isinstance(client, VumiRedis):
+            # The client's pfcount only takes one key, so we send the command
+            # ourselves the same way it does.
+            client._send('PFCOUNT', *self._keys(keys))
+            count = yield client.getResponse()
+        elif isinstance(client, FakeRedis):
+            # The fake client only counts one key too, but it stores each
+            # HyperLogLog as a value we can fetch and merge into a copy.
+            hlls = yield gather_results(
+                [self.manager.get(key) for key in keys])
+            hlls = [hll for hll in hlls if hll is not None]
+            if not hlls:
+                returnValue(0)
+            merged = deepcopy(hlls[0])
+            if len(hlls) > 1:
+                merged.update(*hlls[1:])
+            count = len(merged)
+        else:
+            count = client.pfcount(*self._keys(keys))
+        returnValue(count)
@@ -4,14 +4,48 @@
 Riak backend for message store.
 """
 
+import json
+from collections import deque
 from uuid import uuid4
 
-from twisted.internet.defer import returnValue
+from twisted.internet.defer import Deferred, maybeDeferred, returnValue
 from vumi.persist.model import Manager
 
 from vumi_message_store.models import (
     from_reverse_timestamp, to_reverse_timestamp,
     Batch, CurrentTag, InboundMessage, OutboundMessage, Event)
+from vumi_message_store.utils import bounded_map
+
+
+def message_payload_json(modelobj, field_name):
+    """
+    Serialise the message stored in a model object's
+    :class:`vumi.persist.fields.VumiMessage` field as JSON without building a
+    message object.
+
+    This doesn't read the stored JSON directly. The model object has already
+    been loaded, which decodes the Riak object's JSON body and applies any
+    migrations, and the message's fields are flattened into that body
+    alongside the model's other fields. What this skips is building the
+    message object and serialising it with its ``to_json()`` method. The
+    message's fields are picked out of the loaded data and encoded again
+    with :func:`json.dumps` instead.
+
+    The stored fields are already JSON-compatible, so this produces the same
+    JSON as the message's ``to_json()`` method, although the keys may be in a
+    different order.
+
+    :returns:
+        The JSON string, or ``None`` if the field holds no message.
+    """
+    prefix = modelobj.field_descriptors[field_name].prefix
+    payload = dict(
+        (key[len(prefix):], value)
+        for key, value in modelobj._riak_object.get_data().iteritems()
+        if key.startswith(prefix))
+    if not payload:
+        return None
+    return json.dumps(payload)
 
 
 class MessageStoreRiakBackend(object):
@@ -20,13 +54,27 @@ class MessageStoreRiakBackend(object):
 
     This implements all message store operations that use Riak. Higher-level
     message store objects should route all Riak things through here.
+
+    :param manager:
+        The Riak manager to use.
+    :param blind_writes:
+        If ``True``, messages and events are written without loading any
+        existing record first. This can be overridden for each write.
+
+    NOTE: Blind writes are only safe for messages and events that haven't
+          been stored before. Our buckets don't allow siblings, so a blind
+          write replaces any existing record, and the batches that record
+          belonged to are dropped along with their index entries.
     """
 
     # The Python Riak client defaults to max_results=1000 in places.
     DEFAULT_PAGE_SIZE = 1000
+    # The maximum number of concurrent Riak operations for bulk writes.
+    DEFAULT_CONCURRENCY = 10
 
-    def __init__(self, manager):
+    def __init__(self, manager, blind_writes=False):
         self.manager = manager
+        self.blind_writes = blind_writes
         self.batches = manager.proxy(Batch)
         self.current_tags = manager.proxy(CurrentTag)
         self.inbound_messages = manager.proxy(InboundMessage)
@@ -83,13 +131,27 @@ class MessageStoreRiakBackend(object):
             tagmdl = yield self.current_tags(tag)
         returnValue(tagmdl)
 
+    def _is_blind_write(self, blind_write):
+        """
+        Decide whether a write should skip loading the existing record.
+        """
+        if blind_write is None:
+            return self.blind_writes
+        return blind_write
+
     @Manager.calls_manager
-    def add_inbound_message(self, msg, batch_ids=()):
+    def add_inbound_message(self, msg, batch_ids=(), blind_write=None):
         """
         Store an inbound message in Riak.
+
+        If this is a blind write, we don't load the existing record first.
+        This saves a round trip, but if the message was stored before, it is
+        removed from the batches it already belonged to.
         """
         msg_id = msg['message_id']
-        msg_record = yield self.inbound_messages.load(msg_id)
+        msg_record = None
+        if not self._is_blind_write(blind_write):
+            msg_record = yield self.inbound_messages.load(msg_id)
         if msg_record is None:
             msg_record = self.inbound_messages(msg_id, msg=msg)
         else:
@@ -100,6 +162,20 @@ class MessageStoreRiakBackend(object):
 
         yield msg_record.save()
 
+    @Manager.calls_manager
+    def add_inbound_messages(self, msgs, batch_ids=(), concurrency=None,
+                             blind_write=None):
+        """
+        Store several inbound messages in Riak, with at most `concurrency`
+        messages being written at once.
+        """
+        if concurrency is None:
+            concurrency = self.DEFAULT_CONCURRENCY
+        yield bounded_map(
+            lambda msg: self.add_inbound_message(
+                msg, batch_ids=batch_ids, blind_write=blind_write),
+            msgs, concurrency)
+
     def get_raw_inbound_message(self, msg_id):
         """
         Get an InboundMessage model object from Riak.
@@ -115,12 +191,28 @@ class MessageStoreRiakBackend(object):
         returnValue(msg.msg if msg is not None else None)
 
     @Manager.calls_manager
-    def add_outbound_message(self, msg, batch_ids=()):
+    def get_inbound_message_json(self, msg_id):
+        """
+        Get an inbound message from Riak as a JSON string.
+        """
+        msg = yield self.get_raw_inbound_message(msg_id)
+        if msg is None:
+            returnValue(None)
+        returnValue(message_payload_json(msg, 'msg'))
+
+    @Manager.calls_manager
+    def add_outbound_message(self, msg, batch_ids=(), blind_write=None):
         """
         Store an outbound message in Riak.
+
+        If this is a blind write, we don't load the existing record first.
+        This saves a round trip, but if the message was stored before, it is
+        removed from the batches it already belonged to.
         """
         msg_id = msg['message_id']
-        msg_record = yield self.outbound_messages.load(msg_id)
+        msg_record = None
+        if not self._is_blind_write(blind_write):
+            msg_record = yield self.outbound_messages.load(msg_id)
         if msg_record is None:
             msg_record = self.outbound_messages(msg_id, msg=msg)
         else:
@@ -131,6 +223,20 @@ class MessageStoreRiakBackend(object):
 
         yield msg_record.save()
 
+    @Manager.calls_manager
+    def add_outbound_messages(self, msgs, batch_ids=(), concurrency=None,
+                              blind_write=None):
+        """
+        Store several outbound messages in Riak, with at most `concurrency`
+        messages being written at once.
+        """
+        if concurrency is None:
+            concurrency = self.DEFAULT_CONCURRENCY
+        yield bounded_map(
+            lambda msg: self.add_outbound_message(
+                msg, batch_ids=batch_ids, blind_write=blind_write),
+            msgs, concurrency)
+
     def get_raw_outbound_message(self, msg_id):
         """
         Get an OutboundMessage model object from Riak.
@@ -146,13 +252,29 @@ class MessageStoreRiakBackend(object):
         returnValue(msg.msg if msg is not None else None)
 
     @Manager.calls_manager
-    def add_event(self, event, batch_ids=()):
+    def get_outbound_message_json(self, msg_id):
+        """
+        Get an outbound message from Riak as a JSON string.
+        """
+        msg = yield self.get_raw_outbound_message(msg_id)
+        if msg is None:
+            returnValue(None)
+        returnValue(message_payload_json(msg, 'msg'))
+
+    @Manager.calls_manager
+    def add_event(self, event, batch_ids=(), blind_write=None):
         """
         Store an event in Riak.
+
+        If this is a blind write, we don't load the existing record first.
+        This saves a round trip, but if the event was stored before, it is
+        removed from the batches it already belonged to.
         """
         event_id = event['event_id']
         msg_id = event['user_message_id']
-        event_record = yield self.events.load(event_id)
+        event_record = None
+        if not self._is_blind_write(blind_write):
+            event_record = yield self.events.load(event_id)
         if event_record is None:
             event_record = self.events(event_id, event=event, message=msg_id)
         else:
@@ -163,6 +285,20 @@ class MessageStoreRiakBackend(object):
 
         yield event_record.save()
 
+    @Manager.calls_manager
+    def add_events(self, events, batch_ids=(), concurrency=None,
+                   blind_write=None):
+        """
+        Store several events in Riak, with at most `concurrency` events being
+        written at once.
+        """
+        if concurrency is None:
+            concurrency = self.DEFAULT_CONCURRENCY
+        yield bounded_map(
+            lambda event: self.add_event(
+                event, batch_ids=batch_ids, blind_write=blind_write),
+            events, concurrency)
+
     def get_raw_event(self, event_id):
         """
         Get an Event model object from Riak.
@@ -177,6 +313,16 @@ class MessageStoreRiakBackend(object):
         event = yield self.get_raw_event(event_id)
         returnValue(event.event if event is not None else None)
 
+    @Manager.calls_manager
+    def get_event_json(self, event_id):
+        """
+        Get an event from Riak as a JSON string.
+        """
+        event = yield self.get_raw_event(event_id)
+        if event is None:
+            returnValue(None)
+        returnValue(message_payload_json(event, 'event'))
+
     def _start_end_range(self, batch_id, start, end):
         if start is not None:
             start_value = "%s$%s" % (batch_id, start)
@@ -202,7 +348,7 @@ class MessageStoreRiakBackend(object):
 
     @Manager.calls_manager
     def list_batch_inbound_messages(self, batch_id, start=None, end=None,
-                                    page_size=None):
+                                    page_size=None, continuation=None):
         """
         List inbound message keys with timestamps and addresses in descending
         timestamp order for the given batch.
@@ -213,13 +359,14 @@ class MessageStoreRiakBackend(object):
             self._start_end_range_reverse(batch_id, start, end))
         results = yield self.inbound_messages.index_keys_page(
             'batches_with_addresses_reverse', start_range, end_range,
-            return_terms=True, max_results=page_size)
+            return_terms=True, max_results=page_size,
+            continuation=continuation)
         returnValue(IndexPageWrapper(
             key_with_rts_and_value_formatter, self, batch_id, results))
 
     @Manager.calls_manager
     def list_batch_outbound_messages(self, batch_id, start=None, end=None,
-                                     page_size=None):
+                                     page_size=None, continuation=None):
         """
         List outbound message keys with timestamps and addresses in descending
         timestamp order for the given batch.
@@ -230,7 +377,8 @@ class MessageStoreRiakBackend(object):
             self._start_end_range_reverse(batch_id, start, end))
         results = yield self.outbound_messages.index_keys_page(
             'batches_with_addresses_reverse', start_range, end_range,
-            return_terms=True, max_results=page_size)
+            return_terms=True, max_results=page_size,
+            continuation=continuation)
         returnValue(IndexPageWrapper(
             key_with_rts_and_value_formatter, self, batch_id, results))
 
@@ -252,7 +400,7 @@ class MessageStoreRiakBackend(object):
 
     @Manager.calls_manager
     def list_batch_events(self, batch_id, start=None, end=None,
-                          page_size=None):
+                          page_size=None, continuation=None):
         """
         List event keys with timestamps and statuses in descending timestamp
         order for the given batch.
@@ -263,10 +411,56 @@ class MessageStoreRiakBackend(object):
             self._start_end_range_reverse(batch_id, start, end))
         results = yield self.events.index_keys_page(
             'batches_with_statuses_reverse', start_range, end_range,
-            return_terms=True, max_results=page_size)
+            return_terms=True, max_results=page_size,
+            continuation=continuation)
         returnValue(IndexPageWrapper(
             key_with_rts_and_value_formatter, self, batch_id, results))
 
+    @Manager.calls_manager
+    def iter_batch_inbound_messages(self, batch_id, start=None, end=None,
+                                    page_size=None, concurrency=None):
+        """
+        Iterate over pages of inbound messages in descending timestamp order
+        for the given batch.
+
+        :returns:
+            A :class:`MessagePageIterator`.
+        """
+        keys_page = yield self.list_batch_inbound_messages(
+            batch_id, start=start, end=end, page_size=page_size)
+        returnValue(MessagePageIterator(
+            keys_page, self.get_inbound_message, concurrency))
+
+    @Manager.calls_manager
+    def iter_batch_outbound_messages(self, batch_id, start=None, end=None,
+                                     page_size=None, concurrency=None):
+        """
+        Iterate over pages of outbound messages in descending timestamp order
+        for the given batch.
+
+        :returns:
+            A :class:`MessagePageIterator`.
+        """
+        keys_page = yield self.list_batch_outbound_messages(
+            batch_id, start=start, end=end, page_size=page_size)
+        returnValue(MessagePageIterator(
+            keys_page, self.get_outbound_message, concurrency))
+
+    @Manager.calls_manager
+    def iter_batch_events(self, batch_id, start=None, end=None,
+                          page_size=None, concurrency=None):
+        """
+        Iterate over pages of events in descending timestamp order for the
+        given batch.
+
+        :returns:
+            A :class:`MessagePageIterator`.
+        """
+        keys_page = yield self.list_batch_events(
+            batch_id, start=start, end=end, page_size=page_size)
+        returnValue(MessagePageIterator(
+            keys_page, self.get_event, concurrency))
+
 
 class IndexPageWrapper(object):
     """
@@ -305,6 +499,14 @@ class IndexPageWrapper(object):
         next_page = yield self._index_page.next_page()
         returnValue(self._wrap_index_page(next_page))
 
+    @property
+    def continuation(self):
+        """
+        Opaque token that can be passed to a listing method to fetch the next
+        page of results later, or ``None`` if this is the last page.
+        """
+        return self._index_page.continuation
+
     def has_next_page(self):
         """
         Indicate whether there are more results to follow.
@@ -315,6 +517,15 @@ class IndexPageWrapper(object):
         """
         return self._index_page.has_next_page()
 
+    def iter_pages(self, prefetch=1):
+        """
+        Return an :class:`IndexPageIterator` that starts with this page.
+
+        :param int prefetch:
+            The number of pages to fetch ahead of the page being processed.
+        """
+        return IndexPageIterator(self.manager, self, prefetch)
+
     def __iter__(self):
         return (self._formatter(self._batch_id, r) for r in self._index_page)
 
@@ -322,6 +533,131 @@ class IndexPageWrapper(object):
         return len(self._index_page)
 
 
+class IndexPageIterator(object):
+    """
+    Iterator over pages of index results that fetches pages in the background
+    so that processing one page doesn't have to wait for the next one to be
+    fetched.
+
+    Riak can only give us a page once we have the one before it, so pages are
+    still fetched one after the other, but each fetch starts as soon as the
+    previous one finishes rather than when the caller asks for the page. No
+    more than `prefetch` pages are held that the caller hasn't asked for yet.
+
+    Pages are requested by calling :meth:`next_page` until it returns
+    ``None``. Only one call should be waiting on a result at a time.
+    """
+
+    def __init__(self, manager, first_page, prefetch=1):
+        self.manager = manager
+        self.prefetch = prefetch
+        self._buffer = deque()
+        self._last_page = None
+        self._fetching = False
+        self._failure = None
+        self._waiters = []
+        self._page_fetched(first_page)
+
+    def _fetch_more(self):
+        """
+        Start fetching the next page if there is one and we have room for it.
+        """
+        if self._fetching or self._failure is not None:
+            return
+        if self._last_page is None or not self._last_page.has_next_page():
+            return
+        if len(self._buffer) >= self.prefetch:
+            return
+        self._fetching = True
+        # With a sync manager, this fires (or fails) before it returns.
+        d = maybeDeferred(self._last_page.next_page)
+        d.addCallbacks(self._page_fetched, self._fetch_failed)
+
+    def _page_fetched(self, page):
+        self._fetching = False
+        self._last_page = page
+        if page is not None:
+            self._buffer.append(page)
+        self._wake_waiters()
+        self._fetch_more()
+
+    def _fetch_failed(self, failure):
+        self._fetching = False
+        self._failure = failure
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    @Manager.calls_manager
+    def next_page(self):
+        """
+        Return the next page of results, or ``None`` if there are no more.
+
+        If fetching a page failed, the failure is raised once all the pages
+        fetched before it have been returned.
+        """
+        while not self._buffer and self._fetching:
+            waiter = Deferred()
+            self._waiters.append(waiter)
+            yield waiter
+        if self._buffer:
+            page = self._buffer.popleft()
+            self._fetch_more()
+            returnValue(page)
+        if self._failure is not None:
+            self._failure.raiseException()
+        returnValue(None)
+
+
+class MessagePageIterator(object):
+    """
+    Iterator over pages of messages (or events) for the keys in an index
+    listing.
+
+    The messages for a page are only fetched when the page is asked for, so a
+    slow consumer holds no more than one page of messages in memory. They are
+    fetched with no more than `concurrency` requests at a time and returned in
+    index order. Keys with no message stored for them are skipped. The next
+    page of keys is fetched in the background while the messages for the
+    current page are being fetched.
+
+    Pages are requested by calling :meth:`next_page` until it returns
+    ``None``. Only one call should be waiting on a result at a time.
+
+    :param keys_page:
+        The first :class:`IndexPageWrapper` of the listing.
+    :param get_message:
+        Callable that returns the message for a key.
+    :param int concurrency:
+        The maximum number of messages to fetch at once.
+    """
+
+    def __init__(self, keys_page, get_message, concurrency=None):
+        if concurrency is None:
+            concurrency = MessageStoreRiakBackend.DEFAULT_CONCURRENCY
+        self.manager = keys_page.manager
+        self._keys_pages = keys_page.iter_pages()
+        self._get_message = get_message
+        self.concurrency = concurrency
+
+    @Manager.calls_manager
+    def next_page(self):
+        """
+        Return a list of the messages for the next page of keys, or ``None``
+        if there are no more.
+        """
+        keys_page = yield self._keys_pages.next_page()
+        if keys_page is None:
+            returnValue(None)
+        messages = yield bounded_map(
+            self._get_message, [key for key, _, _ in keys_page],
+            self.concurrency)
+        returnValue([msg for msg in messages if msg is not None])
+
+
 def key_with_ts_and_value_formatter(batch_id, result):
     value, key = result
     prefix = batch_id + "$"
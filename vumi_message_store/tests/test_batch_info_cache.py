@@ -4,11 +4,16 @@
 
 from datetime import datetime, timedelta
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    fail, inlineCallbacks, returnValue, succeed)
+from twisted.trial.unittest import SkipTest
+from txredis.exceptions import NoScript
 from vumi.tests.helpers import VumiTestCase, MessageHelper, PersistenceHelper
 
-from vumi_message_store.batch_info_cache import to_timestamp, BatchInfoCache
+from vumi_message_store.batch_info_cache import (
+    to_timestamp, time_shard_ranges, BatchInfoCache, RedisScript)
 from vumi_message_store.message_store import QueryMessageStore
+from vumi_message_store.utils import gather_results
 
 
 class TestBatchInfoCacheUtils(VumiTestCase):
@@ -27,6 +32,71 @@ class TestBatchInfoCacheUtils(VumiTestCase):
         timestamp = to_timestamp("2015-01-26 19:22:05.000")
         self.assertEqual(timestamp, 1422300125)
 
+    def test_time_shard_ranges_no_boundaries(self):
+        """
+        With no boundaries, we get a single unbounded range.
+        """
+        self.assertEqual(time_shard_ranges([]), [(None, None)])
+
+    def test_time_shard_ranges(self):
+        """
+        Boundaries split time into contiguous inclusive ranges that don't
+        overlap at one second resolution. Boundaries may be datetimes or
+        VUMI_DATE_FORMAT strings, in any order.
+        """
+        self.assertEqual(time_shard_ranges([
+            "2015-01-26 19:23:00.000",
+            datetime(2015, 1, 26, 19, 22, 05, 123),
+        ]), [
+            (None, "2015-01-26 19:22:04.000000"),
+            ("2015-01-26 19:22:05.000000", "2015-01-26 19:22:59.000000"),
+            ("2015-01-26 19:23:00.000000", None),
+        ])
+
+
+class FakeScriptingClient(object):
+    """
+    Just enough of a Redis client to check how scripts are invoked.
+    """
+
+    def __init__(self):
+        self.scripts = {}
+        self.calls = []
+
+    def script_load(self, source):
+        self.calls.append(("script_load", source))
+        sha = RedisScript(source).sha1
+        self.scripts[sha] = source
+        return succeed(sha)
+
+    def evalsha(self, sha, keys=(), args=()):
+        self.calls.append(("evalsha", sha, keys, args))
+        if sha not in self.scripts:
+            return fail(NoScript("No matching script."))
+        return succeed(len(keys) + len(args))
+
+
+class TestRedisScript(VumiTestCase):
+
+    @inlineCallbacks
+    def test_call_loads_script_once(self):
+        """
+        The script is loaded the first time the server doesn't know about it
+        and invoked by its SHA1 after that.
+        """
+        client = FakeScriptingClient()
+        script = RedisScript("return 1")
+        result = yield script(client, ["k1"], ["a1", "a2"])
+        self.assertEqual(result, 3)
+        result = yield script(client, ["k1"], ["a1"])
+        self.assertEqual(result, 2)
+        self.assertEqual(client.calls, [
+            ("evalsha", script.sha1, ["k1"], ["a1", "a2"]),
+            ("script_load", "return 1"),
+            ("evalsha", script.sha1, ["k1"], ["a1", "a2"]),
+            ("evalsha", script.sha1, ["k1"], ["a1"]),
+        ])
+
 
 class TestBatchInfoCache(VumiTestCase):
 
@@ -271,6 +341,44 @@ class TestBatchInfoCache(VumiTestCase):
         yield self.assert_redis_zset("batches:inbound:batch", msgs[2:5])
         yield self.assert_redis_string("batches:inbound_count:batch", "5")
 
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        """
+        Adding several inbound messages updates the relevant counters once for
+        each new message and adds the message_ids to the inbound messages zset.
+        """
+        yield self.batch_info_cache.batch_start("mybatch")
+        msg1 = self.msg_helper.make_inbound("apples", from_addr="addr1")
+        msg2 = self.msg_helper.make_inbound("pears", from_addr="addr2")
+        yield self.batch_info_cache.add_inbound_message("mybatch", msg1)
+        yield self.batch_info_cache.add_inbound_messages(
+            "mybatch", [msg1, msg2])
+
+        yield self.assert_redis_zset("batches:inbound:mybatch", sorted([
+            (msg1["message_id"], to_timestamp(msg1["timestamp"])),
+            (msg2["message_id"], to_timestamp(msg2["timestamp"])),
+        ], key=lambda (k, t): (t, k)))
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "2")
+        yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 2)
+
+    @inlineCallbacks
+    def test_add_inbound_messages_truncates_zset(self):
+        """
+        When adding several inbound messages overfills our zset, it is
+        truncated by removing the oldest entries.
+        """
+        self.batch_info_cache.TRUNCATE_MESSAGE_KEY_ZSET_AT = 3
+        start = datetime.utcnow().replace(microsecond=0)
+        msgs = [self.msg_helper.make_inbound(
+            "apples", timestamp=start + timedelta(seconds=i))
+            for i in range(5)]
+        yield self.batch_info_cache.batch_start("batch")
+        yield self.batch_info_cache.add_inbound_messages("batch", msgs)
+        yield self.assert_redis_zset("batches:inbound:batch", [
+            (msg["message_id"], to_timestamp(msg["timestamp"]))
+            for msg in msgs[2:]])
+        yield self.assert_redis_string("batches:inbound_count:batch", "5")
+
     @inlineCallbacks
     def test_add_from_addrs(self):
         """
@@ -446,6 +554,36 @@ class TestBatchInfoCache(VumiTestCase):
         yield self.assert_redis_zset("batches:outbound:batch", msgs[2:5])
         yield self.assert_redis_string("batches:outbound_count:batch", "5")
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        """
+        Adding several outbound messages updates the relevant counters once
+        for each new message and adds the message_ids to the outbound messages
+        zset.
+        """
+        yield self.batch_info_cache.batch_start("mybatch")
+        msg1 = self.msg_helper.make_outbound("apples", to_addr="addr1")
+        msg2 = self.msg_helper.make_outbound("pears", to_addr="addr2")
+        yield self.batch_info_cache.add_outbound_message("mybatch", msg1)
+        yield self.batch_info_cache.add_outbound_messages(
+            "mybatch", [msg1, msg2])
+
+        yield self.assert_redis_zset("batches:outbound:mybatch", sorted([
+            (msg1["message_id"], to_timestamp(msg1["timestamp"])),
+            (msg2["message_id"], to_timestamp(msg2["timestamp"])),
+        ], key=lambda (k, t): (t, k)))
+        yield self.assert_redis_string("batches:outbound_count:mybatch", "2")
+        yield self.assert_redis_pfcount("batches:to_addr_hll:mybatch", 2)
+        yield self.assert_redis_hash("batches:status:mybatch", {
+            "sent": "2",
+            "ack": "0",
+            "nack": "0",
+            "delivery_report": "0",
+            "delivery_report.delivered": "0",
+            "delivery_report.failed": "0",
+            "delivery_report.pending": "0",
+        })
+
     @inlineCallbacks
     def test_add_to_addrs(self):
         """
@@ -603,6 +741,31 @@ class TestBatchInfoCache(VumiTestCase):
             "delivery_report.pending": "0",
         })
 
+    @inlineCallbacks
+    def test_add_events(self):
+        """
+        Adding several events updates the event counter and the status counter
+        for each new event.
+        """
+        yield self.batch_info_cache.batch_start("mybatch")
+        msg = self.msg_helper.make_outbound("apples")
+        ack = self.msg_helper.make_ack(msg)
+        nack = self.msg_helper.make_nack(msg)
+        dr = self.msg_helper.make_delivery_report(msg)
+        yield self.batch_info_cache.add_event("mybatch", ack)
+        yield self.batch_info_cache.add_events("mybatch", [ack, nack, dr])
+
+        yield self.assert_redis_string("batches:event_count:mybatch", "3")
+        yield self.assert_redis_hash("batches:status:mybatch", {
+            "sent": "0",
+            "ack": "1",
+            "nack": "1",
+            "delivery_report": "1",
+            "delivery_report.delivered": "1",
+            "delivery_report.failed": "0",
+            "delivery_report.pending": "0",
+        })
+
     @inlineCallbacks
     def test_add_event_key_ack(self):
         """
@@ -728,6 +891,37 @@ class TestBatchInfoCache(VumiTestCase):
         yield self.assert_redis_zset("batches:event:batch", redis_events[2:5])
         yield self.assert_redis_string("batches:event_count:batch", "5")
 
+    @inlineCallbacks
+    def test_add_keys_without_lua_scripts(self):
+        """
+        Lua scripts are disabled by default, and adding keys without them
+        updates the same counters as it would with scripts.
+        """
+        self.assertEqual(BatchInfoCache.USE_LUA_SCRIPTS, False)
+        self.assertEqual(self.batch_info_cache._use_scripts(), False)
+        timestamp = to_timestamp(datetime.utcnow())
+        yield self.batch_info_cache.batch_start("mybatch")
+        for _ in range(2):
+            yield self.batch_info_cache.add_inbound_message_key(
+                "mybatch", "in", timestamp)
+            yield self.batch_info_cache.add_outbound_message_key(
+                "mybatch", "out", timestamp)
+            yield self.batch_info_cache.add_event_key(
+                "mybatch", "dr", "delivery_report.delivered", timestamp)
+
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "1")
+        yield self.assert_redis_string("batches:outbound_count:mybatch", "1")
+        yield self.assert_redis_string("batches:event_count:mybatch", "1")
+        yield self.assert_redis_hash("batches:status:mybatch", {
+            "sent": "1",
+            "ack": "0",
+            "nack": "0",
+            "delivery_report": "1",
+            "delivery_report.delivered": "1",
+            "delivery_report.failed": "0",
+            "delivery_report.pending": "0",
+        })
+
     @inlineCallbacks
     def test_add_inbound_message_count(self):
         """
@@ -963,6 +1157,136 @@ class TestBatchInfoCache(VumiTestCase):
         count = yield self.batch_info_cache.get_to_addr_count("batch")
         self.assertEqual(count, 0)
 
+    @inlineCallbacks
+    def test_get_counts_for_batches(self):
+        """
+        The statuses and counters for several batches can be queried together.
+        """
+        yield self.batch_info_cache.batch_start("batch-1")
+        yield self.batch_info_cache.add_inbound_message_count("batch-1", 4)
+        yield self.batch_info_cache.add_event_count("batch-1", "ack", 2)
+        yield self.batch_info_cache.batch_start("batch-2")
+        yield self.batch_info_cache.add_outbound_message_count("batch-2", 3)
+
+        counts = yield self.batch_info_cache.get_counts_for_batches(
+            ["batch-1", "batch-2", "batch-3"])
+        self.assertEqual(sorted(counts.keys()), [
+            "batch-1", "batch-2", "batch-3"])
+        self.assertEqual(counts["batch-1"]["inbound_count"], 4)
+        self.assertEqual(counts["batch-1"]["outbound_count"], 0)
+        self.assertEqual(counts["batch-1"]["event_count"], 2)
+        self.assertEqual(counts["batch-1"]["status"]["ack"], 2)
+        self.assertEqual(counts["batch-2"]["inbound_count"], 0)
+        self.assertEqual(counts["batch-2"]["outbound_count"], 3)
+        self.assertEqual(counts["batch-2"]["event_count"], 0)
+        self.assertEqual(counts["batch-2"]["status"]["sent"], 3)
+        self.assertEqual(counts["batch-3"], {
+            "status": {},
+            "inbound_count": 0,
+            "outbound_count": 0,
+            "event_count": 0,
+        })
+
+    @inlineCallbacks
+    def test_get_merged_addr_count_single_batch(self):
+        """
+        The merged address count for a single batch is the batch's address
+        count.
+        """
+        yield self.batch_info_cache.add_from_addr("batch", "addr-1", "addr-2")
+        yield self.batch_info_cache.add_to_addr("batch", "addr-1")
+        count = yield self.batch_info_cache.get_merged_from_addr_count(
+            ["batch"])
+        self.assertEqual(count, 2)
+        count = yield self.batch_info_cache.get_merged_to_addr_count(["batch"])
+        self.assertEqual(count, 1)
+
+    @inlineCallbacks
+    def test_get_merged_addr_count(self):
+        """
+        Merged address counts for several batches don't count addresses in
+        more than one batch twice, and skip batches without addresses.
+        """
+        cache = self.batch_info_cache
+        yield cache.add_from_addr("batch-1", "addr-1", "addr-2")
+        yield cache.add_from_addr("batch-2", "addr-2", "addr-3")
+        yield cache.add_to_addr("batch-1", "addr-1")
+        count = yield self.batch_info_cache.get_merged_from_addr_count(
+            ["batch-1", "batch-2", "batch-3"])
+        self.assertEqual(count, 3)
+        count = yield self.batch_info_cache.get_merged_to_addr_count(
+            ["batch-1", "batch-2"])
+        self.assertEqual(count, 1)
+        count = yield self.batch_info_cache.get_merged_to_addr_count([])
+        self.assertEqual(count, 0)
+
+    @inlineCallbacks
+    def test_get_batch_summary(self):
+        """
+        The batch status and all the counters can be queried together.
+        """
+        yield self.batch_info_cache.batch_start("batch")
+        yield self.batch_info_cache.add_inbound_message_count("batch", 4)
+        yield self.batch_info_cache.add_outbound_message_count("batch", 3)
+        yield self.batch_info_cache.add_event_count("batch", "ack", 2)
+        yield self.batch_info_cache.add_from_addr("batch", "addr-1")
+        yield self.batch_info_cache.add_to_addr("batch", "addr-1", "addr-2")
+
+        summary = yield self.batch_info_cache.get_batch_summary("batch")
+        self.assertEqual(summary, {
+            "status": {
+                "sent": 3,
+                "ack": 2,
+                "nack": 0,
+                "delivery_report": 0,
+                "delivery_report.delivered": 0,
+                "delivery_report.failed": 0,
+                "delivery_report.pending": 0,
+            },
+            "inbound_count": 4,
+            "outbound_count": 3,
+            "event_count": 2,
+            "from_addr_count": 1,
+            "to_addr_count": 2,
+        })
+
+    @inlineCallbacks
+    def test_get_batch_summary_no_batch(self):
+        """
+        The batch summary has an empty status and zero counts for missing
+        batches.
+        """
+        summary = yield self.batch_info_cache.get_batch_summary("batch")
+        self.assertEqual(summary, {
+            "status": {},
+            "inbound_count": 0,
+            "outbound_count": 0,
+            "event_count": 0,
+            "from_addr_count": 0,
+            "to_addr_count": 0,
+        })
+
+    @inlineCallbacks
+    def test_get_batch_summaries(self):
+        """
+        Summaries for several batches can be queried together.
+        """
+        yield self.batch_info_cache.batch_start("batch-1")
+        yield self.batch_info_cache.add_inbound_message_count("batch-1", 4)
+        yield self.batch_info_cache.batch_start("batch-2")
+        yield self.batch_info_cache.add_outbound_message_count("batch-2", 3)
+
+        summaries = yield self.batch_info_cache.get_batch_summaries(
+            ["batch-1", "batch-2", "batch-3"])
+        self.assertEqual(sorted(summaries.keys()), [
+            "batch-1", "batch-2", "batch-3"])
+        self.assertEqual(summaries["batch-1"]["inbound_count"], 4)
+        self.assertEqual(summaries["batch-1"]["outbound_count"], 0)
+        self.assertEqual(summaries["batch-2"]["inbound_count"], 0)
+        self.assertEqual(summaries["batch-2"]["outbound_count"], 3)
+        self.assertEqual(summaries["batch-2"]["status"]["sent"], 3)
+        self.assertEqual(summaries["batch-3"]["status"], {})
+
     @inlineCallbacks
     def test_rebuild_cache(self):
         """
@@ -1057,6 +1381,449 @@ class TestBatchInfoCache(VumiTestCase):
         yield self.assert_redis_pfcount("batches:to_addr_hll:mybatch", 1)
         yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 1)
 
+    @inlineCallbacks
+    def test_rebuild_cache_live_writes(self):
+        """
+        Messages added while the cache is being rebuilt aren't counted twice
+        if the rebuild finds them in the index as well.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+        for i in range(3):
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)))
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+
+        # Add a message the way the operational store does after the cache
+        # has been cleared, but before the rebuild lists the inbound messages.
+        list_inbound = qms.list_batch_inbound_messages
+
+        @inlineCallbacks
+        def list_inbound_after_live_write(batch_id, **kw):
+            msg = self.msg_helper.make_inbound("live")
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+            yield self.batch_info_cache.add_inbound_message("mybatch", msg)
+            page = yield list_inbound(batch_id, **kw)
+            returnValue(page)
+
+        self.patch(
+            qms, "list_batch_inbound_messages", list_inbound_after_live_write)
+        yield self.batch_info_cache.rebuild_cache("mybatch", qms, page_size=2)
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "4")
+        keys = yield self.redis.zrange("batches:inbound:mybatch", 0, -1)
+        self.assertEqual(len(keys), 4)
+
+    @inlineCallbacks
+    def test_rebuild_cache_shard_boundaries(self):
+        """
+        Rebuilding the cache in time shards gives the same result as
+        rebuilding it all at once, even if some shards have more messages than
+        the truncation point.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+
+        inbound_keys = []
+        for i in range(5):
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)),
+                from_addr="addr %s" % i)
+            inbound_keys.append(
+                (msg["message_id"], to_timestamp(msg["timestamp"])))
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+
+        outbound_msgs = []
+        outbound_keys = []
+        for i in range(4):
+            msg = self.msg_helper.make_outbound(
+                "out %s" % (i,), timestamp=(start + timedelta(seconds=i)))
+            outbound_msgs.append(msg)
+            outbound_keys.append(
+                (msg["message_id"], to_timestamp(msg["timestamp"])))
+            yield backend.add_outbound_message(msg, batch_ids=["mybatch"])
+
+        events = [
+            self.msg_helper.make_nack(
+                outbound_msgs[0], timestamp=(start + timedelta(seconds=1))),
+            self.msg_helper.make_ack(
+                outbound_msgs[1], timestamp=(start + timedelta(seconds=2))),
+            self.msg_helper.make_delivery_report(
+                outbound_msgs[1], timestamp=(start + timedelta(seconds=3))),
+        ]
+        event_keys = []
+        for event in events:
+            event_keys.append(
+                (event["event_id"], to_timestamp(event["timestamp"])))
+            yield backend.add_event(event, batch_ids=["mybatch"])
+
+        self.batch_info_cache.TRUNCATE_MESSAGE_KEY_ZSET_AT = 2
+
+        yield self.batch_info_cache.rebuild_cache(
+            "mybatch", qms, shard_boundaries=[
+                start + timedelta(seconds=3), start + timedelta(seconds=1)])
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "5")
+        yield self.assert_redis_string("batches:outbound_count:mybatch", "4")
+        yield self.assert_redis_string("batches:event_count:mybatch", "3")
+        yield self.assert_redis_hash("batches:status:mybatch", {
+            "sent": "4",
+            "ack": "1",
+            "nack": "1",
+            "delivery_report": "1",
+            "delivery_report.delivered": "1",
+            "delivery_report.failed": "0",
+            "delivery_report.pending": "0",
+        })
+        yield self.assert_redis_zset(
+            "batches:inbound:mybatch", inbound_keys[-2:])
+        yield self.assert_redis_zset(
+            "batches:outbound:mybatch", outbound_keys[-2:])
+        yield self.assert_redis_zset("batches:event:mybatch", event_keys[-2:])
+        yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 5)
+        yield self.assert_redis_pfcount("batches:to_addr_hll:mybatch", 1)
+
+    @inlineCallbacks
+    def test_rebuild_cache_resumable(self):
+        """
+        A resumable rebuild replaces all cached data with data built from the
+        given QueryMessageStore and cleans up after itself.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+
+        inbound_keys = []
+        for i in range(5):
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)))
+            inbound_keys.append(
+                (msg["message_id"], to_timestamp(msg["timestamp"])))
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+
+        outbound_msgs = []
+        outbound_keys = []
+        for i in range(4):
+            msg = self.msg_helper.make_outbound(
+                "out %s" % (i,), timestamp=(start + timedelta(seconds=i)))
+            outbound_msgs.append(msg)
+            outbound_keys.append(
+                (msg["message_id"], to_timestamp(msg["timestamp"])))
+            yield backend.add_outbound_message(msg, batch_ids=["mybatch"])
+
+        events = [
+            self.msg_helper.make_nack(
+                outbound_msgs[0], timestamp=(start + timedelta(seconds=1))),
+            self.msg_helper.make_ack(
+                outbound_msgs[1], timestamp=(start + timedelta(seconds=2))),
+            self.msg_helper.make_delivery_report(
+                outbound_msgs[1], timestamp=(start + timedelta(seconds=3))),
+        ]
+        event_keys = []
+        for event in events:
+            event_keys.append(
+                (event["event_id"], to_timestamp(event["timestamp"])))
+            yield backend.add_event(event, batch_ids=["mybatch"])
+
+        # Fill the cache with some nonsense that we want to throw out when
+        # rebuilding.
+        yield self.batch_info_cache.add_inbound_message_key(
+            "mybatch", "inmsg", 12345)
+        yield self.batch_info_cache.add_outbound_message_key(
+            "mybatch", "outmsg", 23456)
+        yield self.batch_info_cache.add_event_key(
+            "mybatch", "event", "ack", 34567)
+
+        yield self.batch_info_cache.rebuild_cache_resumable(
+            "mybatch", qms, page_size=2, shard_boundaries=[
+                start + timedelta(seconds=2)])
+        yield self.assert_redis_keys([
+            "batches",
+            "batches:inbound:mybatch",
+            "batches:outbound:mybatch",
+            "batches:event:mybatch",
+            "batches:inbound_count:mybatch",
+            "batches:outbound_count:mybatch",
+            "batches:event_count:mybatch",
+            "batches:status:mybatch",
+            "batches:to_addr_hll:mybatch",
+            "batches:from_addr_hll:mybatch",
+        ])
+        yield self.assert_redis_set("batches", ["mybatch"])
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "5")
+        yield self.assert_redis_string("batches:outbound_count:mybatch", "4")
+        yield self.assert_redis_string("batches:event_count:mybatch", "3")
+        yield self.assert_redis_hash("batches:status:mybatch", {
+            "sent": "4",
+            "ack": "1",
+            "nack": "1",
+            "delivery_report": "1",
+            "delivery_report.delivered": "1",
+            "delivery_report.failed": "0",
+            "delivery_report.pending": "0",
+        })
+        yield self.assert_redis_zset("batches:inbound:mybatch", inbound_keys)
+        yield self.assert_redis_zset("batches:outbound:mybatch", outbound_keys)
+        yield self.assert_redis_zset("batches:event:mybatch", event_keys)
+        yield self.assert_redis_pfcount("batches:to_addr_hll:mybatch", 1)
+        yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 1)
+
+    @inlineCallbacks
+    def test_rebuild_cache_resumable_interrupted(self):
+        """
+        If a resumable rebuild is interrupted, the existing cached data is left
+        alone and the next rebuild continues from the last checkpoint instead
+        of starting over.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+
+        inbound_keys = []
+        for i in range(5):
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)),
+                from_addr="addr %s" % i)
+            inbound_keys.append(
+                (msg["message_id"], to_timestamp(msg["timestamp"])))
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+
+        yield self.batch_info_cache.add_inbound_message_key(
+            "mybatch", "inmsg", 12345)
+        self.batch_info_cache.TRUNCATE_MESSAGE_KEY_ZSET_AT = 3
+
+        # Fail when asked for anything after the first page of inbound
+        # messages.
+        list_calls = []
+        list_inbound = qms.list_batch_inbound_messages
+
+        def failing_list_inbound(batch_id, continuation=None, **kw):
+            list_calls.append(continuation)
+            if continuation is not None:
+                return fail(Exception("Interrupted."))
+            return list_inbound(batch_id, continuation=continuation, **kw)
+
+        self.patch(qms, "list_batch_inbound_messages", failing_list_inbound)
+        d = self.batch_info_cache.rebuild_cache_resumable(
+            "mybatch", qms, page_size=2)
+        yield self.assertFailure(d, Exception)
+        self.assertEqual(len(list_calls), 2)
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "1")
+        yield self.assert_redis_zset(
+            "batches:inbound:mybatch", [("inmsg", 12345)])
+        checkpoint = yield self.redis.hgetall(
+            "batches:rebuild_checkpoint:mybatch")
+        self.assertEqual(
+            sorted(checkpoint.keys()),
+            ["cutoff", "event:0", "inbound:0", "outbound:0", "shards"])
+
+        # Resume the rebuild without failing.
+        list_calls[:] = []
+
+        def recording_list_inbound(batch_id, continuation=None, **kw):
+            # Only the rebuild scans end at the cutoff. The listing of newer
+            # messages afterwards has no end.
+            if kw.get('end') is not None:
+                list_calls.append(continuation)
+            return list_inbound(batch_id, continuation=continuation, **kw)
+
+        self.patch(qms, "list_batch_inbound_messages", recording_list_inbound)
+        yield self.batch_info_cache.rebuild_cache_resumable(
+            "mybatch", qms, page_size=2)
+        self.assertEqual(len(list_calls), 2)
+        self.assertNotIn(None, list_calls)
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "5")
+        yield self.assert_redis_zset(
+            "batches:inbound:mybatch", inbound_keys[-3:])
+        yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 5)
+        rebuild_keys = yield self.redis.keys("batches:rebuild*")
+        self.assertEqual(rebuild_keys, [])
+
+    @inlineCallbacks
+    def test_rebuild_cache_resumable_live_writes(self):
+        """
+        Messages added while a resumable rebuild is running aren't lost when
+        the rebuilt data is swapped in, and aren't counted twice.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+        for i in range(3):
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)),
+                from_addr="addr %s" % i)
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+            yield self.batch_info_cache.add_inbound_message("mybatch", msg)
+
+        # Add a message the way the operational store does once the rebuild
+        # has scanned past the newest inbound messages.
+        live_msgs = []
+        list_inbound = qms.list_batch_inbound_messages
+
+        @inlineCallbacks
+        def list_inbound_with_live_write(batch_id, continuation=None, **kw):
+            if continuation is not None and not live_msgs:
+                msg = self.msg_helper.make_inbound(
+                    "live", from_addr="addr live")
+                live_msgs.append(msg)
+                yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+                yield self.batch_info_cache.add_inbound_message(
+                    "mybatch", msg)
+            page = yield list_inbound(
+                batch_id, continuation=continuation, **kw)
+            returnValue(page)
+
+        self.patch(
+            qms, "list_batch_inbound_messages", list_inbound_with_live_write)
+        yield self.batch_info_cache.rebuild_cache_resumable(
+            "mybatch", qms, page_size=2)
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "4")
+        keys = yield self.redis.zrange("batches:inbound:mybatch", 0, -1)
+        self.assertEqual(len(keys), 4)
+        self.assertIn(live_msgs[0]["message_id"], keys)
+        yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 4)
+
+    @inlineCallbacks
+    def test_rebuild_cache_resumable_back_dated_writes(self):
+        """
+        Messages added while a resumable rebuild is running with timestamps
+        in a part of the index that has already been scanned aren't lost when
+        the rebuilt data is swapped in, and messages the scans haven't reached
+        yet aren't counted twice.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+        for i in [0, 2, 4]:
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)),
+                from_addr="addr %s" % i)
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+            yield self.batch_info_cache.add_inbound_message("mybatch", msg)
+
+        # The index is listed newest first, so once the first page has been
+        # processed, the message at start + 3s is behind the scan and the one
+        # at start - 1s is still ahead of it.
+        live_msgs = []
+        list_inbound = qms.list_batch_inbound_messages
+
+        @inlineCallbacks
+        def list_inbound_with_live_writes(batch_id, continuation=None, **kw):
+            if continuation is not None and not live_msgs:
+                live_msgs.extend([
+                    self.msg_helper.make_inbound(
+                        "behind", from_addr="addr behind",
+                        timestamp=(start + timedelta(seconds=3))),
+                    self.msg_helper.make_inbound(
+                        "ahead", from_addr="addr ahead",
+                        timestamp=(start - timedelta(seconds=1))),
+                    self.msg_helper.make_outbound(
+                        "out", to_addr="addr out",
+                        timestamp=(start + timedelta(seconds=3))),
+                ])
+                for msg in live_msgs[:2]:
+                    yield backend.add_inbound_message(
+                        msg, batch_ids=["mybatch"])
+                    yield self.batch_info_cache.add_inbound_message(
+                        "mybatch", msg)
+                yield backend.add_outbound_message(
+                    live_msgs[2], batch_ids=["mybatch"])
+                yield self.batch_info_cache.add_outbound_message(
+                    "mybatch", live_msgs[2])
+            page = yield list_inbound(
+                batch_id, continuation=continuation, **kw)
+            returnValue(page)
+
+        self.patch(
+            qms, "list_batch_inbound_messages", list_inbound_with_live_writes)
+        yield self.batch_info_cache.rebuild_cache_resumable(
+            "mybatch", qms, page_size=2)
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "5")
+        yield self.assert_redis_string("batches:outbound_count:mybatch", "1")
+        status = yield self.batch_info_cache.get_batch_status("mybatch")
+        self.assertEqual(status["sent"], 1)
+        keys = yield self.redis.zrange("batches:inbound:mybatch", 0, -1)
+        self.assertEqual(len(keys), 5)
+        self.assertIn(live_msgs[0]["message_id"], keys)
+        self.assertIn(live_msgs[1]["message_id"], keys)
+        keys = yield self.redis.zrange("batches:outbound:mybatch", 0, -1)
+        self.assertEqual(keys, [live_msgs[2]["message_id"]])
+        yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 5)
+        yield self.assert_redis_pfcount("batches:to_addr_hll:mybatch", 1)
+        rebuild_keys = yield self.redis.keys("*rebuild*")
+        self.assertEqual(rebuild_keys, [])
+
+    @inlineCallbacks
+    def test_rebuild_cache_resumable_write_before_swap(self):
+        """
+        A back-dated event added after a resumable rebuild has read the keys
+        recorded for it, but before the rebuilt data is swapped in, is added
+        to the live keys after the swap.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+        msg = self.msg_helper.make_outbound("out", timestamp=start)
+        yield backend.add_outbound_message(msg, batch_ids=["mybatch"])
+        yield self.batch_info_cache.add_outbound_message("mybatch", msg)
+        ack = self.msg_helper.make_ack(
+            msg, timestamp=(start + timedelta(seconds=1)))
+
+        swap_keys = self.batch_info_cache._swap_keys
+
+        @inlineCallbacks
+        def swap_keys_after_write(*args):
+            yield backend.add_event(ack, batch_ids=["mybatch"])
+            yield self.batch_info_cache.add_event("mybatch", ack)
+            yield swap_keys(*args)
+
+        self.patch(self.batch_info_cache, "_swap_keys", swap_keys_after_write)
+        yield self.batch_info_cache.rebuild_cache_resumable("mybatch", qms)
+        yield self.assert_redis_string("batches:event_count:mybatch", "1")
+        yield self.assert_redis_zset(
+            "batches:event:mybatch",
+            [(ack["event_id"], to_timestamp(ack["timestamp"]))])
+        status = yield self.batch_info_cache.get_batch_status("mybatch")
+        self.assertEqual(status["ack"], 1)
+        self.assertEqual(status["sent"], 1)
+        rebuild_keys = yield self.redis.keys("*rebuild*")
+        self.assertEqual(rebuild_keys, [])
+
     @inlineCallbacks
     def test_rebuild_cache_uncached_batch(self):
         """
@@ -1205,6 +1972,57 @@ class TestBatchInfoCache(VumiTestCase):
                                      inbound_keys[-2:])
         yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 5)
 
+    @inlineCallbacks
+    def test_rebuild_cache_zadds_each_page_once(self):
+        """
+        Rebuilding the cache adds the most recent keys on each page with a
+        single zadd, and only truncates the zset after the last page.
+        """
+        riak_persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True))
+        manager = riak_persistence_helper.get_riak_manager()
+        self.add_cleanup(manager.close_manager)
+        qms = QueryMessageStore(manager, self.redis)
+        backend = qms.riak_backend
+
+        start = datetime.utcnow() - timedelta(seconds=10)
+
+        inbound_keys = []
+        for i in range(5):
+            msg = self.msg_helper.make_inbound(
+                "in %s" % (i,), timestamp=(start + timedelta(seconds=i)))
+            inbound_keys.append(
+                (msg["message_id"], to_timestamp(msg["timestamp"])))
+            yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+
+        zadds = []
+        zadd = self.redis.zadd
+
+        def recording_zadd(key, **valscores):
+            zadds.append((key, sorted(valscores.items(), key=lambda i: i[1])))
+            return zadd(key, **valscores)
+
+        self.patch(self.redis, "zadd", recording_zadd)
+        truncates = []
+        zremrangebyrank = self.redis.zremrangebyrank
+
+        def recording_zremrangebyrank(key, start, stop):
+            truncates.append(key)
+            return zremrangebyrank(key, start, stop)
+
+        self.patch(self.redis, "zremrangebyrank", recording_zremrangebyrank)
+        self.batch_info_cache.TRUNCATE_MESSAGE_KEY_ZSET_AT = 4
+
+        yield self.batch_info_cache.rebuild_cache("mybatch", qms, page_size=3)
+        self.assertEqual(zadds, [
+            ("batches:inbound:mybatch", inbound_keys[2:]),
+            ("batches:inbound:mybatch", inbound_keys[1:2]),
+        ])
+        self.assertEqual(truncates, ["batches:inbound:mybatch"])
+        yield self.assert_redis_string("batches:inbound_count:mybatch", "5")
+        yield self.assert_redis_zset(
+            "batches:inbound:mybatch", inbound_keys[-4:])
+
     @inlineCallbacks
     def test_rebuild_cache_outbound_messages_beyond_truncation(self):
         """
@@ -1440,3 +2258,109 @@ class TestBatchInfoCache(VumiTestCase):
         yield self.assert_redis_zset("batches:event:mybatch", event_keys[-2:])
         yield self.assert_redis_pfcount("batches:to_addr_hll:mybatch", 4)
         yield self.assert_redis_pfcount("batches:from_addr_hll:mybatch", 5)
+
+
+class TestBatchInfoCacheRedisServer(VumiTestCase):
+    """
+    Tests for commands and Lua scripts that only a real Redis server
+    supports. These are skipped unless ``VUMITEST_REDIS_DB`` is set.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.lua_cache = BatchInfoCache(self.redis)
+        self.lua_cache.USE_LUA_SCRIPTS = True
+        if not self.lua_cache._use_scripts():
+            raise SkipTest("These tests need a real Redis server.")
+        self.lua_cache.TRUNCATE_MESSAGE_KEY_ZSET_AT = 3
+        self.plain_cache = BatchInfoCache(self.redis)
+        self.plain_cache.TRUNCATE_MESSAGE_KEY_ZSET_AT = 3
+
+    @inlineCallbacks
+    def get_cache_state(self, cache, batch_id):
+        state = yield gather_results([
+            self.redis.zrange(
+                cache.inbound_key(batch_id), 0, -1, withscores=True),
+            self.redis.zrange(
+                cache.outbound_key(batch_id), 0, -1, withscores=True),
+            self.redis.zrange(
+                cache.event_key(batch_id), 0, -1, withscores=True),
+            cache.get_inbound_message_count(batch_id),
+            cache.get_outbound_message_count(batch_id),
+            cache.get_event_count(batch_id),
+            cache.get_batch_status(batch_id),
+        ])
+        returnValue(state)
+
+    @inlineCallbacks
+    def test_add_keys_script_matches_commands(self):
+        """
+        Adding keys with the Lua script gives the same keys, counters and
+        statuses as adding them with separate commands, and reports the same
+        number of new keys.
+        """
+        now = to_timestamp(datetime.utcnow())
+        calls = [
+            ('add_inbound_message_key', ("in-1", now)),
+            ('add_inbound_message_key', ("in-1", now)),
+            ('add_outbound_message_key', ("out-1", now)),
+            ('add_event_key', ("ev-1", "ack", now)),
+            ('add_event_key', ("ev-1", "ack", now)),
+            ('add_event_key', ("ev-2", "delivery_report.delivered", now + 1)),
+        ]
+        for i in range(5):
+            calls.append(
+                ('add_inbound_message_key', ("in-%d" % (i + 2,), now + i)))
+        results = {}
+        for name, cache in [('lua', self.lua_cache),
+                            ('plain', self.plain_cache)]:
+            yield cache.batch_start(name)
+            results[name] = []
+            for method, args in calls:
+                added = yield getattr(cache, method)(name, *args)
+                results[name].append(added)
+        self.assertEqual(results['lua'], results['plain'])
+
+        lua_state = yield self.get_cache_state(self.lua_cache, 'lua')
+        plain_state = yield self.get_cache_state(self.plain_cache, 'plain')
+        self.assertEqual(lua_state, plain_state)
+        self.assertEqual(len(lua_state[0]), 3)
+        self.assertEqual(lua_state[3:6], [6, 1, 2])
+
+    @inlineCallbacks
+    def test_get_merged_addr_count(self):
+        """
+        Merged address counts don't count addresses in several batches more
+        than once.
+        """
+        yield self.lua_cache.add_from_addr("batch-1", "addr-1", "addr-2")
+        yield self.lua_cache.add_from_addr("batch-2", "addr-2", "addr-3")
+        count = yield self.lua_cache.get_merged_from_addr_count(
+            ["batch-1", "batch-2"])
+        self.assertEqual(count, 3)
+
+    @inlineCallbacks
+    def test_swap_keys_script_matches_commands(self):
+        """
+        Swapping keys with the Lua script deletes the checkpoint, renames
+        each shadow key that exists over its live key and deletes the live
+        keys without a shadow key, the same as swapping them with separate
+        commands.
+        """
+        for name, cache in [('lua', self.lua_cache),
+                            ('plain', self.plain_cache)]:
+            yield self.redis.hmset(
+                "%s:checkpoint" % (name,), {"cutoff": "whenever"})
+            yield self.redis.set("%s:shadow-1" % (name,), "new")
+            yield self.redis.set("%s:live-1" % (name,), "old")
+            yield self.redis.set("%s:live-2" % (name,), "old")
+            yield cache._swap_keys("%s:checkpoint" % (name,), [
+                ("%s:shadow-1" % (name,), "%s:live-1" % (name,)),
+                ("%s:shadow-2" % (name,), "%s:live-2" % (name,)),
+            ])
+            keys = yield self.redis.keys("%s:*" % (name,))
+            self.assertEqual(keys, ["%s:live-1" % (name,)])
+            value = yield self.redis.get("%s:live-1" % (name,))
+            self.assertEqual(value, "new")
@@ -1,9 +1,10 @@
 """
 Tests for vumi_message_store.message_store.
 """
+import json
 from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, fail, inlineCallbacks
 from vumi.tests.helpers import VumiTestCase, MessageHelper, PersistenceHelper
 from zope.interface.verify import verifyObject
 
@@ -295,6 +296,87 @@ class TestOperationalMessageStore(VumiTestCase):
             yield self.bi_cache.get_inbound_message_count("yourbatch"))
         self.assertEqual(yourkeys_count, 1)
 
+    @inlineCallbacks
+    def test_add_inbound_message_cache_after_riak(self):
+        """
+        When an inbound message is added, the batch info caches are only
+        updated once the Riak write has finished, and are all updated
+        together.
+        """
+        riak_d = Deferred()
+        self.patch(
+            self.backend, "add_inbound_message", lambda *a, **kw: riak_d)
+        cache_updates = []
+        self.patch(
+            self.bi_cache, "add_inbound_message",
+            lambda batch_id, msg: cache_updates.append(batch_id))
+        msg = self.msg_helper.make_inbound("apples")
+        d = self.store.add_inbound_message(
+            msg, batch_ids=["mybatch", "yourbatch"])
+        self.assertEqual(cache_updates, [])
+        riak_d.callback(None)
+        yield d
+        self.assertEqual(cache_updates, ["mybatch", "yourbatch"])
+
+    @inlineCallbacks
+    def test_add_inbound_message_riak_failure(self):
+        """
+        If the Riak write fails, the message isn't counted in the batch info
+        cache.
+        """
+        yield self.bi_cache.batch_start("mybatch")
+        self.patch(
+            self.backend, "add_inbound_message",
+            lambda *a, **kw: fail(ValueError("Riak is down")))
+        msg = self.msg_helper.make_inbound("apples")
+        d = self.store.add_inbound_message(msg, batch_ids=["mybatch"])
+        yield self.assertFailure(d, ValueError)
+        count = yield self.bi_cache.get_inbound_message_count("mybatch")
+        self.assertEqual(count, 0)
+
+    @inlineCallbacks
+    def test_add_inbound_message_blind_writes(self):
+        """
+        A store created with blind writes enabled doesn't merge batches with
+        an existing record, but still updates the batch info cache.
+        """
+        store = OperationalMessageStore(
+            self.manager, self.redis, blind_writes=True)
+        yield self.bi_cache.batch_start("yourbatch")
+        msg = self.msg_helper.make_inbound("apples")
+        yield store.add_inbound_message(msg, batch_ids=["mybatch"])
+        yield store.add_inbound_message(msg, batch_ids=["yourbatch"])
+        stored_msg = yield self.backend.get_raw_inbound_message(
+            msg["message_id"])
+        self.assertEqual(stored_msg.batches.keys(), ["yourbatch"])
+        batch_keys_count = (
+            yield self.bi_cache.get_inbound_message_count("yourbatch"))
+        self.assertEqual(batch_keys_count, 1)
+
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        """
+        When several inbound messages are added, they are all stored in Riak
+        and added to the info caches of all the specified batches.
+        """
+        yield self.bi_cache.batch_start("mybatch")
+        yield self.bi_cache.batch_start("yourbatch")
+        msgs = [self.msg_helper.make_inbound("apples %s" % (i,))
+                for i in range(3)]
+        yield self.store.add_inbound_messages(
+            msgs, batch_ids=["mybatch", "yourbatch"])
+        for msg in msgs:
+            stored_msg = yield self.backend.get_raw_inbound_message(
+                msg["message_id"])
+            self.assertEqual(stored_msg.msg, msg)
+            self.assertEqual(
+                sorted(stored_msg.batches.keys()), ["mybatch", "yourbatch"])
+        mykeys_count = yield self.bi_cache.get_inbound_message_count("mybatch")
+        self.assertEqual(mykeys_count, 3)
+        yourkeys_count = (
+            yield self.bi_cache.get_inbound_message_count("yourbatch"))
+        self.assertEqual(yourkeys_count, 3)
+
     @inlineCallbacks
     def test_add_inbound_message_to_new_batch(self):
         """
@@ -413,6 +495,31 @@ class TestOperationalMessageStore(VumiTestCase):
             yield self.bi_cache.get_outbound_message_count("yourbatch"))
         self.assertEqual(yourkeys_count, 1)
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        """
+        When several outbound messages are added, they are all stored in Riak
+        and added to the info caches of all the specified batches.
+        """
+        yield self.bi_cache.batch_start("mybatch")
+        yield self.bi_cache.batch_start("yourbatch")
+        msgs = [self.msg_helper.make_outbound("apples %s" % (i,))
+                for i in range(3)]
+        yield self.store.add_outbound_messages(
+            msgs, batch_ids=["mybatch", "yourbatch"])
+        for msg in msgs:
+            stored_msg = yield self.backend.get_raw_outbound_message(
+                msg["message_id"])
+            self.assertEqual(stored_msg.msg, msg)
+            self.assertEqual(
+                sorted(stored_msg.batches.keys()), ["mybatch", "yourbatch"])
+        mykeys_count = (
+            yield self.bi_cache.get_outbound_message_count("mybatch"))
+        self.assertEqual(mykeys_count, 3)
+        yourkeys_count = (
+            yield self.bi_cache.get_outbound_message_count("yourbatch"))
+        self.assertEqual(yourkeys_count, 3)
+
     @inlineCallbacks
     def test_add_outbound_message_to_new_batch(self):
         """
@@ -537,6 +644,27 @@ class TestOperationalMessageStore(VumiTestCase):
         yourkeys_count = yield self.bi_cache.get_event_count("yourbatch")
         self.assertEqual(yourkeys_count, 1)
 
+    @inlineCallbacks
+    def test_add_events(self):
+        """
+        When several events are added, they are all stored in Riak and added
+        to the info caches of all the specified batches.
+        """
+        yield self.bi_cache.batch_start("mybatch")
+        yield self.bi_cache.batch_start("yourbatch")
+        msg = self.msg_helper.make_outbound("apples")
+        acks = [self.msg_helper.make_ack(msg) for _ in range(3)]
+        yield self.store.add_events(acks, batch_ids=["mybatch", "yourbatch"])
+        for ack in acks:
+            stored_event = yield self.backend.get_raw_event(ack["event_id"])
+            self.assertEqual(stored_event.event, ack)
+            self.assertEqual(
+                sorted(stored_event.batches.keys()), ["mybatch", "yourbatch"])
+        mykeys_count = yield self.bi_cache.get_event_count("mybatch")
+        self.assertEqual(mykeys_count, 3)
+        yourkeys_count = yield self.bi_cache.get_event_count("yourbatch")
+        self.assertEqual(yourkeys_count, 3)
+
     @inlineCallbacks
     def test_add_ack_event_to_new_batch(self):
         """
@@ -695,6 +823,49 @@ class TestQueryMessageStore(VumiTestCase):
         stored_record = yield self.store.get_event("badevent")
         self.assertEqual(stored_record, None)
 
+    @inlineCallbacks
+    def test_get_inbound_message_json(self):
+        """
+        When we ask for an inbound message as JSON, we get the message
+        serialised as JSON.
+        """
+        msg = self.msg_helper.make_inbound("apples")
+        yield self.backend.add_inbound_message(msg)
+        stored_json = yield self.store.get_inbound_message_json(
+            msg["message_id"])
+        self.assertEqual(json.loads(stored_json), json.loads(msg.to_json()))
+
+    @inlineCallbacks
+    def test_get_outbound_message_json(self):
+        """
+        When we ask for an outbound message as JSON, we get the message
+        serialised as JSON.
+        """
+        msg = self.msg_helper.make_outbound("apples")
+        yield self.backend.add_outbound_message(msg)
+        stored_json = yield self.store.get_outbound_message_json(
+            msg["message_id"])
+        self.assertEqual(json.loads(stored_json), json.loads(msg.to_json()))
+
+    @inlineCallbacks
+    def test_get_event_json(self):
+        """
+        When we ask for an event as JSON, we get the event serialised as JSON.
+        """
+        msg = self.msg_helper.make_outbound("apples")
+        ack = self.msg_helper.make_ack(msg)
+        yield self.backend.add_event(ack)
+        stored_json = yield self.store.get_event_json(ack["event_id"])
+        self.assertEqual(json.loads(stored_json), json.loads(ack.to_json()))
+
+    @inlineCallbacks
+    def test_get_event_json_missing(self):
+        """
+        When we ask for an event that does not exist as JSON, we get ``None``.
+        """
+        stored_json = yield self.store.get_event_json("badevent")
+        self.assertEqual(stored_json, None)
+
     @inlineCallbacks
     def test_list_batch_inbound_messages(self):
         """
@@ -935,6 +1106,23 @@ class TestQueryMessageStore(VumiTestCase):
         keys_page = yield self.store.list_message_events("badmsg")
         self.assertEqual(list(keys_page), [])
 
+    @inlineCallbacks
+    def test_iter_batch_outbound_messages(self):
+        """
+        We can iterate over pages of full outbound messages for a batch.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_outbound_message_sequence())
+        msg_pages = yield self.store.iter_batch_outbound_messages(
+            batch_id, page_size=3, concurrency=2)
+        msgs_p1 = yield msg_pages.next_page()
+        msgs_p2 = yield msg_pages.next_page()
+        self.assertEqual(
+            [msg["message_id"] for msg in msgs_p1 + msgs_p2],
+            [key for key, _, _ in all_keys])
+        msgs_p3 = yield msg_pages.next_page()
+        self.assertEqual(msgs_p3, None)
+
     @inlineCallbacks
     def test_get_batch_info_status(self):
         """
@@ -1072,6 +1260,82 @@ class TestQueryMessageStore(VumiTestCase):
         count = yield self.store.get_batch_to_addr_count("batch")
         self.assertEqual(count, 0)
 
+    @inlineCallbacks
+    def test_get_batch_summary(self):
+        """
+        The batch status and all the counters can be queried together.
+        """
+        yield self.bi_cache.batch_start("batch")
+        yield self.bi_cache.add_inbound_message_count("batch", 4)
+        yield self.bi_cache.add_outbound_message_count("batch", 3)
+        yield self.bi_cache.add_event_count(
+            "batch", "delivery_report.delivered", 1)
+        yield self.bi_cache.add_from_addr("batch", "addr-1")
+        yield self.bi_cache.add_to_addr("batch", "addr-1", "addr-2")
+
+        summary = yield self.store.get_batch_summary("batch")
+        self.assertEqual(summary, {
+            "status": {
+                "sent": 3,
+                "ack": 0,
+                "nack": 0,
+                "delivery_report": 1,
+                "delivery_report.delivered": 1,
+                "delivery_report.failed": 0,
+                "delivery_report.pending": 0,
+            },
+            "inbound_count": 4,
+            "outbound_count": 3,
+            "event_count": 1,
+            "from_addr_count": 1,
+            "to_addr_count": 2,
+        })
+
+    @inlineCallbacks
+    def test_get_counts_for_batches(self):
+        """
+        The statuses and counters for several batches can be queried together.
+        """
+        yield self.bi_cache.batch_start("batch-1")
+        yield self.bi_cache.add_inbound_message_count("batch-1", 4)
+        yield self.bi_cache.batch_start("batch-2")
+        yield self.bi_cache.add_event_count("batch-2", "nack", 2)
+
+        counts = yield self.store.get_counts_for_batches(
+            ["batch-1", "batch-2"])
+        self.assertEqual(sorted(counts.keys()), ["batch-1", "batch-2"])
+        self.assertEqual(counts["batch-1"]["inbound_count"], 4)
+        self.assertEqual(counts["batch-2"]["event_count"], 2)
+        self.assertEqual(counts["batch-2"]["status"]["nack"], 2)
+
+    @inlineCallbacks
+    def test_get_merged_addr_counts(self):
+        """
+        The merged address counts for a single batch can be queried.
+        """
+        yield self.bi_cache.add_from_addr("batch", "addr-1", "addr-2")
+        yield self.bi_cache.add_to_addr("batch", "addr-1")
+        count = yield self.store.get_merged_from_addr_count(["batch"])
+        self.assertEqual(count, 2)
+        count = yield self.store.get_merged_to_addr_count(["batch"])
+        self.assertEqual(count, 1)
+
+    @inlineCallbacks
+    def test_get_batch_summaries(self):
+        """
+        Summaries for several batches can be queried together.
+        """
+        yield self.bi_cache.batch_start("batch-1")
+        yield self.bi_cache.add_inbound_message_count("batch-1", 4)
+        yield self.bi_cache.batch_start("batch-2")
+        yield self.bi_cache.add_inbound_message_count("batch-2", 2)
+
+        summaries = yield self.store.get_batch_summaries(
+            ["batch-1", "batch-2"])
+        self.assertEqual(sorted(summaries.keys()), ["batch-1", "batch-2"])
+        self.assertEqual(summaries["batch-1"]["inbound_count"], 4)
+        self.assertEqual(summaries["batch-2"]["inbound_count"], 2)
+
     @inlineCallbacks
     def test_list_batch_events(self):
         """
@@ -0,0 +1,168 @@
+"""
+Tests for vumi_message_store.redis_commands.
+"""
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.trial.unittest import SkipTest
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vumi_message_store.batch_info_cache import RedisScript
+from vumi_message_store import redis_commands
+from vumi_message_store.redis_commands import RedisCommands
+
+
+GET_SCRIPT = RedisScript("return redis.call('GET', KEYS[1])")
+
+
+class FakeCommandClient(object):
+    """
+    Just enough of a txredis client to check which commands are sent.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.commands = []
+
+    def mget(self, *keys):
+        self.commands.append(("MGET",) + keys)
+        return succeed(self.response)
+
+    def _send(self, *args):
+        self.commands.append(args)
+
+    def getResponse(self):
+        return succeed(self.response)
+
+
+class TestRedisCommands(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.commands = RedisCommands(self.redis)
+
+    def use_command_client(self, response):
+        """
+        Replace the manager's client with a :class:`FakeCommandClient` that is
+        treated as a txredis client.
+        """
+        client = FakeCommandClient(response)
+        self.patch(redis_commands, "VumiRedis", FakeCommandClient)
+        self.patch(self.commands, "_client", lambda: client)
+        return client
+
+    def require_scripting(self):
+        if not self.commands.supports_scripting():
+            raise SkipTest("This test needs a real Redis server.")
+
+    @inlineCallbacks
+    def test_run_script_without_scripting(self):
+        """
+        If the client can't run Lua scripts, running one fails instead of
+        sending anything to Redis.
+        """
+        if self.commands.supports_scripting():
+            raise SkipTest("This test needs a fake Redis client.")
+        d = self.commands.run_script(GET_SCRIPT, ["foo"])
+        yield self.assertFailure(d, NotImplementedError)
+
+    @inlineCallbacks
+    def test_run_script_prefixes_keys(self):
+        """
+        Keys passed to a script get the manager's key prefix, so the script
+        sees the same keys the manager's own commands do.
+        """
+        self.require_scripting()
+        yield self.redis.set("foo", "bar")
+        value = yield self.commands.run_script(GET_SCRIPT, ["foo"])
+        self.assertEqual(value, "bar")
+
+    @inlineCallbacks
+    def test_mget(self):
+        """
+        We get the value of each key, or ``None`` if it doesn't exist.
+        """
+        yield self.redis.set("foo", "1")
+        yield self.redis.set("baz", "3")
+        values = yield self.commands.mget(["foo", "bar", "baz"])
+        self.assertEqual(values, ["1", None, "3"])
+        values = yield self.commands.mget([])
+        self.assertEqual(values, [])
+
+    @inlineCallbacks
+    def test_mget_txredis(self):
+        """
+        A txredis client gets all the keys, with the manager's prefix, in a
+        single MGET.
+        """
+        client = self.use_command_client(["1", None])
+        values = yield self.commands.mget(["foo", "bar"])
+        self.assertEqual(values, ["1", None])
+        self.assertEqual(client.commands, [
+            ("MGET", self.redis._key("foo"), self.redis._key("bar")),
+        ])
+
+    @inlineCallbacks
+    def test_pfcount(self):
+        """
+        We get the number of unique values across all the keys, and missing
+        keys count as empty.
+        """
+        yield self.redis.pfadd("hll-1", "a", "b")
+        yield self.redis.pfadd("hll-2", "b", "c")
+        count = yield self.commands.pfcount(["hll-1", "hll-2", "hll-3"])
+        self.assertEqual(count, 3)
+        count = yield self.commands.pfcount(["hll-1"])
+        self.assertEqual(count, 2)
+        count = yield self.commands.pfcount(["hll-3", "hll-4"])
+        self.assertEqual(count, 0)
+        count = yield self.commands.pfcount([])
+        self.assertEqual(count, 0)
+
+    @inlineCallbacks
+    def test_pfcount_leaves_keys_unchanged(self):
+        """
+        Counting several keys doesn't merge them into the first one.
+        """
+        yield self.redis.pfadd("hll-1", "a")
+        yield self.redis.pfadd("hll-2", "b")
+        yield self.commands.pfcount(["hll-1", "hll-2"])
+        count = yield self.redis.pfcount("hll-1")
+        self.assertEqual(count, 1)
+
+    @inlineCallbacks
+    def test_pfcount_txredis(self):
+        """
+        A txredis client counts all the keys, with the manager's prefix, in a
+        single PFCOUNT.
+        """
+        client = self.use_command_client(3)
+        count = yield self.commands.pfcount(["hll-1", "hll-2"])
+        self.assertEqual(count, 3)
+        self.assertEqual(client.commands, [
+            ("PFCOUNT", self.redis._key("hll-1"), self.redis._key("hll-2")),
+        ])
+
+
+class TestRedisCommandsSync(VumiTestCase):
+
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(is_sync=True))
+        self.redis = self.persistence_helper.get_redis_manager()
+        self.commands = RedisCommands(self.redis)
+
+    def test_mget(self):
+        """
+        A sync manager gets the values back directly.
+        """
+        self.redis.set("foo", "1")
+        self.assertEqual(self.commands.mget(["foo", "bar"]), ["1", None])
+
+    def test_pfcount(self):
+        """
+        A sync manager gets the count back directly.
+        """
+        self.redis.pfadd("hll-1", "a", "b")
+        self.redis.pfadd("hll-2", "b", "c")
+        self.assertEqual(self.commands.pfcount(["hll-1", "hll-2"]), 3)
@@ -3,8 +3,10 @@
 """
 Tests for vumi_message_store.riak_backend.
 """
-from twisted.internet.defer import inlineCallbacks
-from vumi.message import format_vumi_date
+import json
+
+from twisted.internet.defer import Deferred, inlineCallbacks
+from vumi.message import TransportUserMessage, format_vumi_date
 from vumi.tests.helpers import MessageHelper, VumiTestCase, PersistenceHelper
 
 from vumi_message_store.memory_backend_manager import (
@@ -13,7 +15,8 @@ from vumi_message_store.models import (
     to_reverse_timestamp,
     Batch, CurrentTag, InboundMessage, OutboundMessage, Event)
 from vumi_message_store.riak_backend import (
-    MessageStoreRiakBackend, key_with_ts_and_value_formatter)
+    IndexPageWrapper, MessageStoreRiakBackend,
+    key_with_ts_and_value_formatter)
 from vumi_message_store.tests.helpers import MessageSequenceHelper
 
 
@@ -267,6 +270,79 @@ class RiakBackendTestMixin(object):
              "%s$%s$%s" % ("yourbatch", reverse_ts, msg['from_addr'])),
         ]))
 
+    @inlineCallbacks
+    def test_add_inbound_message_blind_write(self):
+        """
+        When an inbound message is added with a blind write, the existing
+        record isn't loaded and is replaced.
+        """
+        inbound_messages = self.manager.proxy(InboundMessage)
+        msg = self.msg_helper.make_inbound("apples")
+        yield self.backend.add_inbound_message(msg, batch_ids=["mybatch"])
+
+        self.patch(self.backend.inbound_messages, "load", lambda *a: 1 / 0)
+        yield self.backend.add_inbound_message(
+            msg, batch_ids=["yourbatch"], blind_write=True)
+        stored_msg = yield inbound_messages.load(msg["message_id"])
+        self.assertEqual(stored_msg.msg, msg)
+        self.assertEqual(stored_msg.batches.keys(), ["yourbatch"])
+
+    @inlineCallbacks
+    def test_add_inbound_message_blind_write_indexes(self):
+        """
+        A blind write of a new inbound message indexes it the same way as a
+        normal write, but a blind write of a message that was stored before
+        removes it from the batch indexes it was already in.
+        """
+        msg = self.msg_helper.make_inbound("apples")
+        yield self.backend.add_inbound_message(
+            msg, batch_ids=["mybatch"], blind_write=True)
+        page = yield self.backend.list_batch_inbound_messages("mybatch")
+        self.assertEqual([key for key, _, _ in page], [msg["message_id"]])
+
+        yield self.backend.add_inbound_message(
+            msg, batch_ids=["yourbatch"], blind_write=True)
+        page = yield self.backend.list_batch_inbound_messages("mybatch")
+        self.assertEqual(list(page), [])
+        page = yield self.backend.list_batch_inbound_messages("yourbatch")
+        self.assertEqual([key for key, _, _ in page], [msg["message_id"]])
+
+    @inlineCallbacks
+    def test_add_inbound_message_blind_writes_backend(self):
+        """
+        A backend with blind writes enabled doesn't load the existing record
+        unless the write asks it to.
+        """
+        inbound_messages = self.manager.proxy(InboundMessage)
+        backend = MessageStoreRiakBackend(self.manager, blind_writes=True)
+        msg = self.msg_helper.make_inbound("apples")
+        yield backend.add_inbound_message(msg, batch_ids=["mybatch"])
+        yield backend.add_inbound_message(msg, batch_ids=["yourbatch"])
+        stored_msg = yield inbound_messages.load(msg["message_id"])
+        self.assertEqual(stored_msg.batches.keys(), ["yourbatch"])
+
+        yield backend.add_inbound_message(
+            msg, batch_ids=["mybatch"], blind_write=False)
+        stored_msg = yield inbound_messages.load(msg["message_id"])
+        self.assertEqual(
+            sorted(stored_msg.batches.keys()), ["mybatch", "yourbatch"])
+
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        """
+        When several inbound messages are added, they are all stored in Riak
+        with the specified batch identifiers.
+        """
+        inbound_messages = self.manager.proxy(InboundMessage)
+        msgs = [self.msg_helper.make_inbound("apples %s" % (i,))
+                for i in range(5)]
+        yield self.backend.add_inbound_messages(
+            msgs, batch_ids=["mybatch"], concurrency=2)
+        for msg in msgs:
+            stored_msg = yield inbound_messages.load(msg["message_id"])
+            self.assertEqual(stored_msg.msg, msg)
+            self.assertEqual(stored_msg.batches.keys(), ["mybatch"])
+
     @inlineCallbacks
     def test_get_raw_inbound_message(self):
         """
@@ -318,6 +394,32 @@ class RiakBackendTestMixin(object):
         stored_record = yield self.backend.get_inbound_message("badmsg")
         self.assertEqual(stored_record, None)
 
+    @inlineCallbacks
+    def test_get_inbound_message_json(self):
+        """
+        When we ask for an inbound message as JSON, we get the message
+        serialised as JSON.
+        """
+        inbound_messages = self.manager.proxy(InboundMessage)
+        msg = self.msg_helper.make_inbound("apples")
+        msg_record = inbound_messages(msg["message_id"], msg=msg)
+        msg_record.batches.add_key("mybatch")
+        yield msg_record.save()
+
+        stored_json = yield self.backend.get_inbound_message_json(
+            msg["message_id"])
+        self.assertEqual(json.loads(stored_json), json.loads(msg.to_json()))
+        self.assertEqual(TransportUserMessage.from_json(stored_json), msg)
+
+    @inlineCallbacks
+    def test_get_inbound_message_json_missing(self):
+        """
+        When we ask for an inbound message that does not exist as JSON, we get
+        ``None``.
+        """
+        stored_json = yield self.backend.get_inbound_message_json("badmsg")
+        self.assertEqual(stored_json, None)
+
     @inlineCallbacks
     def test_add_outbound_message(self):
         """
@@ -436,6 +538,39 @@ class RiakBackendTestMixin(object):
              "%s$%s$%s" % ("yourbatch", reverse_ts, msg['to_addr'])),
         ]))
 
+    @inlineCallbacks
+    def test_add_outbound_message_blind_write(self):
+        """
+        When an outbound message is added with a blind write, the existing
+        record isn't loaded and is replaced.
+        """
+        outbound_messages = self.manager.proxy(OutboundMessage)
+        msg = self.msg_helper.make_outbound("apples")
+        yield self.backend.add_outbound_message(msg, batch_ids=["mybatch"])
+
+        self.patch(self.backend.outbound_messages, "load", lambda *a: 1 / 0)
+        yield self.backend.add_outbound_message(
+            msg, batch_ids=["yourbatch"], blind_write=True)
+        stored_msg = yield outbound_messages.load(msg["message_id"])
+        self.assertEqual(stored_msg.msg, msg)
+        self.assertEqual(stored_msg.batches.keys(), ["yourbatch"])
+
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        """
+        When several outbound messages are added, they are all stored in Riak
+        with the specified batch identifiers.
+        """
+        outbound_messages = self.manager.proxy(OutboundMessage)
+        msgs = [self.msg_helper.make_outbound("apples %s" % (i,))
+                for i in range(5)]
+        yield self.backend.add_outbound_messages(
+            msgs, batch_ids=["mybatch"], concurrency=2)
+        for msg in msgs:
+            stored_msg = yield outbound_messages.load(msg["message_id"])
+            self.assertEqual(stored_msg.msg, msg)
+            self.assertEqual(stored_msg.batches.keys(), ["mybatch"])
+
     @inlineCallbacks
     def test_get_raw_outbound_message(self):
         """
@@ -487,6 +622,31 @@ class RiakBackendTestMixin(object):
         stored_record = yield self.backend.get_outbound_message("badmsg")
         self.assertEqual(stored_record, None)
 
+    @inlineCallbacks
+    def test_get_outbound_message_json(self):
+        """
+        When we ask for an outbound message as JSON, we get the message
+        serialised as JSON.
+        """
+        outbound_messages = self.manager.proxy(OutboundMessage)
+        msg = self.msg_helper.make_outbound("apples")
+        msg_record = outbound_messages(msg["message_id"], msg=msg)
+        msg_record.batches.add_key("mybatch")
+        yield msg_record.save()
+
+        stored_json = yield self.backend.get_outbound_message_json(
+            msg["message_id"])
+        self.assertEqual(json.loads(stored_json), json.loads(msg.to_json()))
+
+    @inlineCallbacks
+    def test_get_outbound_message_json_missing(self):
+        """
+        When we ask for an outbound message that does not exist as JSON, we
+        get ``None``.
+        """
+        stored_json = yield self.backend.get_outbound_message_json("badmsg")
+        self.assertEqual(stored_json, None)
+
     @inlineCallbacks
     def test_add_ack_event(self):
         """
@@ -638,6 +798,41 @@ class RiakBackendTestMixin(object):
              "%s$%s$%s" % ("yourbatch", reverse_ts, "ack")),
         ]))
 
+    @inlineCallbacks
+    def test_add_ack_event_blind_write(self):
+        """
+        When an event is added with a blind write, the existing record isn't
+        loaded and is replaced.
+        """
+        events = self.manager.proxy(Event)
+        msg = self.msg_helper.make_outbound("apples")
+        ack = self.msg_helper.make_ack(msg)
+        yield self.backend.add_event(ack, batch_ids=["mybatch"])
+
+        self.patch(self.backend.events, "load", lambda *a: 1 / 0)
+        yield self.backend.add_event(
+            ack, batch_ids=["yourbatch"], blind_write=True)
+        stored_event = yield events.load(ack["event_id"])
+        self.assertEqual(stored_event.event, ack)
+        self.assertEqual(stored_event.message.key, ack["user_message_id"])
+        self.assertEqual(stored_event.batches.keys(), ["yourbatch"])
+
+    @inlineCallbacks
+    def test_add_events(self):
+        """
+        When several events are added, they are all stored in Riak with the
+        specified batch identifiers.
+        """
+        events = self.manager.proxy(Event)
+        msg = self.msg_helper.make_outbound("apples")
+        acks = [self.msg_helper.make_ack(msg) for _ in range(5)]
+        yield self.backend.add_events(
+            acks, batch_ids=["mybatch"], concurrency=2)
+        for ack in acks:
+            stored_event = yield events.load(ack["event_id"])
+            self.assertEqual(stored_event.event, ack)
+            self.assertEqual(stored_event.batches.keys(), ["mybatch"])
+
     @inlineCallbacks
     def test_get_raw_event(self):
         """
@@ -685,6 +880,29 @@ class RiakBackendTestMixin(object):
         stored_record = yield self.backend.get_event("badevent")
         self.assertEqual(stored_record, None)
 
+    @inlineCallbacks
+    def test_get_event_json(self):
+        """
+        When we ask for an event as JSON, we get the event serialised as JSON.
+        """
+        events = self.manager.proxy(Event)
+        msg = self.msg_helper.make_outbound("apples")
+        ack = self.msg_helper.make_ack(msg)
+        event_record = events(
+            ack["event_id"], event=ack, message=ack["user_message_id"])
+        yield event_record.save()
+
+        stored_json = yield self.backend.get_event_json(ack["event_id"])
+        self.assertEqual(json.loads(stored_json), json.loads(ack.to_json()))
+
+    @inlineCallbacks
+    def test_get_event_json_missing(self):
+        """
+        When we ask for an event that does not exist as JSON, we get ``None``.
+        """
+        stored_json = yield self.backend.get_event_json("badevent")
+        self.assertEqual(stored_json, None)
+
     @inlineCallbacks
     def test_list_batch_inbound_messages(self):
         """
@@ -750,6 +968,159 @@ class RiakBackendTestMixin(object):
         keys_p2 = yield keys_p1.next_page()
         self.assertEqual(list(keys_p2), all_keys[3:-1])
 
+    @inlineCallbacks
+    def test_list_batch_inbound_messages_continuation(self):
+        """
+        When we ask for a list of inbound messages for a batch, we can pass
+        the continuation token from an earlier page to get the following page.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        keys_p1 = yield self.backend.list_batch_inbound_messages(
+            batch_id, page_size=3)
+        self.assertNotEqual(keys_p1.continuation, None)
+        keys_p2 = yield self.backend.list_batch_inbound_messages(
+            batch_id, page_size=3, continuation=keys_p1.continuation)
+        self.assertEqual(list(keys_p2), all_keys[3:])
+        self.assertEqual(keys_p2.continuation, None)
+
+    @inlineCallbacks
+    def test_iter_pages(self):
+        """
+        We can iterate over all the pages of an index listing.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        keys_page = yield self.backend.list_batch_inbound_messages(
+            batch_id, page_size=2)
+        pages = keys_page.iter_pages()
+        keys = []
+        page = yield pages.next_page()
+        while page is not None:
+            keys.extend(page)
+            page = yield pages.next_page()
+        self.assertEqual(keys, all_keys)
+        page = yield pages.next_page()
+        self.assertEqual(page, None)
+
+    @inlineCallbacks
+    def test_iter_pages_prefetch(self):
+        """
+        Pages are fetched ahead of the page being processed, but no more than
+        the requested number of pages are held.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        keys_page = yield self.backend.list_batch_inbound_messages(
+            batch_id, page_size=1)
+        fetches = []
+        next_page = IndexPageWrapper.next_page
+
+        def recording_next_page(page):
+            fetches.append(list(page))
+            return next_page(page)
+
+        self.patch(IndexPageWrapper, "next_page", recording_next_page)
+
+        pages = keys_page.iter_pages(prefetch=2)
+        page = yield pages.next_page()
+        self.assertEqual(list(page), all_keys[0:1])
+        # We've been given the first page and have fetched the two after it.
+        self.assertEqual(fetches, [all_keys[0:1], all_keys[1:2]])
+
+        page = yield pages.next_page()
+        self.assertEqual(list(page), all_keys[1:2])
+        self.assertEqual(
+            fetches, [all_keys[0:1], all_keys[1:2], all_keys[2:3]])
+
+    @inlineCallbacks
+    def test_iter_pages_failure(self):
+        """
+        If fetching a page fails, we get all the pages before it and then the
+        failure.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        keys_page = yield self.backend.list_batch_inbound_messages(
+            batch_id, page_size=3)
+        self.patch(IndexPageWrapper, "next_page", lambda page: 1 / 0)
+
+        pages = keys_page.iter_pages()
+        page = yield pages.next_page()
+        self.assertEqual(list(page), all_keys[:3])
+        try:
+            yield pages.next_page()
+        except ZeroDivisionError:
+            pass
+        else:
+            self.fail("Expected ZeroDivisionError.")
+
+    @inlineCallbacks
+    def test_iter_batch_inbound_messages(self):
+        """
+        We can iterate over pages of full inbound messages for a batch in
+        descending timestamp order.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        msg_pages = yield self.backend.iter_batch_inbound_messages(
+            batch_id, page_size=3)
+        msgs_p1 = yield msg_pages.next_page()
+        self.assertEqual(
+            [msg["message_id"] for msg in msgs_p1],
+            [key for key, _, _ in all_keys[:3]])
+        msgs_p2 = yield msg_pages.next_page()
+        self.assertEqual(
+            [msg["message_id"] for msg in msgs_p2],
+            [key for key, _, _ in all_keys[3:]])
+        msgs_p3 = yield msg_pages.next_page()
+        self.assertEqual(msgs_p3, None)
+
+    @inlineCallbacks
+    def test_iter_batch_inbound_messages_range(self):
+        """
+        When we iterate over inbound messages for a batch, we can specify both
+        ends of the range.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        msg_pages = yield self.backend.iter_batch_inbound_messages(
+            batch_id, start=all_keys[-2][1], end=all_keys[1][1])
+        msgs = yield msg_pages.next_page()
+        self.assertEqual(
+            [msg["message_id"] for msg in msgs],
+            [key for key, _, _ in all_keys[1:-1]])
+
+    @inlineCallbacks
+    def test_iter_batch_inbound_messages_concurrency(self):
+        """
+        No more than the requested number of messages are fetched at once.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_inbound_message_sequence())
+        fetching = []
+        max_fetching = []
+        get_inbound_message = self.backend.get_inbound_message
+
+        def done(result, msg_id):
+            fetching.remove(msg_id)
+            return result
+
+        def get_message(msg_id):
+            fetching.append(msg_id)
+            max_fetching.append(len(fetching))
+            result = get_inbound_message(msg_id)
+            if isinstance(result, Deferred):
+                return result.addBoth(done, msg_id)
+            return done(result, msg_id)
+
+        self.patch(self.backend, "get_inbound_message", get_message)
+        msg_pages = yield self.backend.iter_batch_inbound_messages(
+            batch_id, concurrency=2)
+        msgs = yield msg_pages.next_page()
+        self.assertEqual(len(msgs), 5)
+        self.assertTrue(max(max_fetching) <= 2)
+
     @inlineCallbacks
     def test_list_batch_inbound_messages_empty(self):
         """
@@ -777,6 +1148,27 @@ class RiakBackendTestMixin(object):
         keys_p2 = yield keys_p1.next_page()
         self.assertEqual(list(keys_p2), all_keys[3:])
 
+    @inlineCallbacks
+    def test_iter_batch_outbound_messages(self):
+        """
+        We can iterate over pages of full outbound messages for a batch in
+        descending timestamp order.
+        """
+        batch_id, all_keys = (
+            yield self.msg_seq_helper.create_outbound_message_sequence())
+        msg_pages = yield self.backend.iter_batch_outbound_messages(
+            batch_id, page_size=3)
+        msgs_p1 = yield msg_pages.next_page()
+        self.assertEqual(
+            [msg["message_id"] for msg in msgs_p1],
+            [key for key, _, _ in all_keys[:3]])
+        msgs_p2 = yield msg_pages.next_page()
+        self.assertEqual(
+            [msg["message_id"] for msg in msgs_p2],
+            [key for key, _, _ in all_keys[3:]])
+        msgs_p3 = yield msg_pages.next_page()
+        self.assertEqual(msgs_p3, None)
+
     @inlineCallbacks
     def test_list_batch_outbound_messages_range_start(self):
         """
@@ -941,6 +1333,27 @@ class RiakBackendTestMixin(object):
         keys_p2 = yield keys_p1.next_page()
         self.assertEqual(list(keys_p2), all_keys[3:])
 
+    @inlineCallbacks
+    def test_iter_batch_events(self):
+        """
+        We can iterate over pages of full events for a batch in descending
+        timestamp order.
+        """
+        batch_id, msg_id, all_keys = (
+            yield self.msg_seq_helper.create_ack_event_sequence())
+        event_pages = yield self.backend.iter_batch_events(
+            batch_id, page_size=3)
+        events_p1 = yield event_pages.next_page()
+        self.assertEqual(
+            [event["event_id"] for event in events_p1],
+            [key for key, _, _ in all_keys[:3]])
+        events_p2 = yield event_pages.next_page()
+        self.assertEqual(
+            [event["event_id"] for event in events_p2],
+            [key for key, _, _ in all_keys[3:]])
+        events_p3 = yield event_pages.next_page()
+        self.assertEqual(events_p3, None)
+
     @inlineCallbacks
     def test_list_batch_events_range_start(self):
         """
@@ -0,0 +1,107 @@
+"""
+Tests for vumi_message_store.utils.
+"""
+from twisted.internet.defer import (
+    Deferred, fail, inlineCallbacks, returnValue, succeed)
+from vumi.tests.helpers import VumiTestCase
+
+from vumi_message_store.utils import bounded_map, gather_results
+
+
+class TestGatherResults(VumiTestCase):
+
+    def test_no_deferreds(self):
+        """
+        If none of the results are Deferreds, we get a list of them back
+        immediately.
+        """
+        self.assertEqual(gather_results([1, "a", None]), [1, "a", None])
+        self.assertEqual(gather_results(iter([])), [])
+
+    @inlineCallbacks
+    def test_deferreds(self):
+        """
+        If any of the results are Deferreds, we get a Deferred that fires with
+        all the results in order.
+        """
+        d1 = Deferred()
+        d = gather_results([d1, succeed(2), 3])
+        self.assertEqual(d.called, False)
+        d1.callback(1)
+        results = yield d
+        self.assertEqual(results, [1, 2, 3])
+
+    @inlineCallbacks
+    def test_failure_unwrapped(self):
+        """
+        If any of the Deferreds fail, the original failure is propagated.
+        """
+        d = gather_results([succeed(1), fail(ValueError("oops"))])
+        err = yield self.assertFailure(d, ValueError)
+        self.assertEqual(str(err), "oops")
+
+
+class TestBoundedMap(VumiTestCase):
+
+    def test_no_deferreds(self):
+        """
+        If the function returns plain values, we get a list of results back
+        immediately.
+        """
+        self.assertEqual(bounded_map(lambda x: x * 2, [1, 2, 3], 2), [2, 4, 6])
+        self.assertEqual(bounded_map(lambda x: x * 2, [], 2), [])
+
+    @inlineCallbacks
+    def test_concurrency_limit(self):
+        """
+        No more than the requested number of calls are waiting on results at
+        once, and results are returned in input order.
+        """
+        waiting = {}
+
+        def func(item):
+            waiting[item] = Deferred()
+            return waiting[item]
+
+        d = bounded_map(func, range(5), 2)
+        self.assertEqual(sorted(waiting.keys()), [0, 1])
+        waiting[1].callback("r1")
+        self.assertEqual(sorted(waiting.keys()), [0, 1, 2])
+        waiting[0].callback("r0")
+        self.assertEqual(sorted(waiting.keys()), [0, 1, 2, 3])
+        waiting[3].callback("r3")
+        waiting[2].callback("r2")
+        self.assertEqual(d.called, False)
+        waiting[4].callback("r4")
+        results = yield d
+        self.assertEqual(results, ["r0", "r1", "r2", "r3", "r4"])
+
+    @inlineCallbacks
+    def test_failure(self):
+        """
+        If any of the calls fail, the failure is propagated.
+        """
+        def func(item):
+            if item == 2:
+                return fail(ValueError("oops"))
+            return succeed(item)
+
+        d = bounded_map(func, range(4), 2)
+        err = yield self.assertFailure(d, ValueError)
+        self.assertEqual(str(err), "oops")
+
+    @inlineCallbacks
+    def test_many_fired_deferreds(self):
+        """
+        Many Deferreds that have already fired don't exhaust the stack.
+        """
+        results = yield bounded_map(succeed, range(20000), 2)
+        self.assertEqual(results, range(20000))
+
+        @inlineCallbacks
+        def func(item):
+            value = yield succeed(item)
+            returnValue(value * 2)
+
+        results = yield bounded_map(func, range(5000), 10)
+        self.assertEqual(results, [i * 2 for i in range(5000)])
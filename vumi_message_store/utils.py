@@ -0,0 +1,89 @@
+# -*- test-case-name: vumi_message_store.tests.test_utils -*-
+
+"""
+Assorted helpers shared by the message store components.
+"""
+
+from twisted.internet.defer import (
+    Deferred, gatherResults, inlineCallbacks, succeed)
+
+
+def _unwrap_first_error(failure):
+    """
+    Return the original failure wrapped in a FirstError.
+    """
+    return failure.value.subFailure
+
+
+def gather_results(results):
+    """
+    Wait for a sequence of results, any of which may be Deferreds.
+
+    Async Redis and Riak managers return Deferreds while sync managers return
+    plain values, so this works with both. Making several async calls before
+    waiting on any of them lets the client send all the requests without
+    waiting for a response in between.
+
+    :param results:
+        Sequence of results or Deferreds.
+
+    :returns:
+        A list of results in the same order as the input. If any of the inputs
+        is a Deferred, a Deferred is returned instead. The first failure (if
+        any) is propagated unwrapped.
+    """
+    results = list(results)
+    if not any(isinstance(r, Deferred) for r in results):
+        return results
+    d = gatherResults([
+        r if isinstance(r, Deferred) else succeed(r) for r in results],
+        consumeErrors=True)
+    d.addErrback(_unwrap_first_error)
+    return d
+
+
+def bounded_map(func, items, concurrency):
+    """
+    Call a function for each item, waiting on at most ``concurrency`` results
+    at any one time.
+
+    If the function returns plain values (as it does for sync managers), the
+    calls are made one after the other.
+
+    :param func:
+        Callable that takes a single item and returns a result or a Deferred.
+    :param items:
+        Sequence of items to call ``func`` with.
+    :param concurrency:
+        The maximum number of Deferreds to wait on at once.
+
+    :returns:
+        A list of results in the same order as the input. If any of the calls
+        returned a Deferred, a Deferred is returned instead.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = iter(enumerate(items))
+
+    @inlineCallbacks
+    def wait_for_items(result, index):
+        # Once a worker has a Deferred to wait on, it carries on in a loop
+        # rather than chaining callbacks, so that Deferreds that have already
+        # fired don't grow the stack.
+        results[index] = yield result
+        for index, item in pending:
+            results[index] = yield func(item)
+
+    def process_items():
+        # All workers share the same iterator, so each item is only processed
+        # once no matter which worker picks it up.
+        for index, item in pending:
+            result = func(item)
+            if isinstance(result, Deferred):
+                return wait_for_items(result, index)
+            results[index] = result
+
+    d = gather_results([process_items() for _ in xrange(max(concurrency, 1))])
+    if isinstance(d, Deferred):
+        return d.addCallback(lambda _: results)
+    return results